@@ -10,6 +10,7 @@ __version__="0.0.6"
 import contextlib
 
 from .account import Cloudant, CouchDB
+from .replication import replicate
 
 
 @contextlib.contextmanager
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+_batch_
+
+Helpers for splitting large bulk requests into bounded chunks
+and running those chunks concurrently against the server
+
+"""
+import collections
+import itertools
+import json
+import Queue
+import re
+import sys
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from .errors import CloudantArgumentError
+
+_DONE = object()
+
+
+def chunked(items, size):
+    """
+    _chunked_
+
+    Split the items provided into lists of at most size elements,
+    preserving order
+
+    :param items: iterable of things to split up
+    :param size: int, max number of elements per chunk
+
+    """
+    if size < 1:
+        msg = "Chunk size must be a positive integer, got {0}".format(size)
+        raise CloudantArgumentError(msg)
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def size_bounded_chunks(items, max_items=None, max_bytes=None, sizer=None):
+    """
+    _size_bounded_chunks_
+
+    Split items into lists that are bounded both by number of elements
+    and by the approximate size of their JSON encoding, so that request
+    bodies stay a manageable size. A single item larger than max_bytes
+    is emitted as a chunk on its own.
+
+    :param items: iterable of JSON serialisable things
+    :param max_items: optional int, max number of elements per chunk
+    :param max_bytes: optional int, max encoded size of a chunk in bytes
+    :param sizer: optional callable returning the encoded size of an item,
+      defaults to the length of its JSON encoding
+
+    """
+    if sizer is None:
+        sizer = lambda x: len(json.dumps(x))
+    chunk = []
+    chunk_bytes = 0
+    for item in items:
+        item_bytes = sizer(item) if max_bytes is not None else 0
+        over_size = (
+            max_bytes is not None and chunk and
+            chunk_bytes + item_bytes > max_bytes
+        )
+        over_count = max_items is not None and len(chunk) >= max_items
+        if over_size or over_count:
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(item)
+        # allow for the separator between elements
+        chunk_bytes += item_bytes + 1
+    if chunk:
+        yield chunk
+
+
+def put_unless_stopped(queue, item, stop, poll_interval=0.1):
+    """
+    _put_unless_stopped_
+
+    Put item on a bounded queue, waiting for room as long as it takes,
+    but give up once the stop event is set, so that a producer never
+    blocks forever on a consumer that has gone away
+
+    :param queue: Queue.Queue to put item on
+    :param item: the thing to queue
+    :param stop: threading.Event that is set when the consumer stops
+    :param poll_interval: seconds between checks of the stop event
+
+    :returns: True if item was queued, False if stop was set first
+
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=poll_interval)
+            return True
+        except Queue.Full:
+            continue
+    return False
+
+
+def _lookahead(items):
+    """
+    returns an iterator over items, read lazily, and whether it has
+    more than one element
+    """
+    items = iter(items)
+    head = list(itertools.islice(items, 2))
+    return itertools.chain(head, items), len(head) > 1
+
+
+def parallel_map(func, items, workers=4, ordered=True, max_pending=None):
+    """
+    _parallel_map_
+
+    Apply func to each of the items using a pool of worker threads,
+    yielding the results as they become available.
+    If ordered is True the results are yielded in the same order as
+    the items, otherwise in order of completion.
+    The items are read lazily and at most max_pending of them are
+    submitted to the pool ahead of the consumer, so a slow consumer
+    holds back the producer rather than results piling up in memory.
+    With a single worker, or a single item, no threads are started.
+
+    :param func: callable taking a single item
+    :param items: iterable of items to process
+    :param workers: int, number of threads to use
+    :param ordered: boolean, preserve input order in the results
+    :param max_pending: max number of items in flight or waiting to be
+      consumed, defaults to twice the number of workers
+
+    """
+    items, many = _lookahead(items)
+    if workers <= 1 or not many:
+        for item in items:
+            yield func(item)
+        return
+
+    if max_pending is None:
+        max_pending = workers * 2
+    max_pending = max(max_pending, 1)
+
+    def call(item):
+        try:
+            return True, func(item)
+        except Exception:
+            return False, sys.exc_info()
+
+    pool = ThreadPool(min(workers, max_pending))
+    completed = Queue.Queue()
+    pending = collections.deque()
+
+    def next_result():
+        result = pending.popleft()
+        if ordered:
+            success, value = result.get()
+        else:
+            success, value = completed.get()
+        if not success:
+            raise value[0], value[1], value[2]
+        return value
+
+    try:
+        for item in items:
+            if ordered:
+                pending.append(pool.apply_async(call, (item,)))
+            else:
+                pending.append(pool.apply_async(
+                    call, (item,), callback=completed.put
+                ))
+            if len(pending) >= max_pending:
+                yield next_result()
+        while pending:
+            yield next_result()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parallel_stream(func, items, workers=4, max_pending=1000):
+    """
+    _parallel_stream_
+
+    Like parallel_map, but func returns an iterator for each item and
+    the elements of those iterators are yielded as soon as the worker
+    threads produce them, so that no single result is held in memory
+    as a whole. The items are read lazily as workers become free and
+    at most max_pending elements are buffered between the workers and
+    the consumer. Exceptions in the workers are re-raised in the
+    consuming thread.
+
+    :param func: callable taking a single item and returning an iterator
+    :param items: iterable of items to process
+    :param workers: int, number of threads to use
+    :param max_pending: max number of produced elements to buffer
+
+    """
+    items, many = _lookahead(items)
+    if workers <= 1 or not many:
+        for item in items:
+            for result in func(item):
+                yield result
+        return
+
+    items_lock = threading.Lock()
+    results = Queue.Queue(max_pending)
+    stop = threading.Event()
+
+    def put(message):
+        return put_unless_stopped(results, message, stop)
+
+    def worker():
+        try:
+            while not stop.is_set():
+                with items_lock:
+                    item = next(items, _DONE)
+                if item is _DONE:
+                    break
+                for result in func(item):
+                    if not put(('result', result)):
+                        return
+        except Exception:
+            put(('error', sys.exc_info()))
+        finally:
+            put(('done', None))
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        running = len(threads)
+        while running:
+            kind, value = results.get()
+            if kind == 'result':
+                yield value
+            elif kind == 'error':
+                raise value[0], value[1], value[2]
+            else:
+                running -= 1
+    finally:
+        stop.set()
+
+
+_STRUCTURE = re.compile(r'[{}\[\]"]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r'[\s,\]}]')
+
+
+class _ValueScanner(object):
+    """
+    finds the end of a single JSON value delivered in pieces, tracking
+    nesting depth and string state across the pieces so that each
+    character is only looked at once
+    """
+    def __init__(self):
+        self.started = False
+        self.scalar = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, text, start=0):
+        """
+        scan text from start, returns the index just after the end of
+        the value, or None if it continues into the next piece
+        """
+        if not self.started:
+            self.started = True
+            self.scalar = text[start] not in '{["'
+        if self.scalar:
+            match = _SCALAR_END.search(text, start)
+            return match.start() if match else None
+        pos = start
+        while pos < len(text):
+            if self.escape:
+                self.escape = False
+                pos += 1
+                continue
+            if self.in_string:
+                match = _STRING_SPECIAL.search(text, pos)
+                if match is None:
+                    return None
+                pos = match.end()
+                if match.group() == '\\':
+                    self.escape = True
+                else:
+                    self.in_string = False
+                    if self.depth == 0:
+                        return pos
+                continue
+            match = _STRUCTURE.search(text, pos)
+            if match is None:
+                return None
+            pos = match.end()
+            char = match.group()
+            if char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    return pos
+        return None
+
+
+def iter_json_array(chunks, field, decoder=None):
+    """
+    _iter_json_array_
+
+    Incrementally decode the elements of the array stored under field
+    in a JSON object that is delivered as a sequence of text chunks,
+    such as a streamed HTTP response body, yielding each element as
+    soon as it has been completely received.
+
+    Eg for chunks making up {"results": [{"a": 1}, {"b": 2}]}
+    iter_json_array(chunks, "results") yields {"a": 1} then {"b": 2}
+
+    :param chunks: iterable of str chunks of the JSON document
+    :param field: name of the top level field holding the array
+    :param decoder: optional json.JSONDecoder instance
+
+    """
+    decoder = decoder or json.JSONDecoder()
+    start_pattern = re.compile(r'"{0}"\s*:\s*\['.format(re.escape(field)))
+    chunks = iter(chunks)
+    buf = ''
+
+    def more():
+        for chunk in chunks:
+            if chunk:
+                return chunk
+        return None
+
+    def more_elements():
+        chunk = more()
+        if chunk is None:
+            raise ValueError(
+                "Truncated JSON array for field {0}".format(field)
+            )
+        return chunk
+
+    # locate the start of the array
+    while True:
+        match = start_pattern.search(buf)
+        if match is not None:
+            buf = buf[match.end():]
+            break
+        chunk = more()
+        if chunk is None:
+            return
+        buf += chunk
+
+    pos = 0
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buf):
+            buf, pos = more_elements(), 0
+            continue
+        if buf[pos] == ']':
+            return
+        # find where the element ends before decoding it, so that a
+        # large element split over many chunks is only parsed once
+        scanner = _ValueScanner()
+        parts = []
+        end = scanner.feed(buf, pos)
+        while end is None:
+            parts.append(buf[pos:])
+            buf, pos = more_elements(), 0
+            end = scanner.feed(buf, pos)
+        parts.append(buf[pos:end])
+        yield decoder.decode(''.join(parts))
+        pos = end
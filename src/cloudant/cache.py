@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+_cache_
+
+Client side caching of query results, invalidated when the
+database changes
+
+"""
+import collections
+import json
+import threading
+import time
+
+
+def query_cache_key(params, keys=None):
+    """
+    _query_cache_key_
+
+    Normalise query params, as produced by python_to_couch, and an
+    optional list of keys into a hashable cache key
+
+    """
+    return json.dumps([sorted(params.iteritems()), keys], sort_keys=True)
+
+
+class QueryCache(object):
+    """
+    _QueryCache_
+
+    LRU cache of query results tagged with the database update_seq
+    they were computed at. An entry is only served while the update_seq
+    is unchanged and it is younger than ttl seconds. The update_seq is
+    looked up at most every seq_check_interval seconds, so changes made
+    within that interval may not be seen straight away.
+
+    In stale while revalidate mode, an out of date entry is served
+    immediately and refreshed in a background thread, in the same
+    spirit as stale=update_after: callers accept a slightly old answer
+    in exchange for not waiting. This mode is also used for queries
+    that pass stale themselves.
+
+    Hits, misses and the query time saved by hits are counted, see stats.
+
+    :param max_entries: max number of results to keep
+    :param ttl: optional max age in seconds of a result
+    :param stale_while_revalidate: serve out of date results while
+      refreshing them in the background
+    :param seq_check_interval: min seconds between update_seq lookups
+
+    """
+    def __init__(self, max_entries=100, ttl=None,
+                 stale_while_revalidate=False, seq_check_interval=1.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.seq_check_interval = seq_check_interval
+        self._entries = collections.OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._seq = None
+        self._seq_checked = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.refresh_errors = 0
+        self.saved_seconds = 0.0
+
+    def _current_seq(self, update_seq):
+        """the update_seq, looked up if it hasnt been checked recently"""
+        now = time.time()
+        if self._seq_checked is None or \
+                now - self._seq_checked >= self.seq_check_interval:
+            self._seq = update_seq()
+            self._seq_checked = now
+        return self._seq
+
+    def _fresh(self, entry, seq):
+        """is entry valid at seq"""
+        if entry['seq'] != seq:
+            return False
+        if self.ttl is not None and \
+                time.time() - entry['stored'] >= self.ttl:
+            return False
+        return True
+
+    def _store(self, key, value, seq, latency):
+        """add a result to the cache, evicting the least recently used"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = {
+                'value': value,
+                'seq': seq,
+                'stored': time.time(),
+                'latency': latency,
+            }
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _compute(self, key, query, seq):
+        """run the query, caching and returning its result"""
+        start = time.time()
+        value = query()
+        self._store(key, value, seq, time.time() - start)
+        return value
+
+    def _refresh(self, key, query, seq):
+        """rerun the query for a stale entry in the background"""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self._compute(key, query, seq)
+            except Exception:
+                with self._lock:
+                    self.refresh_errors += 1
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def get(self, key, query, update_seq, allow_stale=False):
+        """
+        _get_
+
+        Get the result for key from the cache if it is valid, otherwise
+        run query and cache its result
+
+        :param key: cache key, see query_cache_key
+        :param query: callable that runs the query
+        :param update_seq: callable returning the database update_seq
+        :param allow_stale: serve an out of date result while refreshing
+          it in the background, even if stale_while_revalidate is off
+
+        """
+        seq = self._current_seq(update_seq)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._fresh(entry, seq):
+                    # move to the most recently used end
+                    del self._entries[key]
+                    self._entries[key] = entry
+                    self.hits += 1
+                    self.saved_seconds += entry['latency']
+                    return entry['value']
+                self.invalidations += 1
+                if allow_stale or self.stale_while_revalidate:
+                    self.stale_hits += 1
+                    self.saved_seconds += entry['latency']
+                else:
+                    del self._entries[key]
+                    entry = None
+            if entry is None:
+                self.misses += 1
+        if entry is not None:
+            self._refresh(key, query, seq)
+            return entry['value']
+        return self._compute(key, query, seq)
+
+    def clear(self):
+        """
+        _clear_
+
+        Drop all the cached results
+
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        _stats_
+
+        :returns: dict of the hit and miss counts, the hit ratio and
+          the seconds of query time saved by serving cached results
+
+        """
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_ratio': (
+                    float(self.hits + self.stale_hits) / lookups
+                    if lookups else 0.0
+                ),
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'refresh_errors': self.refresh_errors,
+                'saved_seconds': self.saved_seconds,
+            }
@@ -6,7 +6,104 @@ Iterator support for consuming changes-like feeds
 
 """
 
+import collections
 import json
+import Queue
+import sys
+import threading
+import time
+
+import requests
+
+from .batch import put_unless_stopped
+from .errors import CloudantArgumentError
+
+NETWORK_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+def _seq_number(seq):
+    """
+    the numeric part of a seq, eg 26982 for "26982-g1AAA...",
+    or None if it doesnt have one
+    """
+    if isinstance(seq, (int, long)):
+        return seq
+    if isinstance(seq, basestring):
+        try:
+            return int(seq.split('-', 1)[0])
+        except ValueError:
+            return None
+    return None
+
+
+def _heartbeat_ms(seconds):
+    """
+    the heartbeat in ms for a feed whose consumer waits up to seconds
+    for changes, between one second and a minute
+    """
+    return min(60000, max(1000, int(seconds * 1000)))
+
+
+class FeedMetrics(object):
+    """
+    _FeedMetrics_
+
+    Counters describing the health and throughput of a Feed.
+    Rates are averaged over the time since the metrics were created.
+    The lag is an estimate of how many changes the feed is behind the
+    database, based on the numeric prefix of the seqs, and is None
+    until it has been measured.
+
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.changes = 0
+        self.bytes = 0
+        self.parse_seconds = 0.0
+        self.bad_lines = 0
+        self.reconnects = 0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.update_seq = None
+        self.lag = None
+
+    def record_lag(self, seq, update_seq):
+        """
+        _record_lag_
+
+        Estimate the lag of a feed at seq behind the database update_seq
+
+        """
+        self.update_seq = update_seq
+        current = _seq_number(seq)
+        latest = _seq_number(update_seq)
+        if latest is None:
+            self.lag = None
+        else:
+            self.lag = max(0, latest - (current or 0))
+
+    def snapshot(self):
+        """
+        :returns: dict of the current metric values
+        """
+        elapsed = max(time.time() - self.started, 1e-6)
+        return {
+            'changes': self.changes,
+            'changes_per_sec': self.changes / elapsed,
+            'bytes': self.bytes,
+            'bytes_per_sec': self.bytes / elapsed,
+            'parse_seconds': self.parse_seconds,
+            'bad_lines': self.bad_lines,
+            'reconnects': self.reconnects,
+            'stalls': self.stalls,
+            'stall_seconds': self.stall_seconds,
+            'update_seq': self.update_seq,
+            'lag': self.lag,
+        }
 
 
 class Feed(object):
@@ -16,8 +113,103 @@ class Feed(object):
     Acts as an infinite iterator for consuming database feeds such as
     _changes, suitable for feeding a daemon.
 
+    If a checkpoint store is provided, the seq of each change is
+    committed to it once the change has been processed, ie when the
+    next change is requested, every checkpoint_every changes or
+    checkpoint_interval seconds, whichever comes first.
+    If no since value is given the feed resumes from the stored seq.
+    This gives at-least-once delivery: after a crash, changes that
+    were processed after the last commit will be seen again.
+
+    To detect connections that have silently died, pass heartbeat so
+    the server sends a blank line every heartbeat milliseconds while
+    idle. If nothing at all is read from the connection for
+    stall_timeout seconds (by default three heartbeat intervals) the
+    feed reconnects from the seq of the last change it returned.
+    Reconnects and stalls are counted in the metrics attribute.
+
+    On any network error, or if a feed that is followed forever ends
+    without a last_seq, the feed reconnects from the seq of the last
+    change it returned, which is available as feed.last_seq for
+    external checkpointing. The first reconnect is immediate, repeated
+    failures back off exponentially from backoff seconds up to
+    max_backoff, and after max_retries consecutive failures the error
+    is raised.
+
+    Changes can be filtered on the server, so that only the relevant
+    ones are sent over the wire:
+
+    Feed(session, url, selector={"type": "order"})  # Mango selector
+    Feed(session, url, doc_ids=["doc1", "doc2"])  # specific documents
+    Feed(session, url, view="ddoc/viewname")  # docs emitted by a view
+    Feed(session, url, filter="ddoc/filtername",
+         query_params={"status": "new"})  # design document filter
+
+    When following the feed forever, by default it is consumed as a
+    single long lived continuous stream, otherwise the changes so far
+    are fetched with a normal request. Where a long lived stream is not
+    possible, eg behind proxies that kill long connections,
+    feed="longpoll" or feed="normal" fetches pages of up to limit
+    changes with separate requests. When following such a
+    feed forever, the wait between requests adapts to the activity:
+    none after a full page, poll_interval after a partial page, doubling
+    up to max_poll_interval while the feed is idle. Batch consumers can
+    instead pull one bounded page at a time with next_page.
+
+    Throughput, parse time, bad lines and reconnects are tracked in
+    feed.metrics, whose snapshot method returns them as a dict. Given a
+    lag_source, a callable returning the database update_seq, the feed
+    also estimates how far behind it is every lag_interval seconds.
+    A metrics_hook callable is passed the snapshot every
+    metrics_interval seconds:
+
+    Feed(session, url, lag_source=lambda: db.metadata()['update_seq'],
+         metrics_hook=stats.report)
+
     :params:
 
+    :param session: requests.Session to use to access the feed
+    :param url: URL of the feed
+    :param include_docs: Include document bodies in the changes
+    :param since: Start from this sequence
+    :param continuous: Stream results forever
+    :param checkpoint: Optional CheckpointStore instance to commit the
+      processed seq to, and resume from
+    :param checkpoint_every: commit after this many processed changes
+    :param checkpoint_interval: commit after this many seconds
+    :param heartbeat: Optional, ms between server heartbeat lines
+    :param timeout: Optional, ms after which the server ends the feed
+      if there are no changes
+    :param stall_timeout: Optional, seconds without any data after which
+      the connection is considered dead and the feed reconnects
+    :param filter: Optional, name of the filter to apply, either a
+      design document filter as ddoc/filtername or one of the built in
+      _selector, _doc_ids, _view or _design filters
+    :param selector: Optional, Mango selector dict, implies _selector
+    :param doc_ids: Optional, list of document ids, implies _doc_ids
+    :param view: Optional, view name as ddoc/viewname, implies _view
+    :param query_params: Optional, dict of extra query parameters to
+      pass to a design document filter
+    :param style: Optional, all_docs to include all leaf revisions in
+      each change, or main_only
+    :param feed: continuous, longpoll or normal, defaults to continuous
+      when following the feed forever and normal otherwise
+    :param limit: Optional, max number of changes per request
+    :param poll_interval: seconds to wait between longpoll/normal
+      requests when the feed is not busy
+    :param max_poll_interval: max seconds to wait between requests
+      when the feed is idle
+    :param max_retries: max consecutive reconnect attempts, None to
+      retry forever
+    :param backoff: initial seconds to wait between reconnect attempts
+    :param max_backoff: max seconds to wait between reconnect attempts
+    :param lag_source: Optional callable returning the current update_seq
+      of the database, used to estimate the lag of the feed
+    :param lag_interval: seconds between lag estimates
+    :param metrics_hook: Optional callable passed a metrics snapshot dict
+      every metrics_interval seconds
+    :param metrics_interval: seconds between calls to metrics_hook
+
     """
     def __init__(self, session, url, include_docs=False, **kwargs):
         self._session = session
@@ -27,9 +219,165 @@ class Feed(object):
         self._last_seq = kwargs.get('since')
         self._continuous = kwargs.get('continuous', False)
         self._end_of_iteration = False
-        self._params = {'feed': 'continuous'}
+        self._feed_mode = kwargs.get('feed')
+        if self._feed_mode is None:
+            # a continuous stream only ends when the server times it out
+            self._feed_mode = 'continuous' if self._continuous else 'normal'
+        if self._feed_mode not in ('continuous', 'longpoll', 'normal'):
+            msg = (
+                "Invalid feed {0}, must be continuous, longpoll or normal"
+            ).format(self._feed_mode)
+            raise CloudantArgumentError(msg)
+        self._params = {'feed': self._feed_mode}
+        self._limit = kwargs.get('limit')
+        if self._limit is not None:
+            self._params['limit'] = self._limit
+        self._page = None
+        self._page_size = 0
+        self._page_last_seq = None
+        self._min_poll_interval = kwargs.get('poll_interval', 1.0)
+        self._max_poll_interval = kwargs.get('max_poll_interval', 60.0)
+        self._poll_interval = 0
         if include_docs:
             self._params['include_docs'] = 'true'
+        heartbeat = kwargs.get('heartbeat')
+        if heartbeat is not None:
+            self._params['heartbeat'] = heartbeat
+        if kwargs.get('timeout') is not None:
+            self._params['timeout'] = kwargs['timeout']
+        self._body = self._filter_options(kwargs)
+        self._stall_timeout = kwargs.get('stall_timeout')
+        if self._stall_timeout is None and heartbeat is not None:
+            self._stall_timeout = 3 * heartbeat / 1000.0
+        self._last_read = None
+        self._max_retries = kwargs.get('max_retries', 10)
+        self._backoff = kwargs.get('backoff', 0.5)
+        self._max_backoff = kwargs.get('max_backoff', 60.0)
+        self._retries = 0
+        self.metrics = FeedMetrics()
+        self._lag_source = kwargs.get('lag_source')
+        self._lag_interval = kwargs.get('lag_interval', 60.0)
+        self._last_lag_check = None
+        self._metrics_hook = kwargs.get('metrics_hook')
+        self._metrics_interval = kwargs.get('metrics_interval', 10.0)
+        self._last_metrics_report = time.time()
+
+        self._checkpoint = kwargs.get('checkpoint')
+        self._checkpoint_every = kwargs.get('checkpoint_every', 100)
+        self._checkpoint_interval = kwargs.get('checkpoint_interval', 10.0)
+        self._pending_seq = None
+        self._processed_seq = None
+        self._committed_seq = None
+        self._uncommitted = 0
+        self._last_commit = time.time()
+        if self._checkpoint is not None and self._last_seq is None:
+            self._last_seq = self._checkpoint.load()
+            self._committed_seq = self._last_seq
+
+    def _filter_options(self, options):
+        """
+        _filter_options_
+
+        Add the query params for any server side filtering to the
+        feed params.
+
+        :returns: the dict to POST as the request body for the filter,
+          or None if the filter doesnt need a body
+
+        """
+        filter_name = options.get('filter')
+        body = None
+        implied = [
+            ('selector', '_selector'),
+            ('doc_ids', '_doc_ids'),
+            ('view', '_view'),
+        ]
+        for option, implied_filter in implied:
+            if options.get(option) is None:
+                continue
+            if filter_name not in (None, implied_filter):
+                msg = "Cannot use {0} with filter {1}".format(
+                    option,
+                    filter_name
+                )
+                raise CloudantArgumentError(msg)
+            filter_name = implied_filter
+
+        if filter_name == '_selector':
+            if options.get('selector') is None:
+                msg = "The _selector filter requires a selector"
+                raise CloudantArgumentError(msg)
+            body = {'selector': options['selector']}
+        elif filter_name == '_doc_ids':
+            if options.get('doc_ids') is None:
+                msg = "The _doc_ids filter requires doc_ids"
+                raise CloudantArgumentError(msg)
+            body = {'doc_ids': list(options['doc_ids'])}
+        elif filter_name == '_view':
+            if options.get('view') is None:
+                msg = "The _view filter requires a view"
+                raise CloudantArgumentError(msg)
+            self._params['view'] = options['view']
+
+        if filter_name is not None:
+            self._params['filter'] = filter_name
+        if options.get('query_params'):
+            self._params.update(options['query_params'])
+        if options.get('style') is not None:
+            if options['style'] not in ('all_docs', 'main_only'):
+                msg = (
+                    "Invalid style {0}, must be all_docs or main_only"
+                ).format(options['style'])
+                raise CloudantArgumentError(msg)
+            self._params['style'] = options['style']
+        return body
+
+    @property
+    def last_seq(self):
+        """
+        the seq of the last change returned by the feed, which is
+        where the feed will resume from if it reconnects
+        """
+        return self._last_seq
+
+    def _ack(self):
+        """
+        _ack_
+
+        Mark the last change handed out as processed, and commit the
+        checkpoint if enough changes or time have gone by. This runs on
+        every call to next, heartbeats included, so processed changes
+        are committed on time even while the feed is idle.
+
+        """
+        if self._pending_seq is not None:
+            self._processed_seq = self._pending_seq
+            self._pending_seq = None
+            self._uncommitted += 1
+        if self._checkpoint is None or \
+                self._processed_seq == self._committed_seq:
+            return
+        elapsed = time.time() - self._last_commit
+        if self._uncommitted >= self._checkpoint_every or \
+                elapsed >= self._checkpoint_interval:
+            self.commit()
+
+    def commit(self):
+        """
+        _commit_
+
+        Save the seq of the last processed change to the checkpoint
+        store, if there is one and the seq has moved on
+
+        """
+        if self._checkpoint is None:
+            return
+        seq = self._processed_seq
+        if seq is not None and seq != self._committed_seq:
+            self._checkpoint.save(seq)
+            self._committed_seq = seq
+        self._uncommitted = 0
+        self._last_commit = time.time()
 
     def start(self):
         """
@@ -40,12 +388,203 @@ class Feed(object):
         if a last seq value is present, pass that along.
 
         """
-        params = self._params
+        params = dict(self._params)
         if self._last_seq is not None:
             params['since'] = self._last_seq
-        self._resp = self._session.get(self._url, params=params, stream=True)
+        stream = self._feed_mode == 'continuous'
+        if self._body is not None:
+            self._resp = self._session.post(
+                self._url,
+                params=params,
+                data=json.dumps(self._body),
+                headers={'Content-Type': 'application/json'},
+                stream=stream,
+                timeout=self._stall_timeout
+            )
+        else:
+            self._resp = self._session.get(
+                self._url,
+                params=params,
+                stream=stream,
+                timeout=self._stall_timeout
+            )
         self._resp.raise_for_status()
-        self._line_iter = self._resp.iter_lines()
+        self._last_read = time.time()
+        if stream:
+            self._line_iter = self._resp.iter_lines()
+        else:
+            content = self._resp.content
+            self.metrics.bytes += len(content)
+            parse_start = time.time()
+            data = json.loads(content)
+            self.metrics.parse_seconds += time.time() - parse_start
+            results = data.get('results', [])
+            self._page = iter(results)
+            self._page_size = len(results)
+            self._page_last_seq = data.get('last_seq')
+
+    def _adapt_poll_interval(self):
+        """
+        _adapt_poll_interval_
+
+        Work out how long to wait before requesting the next page,
+        based on how many changes were in the last one
+
+        """
+        if self._limit is not None and self._page_size >= self._limit:
+            # busy, there are probably more changes waiting
+            self._poll_interval = 0
+        elif self._page_size > 0:
+            self._poll_interval = self._min_poll_interval
+        else:
+            self._poll_interval = min(
+                self._max_poll_interval,
+                max(self._min_poll_interval, self._poll_interval * 2)
+            )
+
+    def _end_of_page(self):
+        """
+        _end_of_page_
+
+        Move the feed position on to the last_seq of the page that
+        has just been consumed
+
+        """
+        self._page = None
+        if self._page_last_seq is not None:
+            self._last_seq = self._page_last_seq
+            self._processed_seq = self._page_last_seq
+
+    def next_page(self):
+        """
+        _next_page_
+
+        Fetch the next page of up to limit changes with a single
+        longpoll or normal request, moving the feed position on to
+        the end of the page. The feed must have been given a limit.
+
+        :returns: ChangesBatch of the changes, with the last_seq of
+          the page
+
+        """
+        if self._feed_mode == 'continuous':
+            msg = "next_page requires a longpoll or normal feed"
+            raise CloudantArgumentError(msg)
+        if self._limit is None:
+            msg = "next_page requires a limit"
+            raise CloudantArgumentError(msg)
+        self._ack()
+        self._connect()
+        self._retries = 0
+        batch = ChangesBatch(list(self._page), self._page_last_seq)
+        self._end_of_page()
+        self.metrics.changes += len(batch)
+        self._update_metrics()
+        return batch
+
+    def _next_paged(self):
+        """
+        _next_paged_
+
+        Iterate over a longpoll or normal feed, fetching pages of
+        changes as needed. Returns an empty dict at the end of each page
+        when following forever, and the last_seq at the end of the
+        first page otherwise.
+
+        """
+        if self._page is None:
+            if self._poll_interval:
+                time.sleep(self._poll_interval)
+            self._connect()
+            self._retries = 0
+        try:
+            data = self._page.next()
+        except StopIteration:
+            self._end_of_page()
+            if self._continuous:
+                self._adapt_poll_interval()
+                return {}
+            self._end_of_iteration = True
+            return {'last_seq': self._page_last_seq}
+        if data.get('seq') is not None:
+            self._pending_seq = data['seq']
+            self._last_seq = data['seq']
+        return data
+
+    def _connect(self):
+        """
+        _connect_
+
+        start the feed, reconnecting if the request fails
+
+        """
+        try:
+            self.start()
+        except NETWORK_ERRORS as ex:
+            self._reconnect(ex)
+
+    def _reconnect(self, error):
+        """
+        _reconnect_
+
+        Drop the current connection after error and start a new one
+        from the last seq seen, backing off exponentially while the
+        attempts keep failing
+
+        """
+        if self._resp is not None:
+            try:
+                self._resp.close()
+            except Exception:
+                pass
+        while True:
+            self._retries += 1
+            if self._max_retries is not None and \
+                    self._retries > self._max_retries:
+                raise error
+            if self._retries > 1:
+                delay = self._backoff * 2 ** (self._retries - 2)
+                time.sleep(min(self._max_backoff, delay))
+            self.metrics.reconnects += 1
+            try:
+                self.start()
+                return
+            except NETWORK_ERRORS as ex:
+                error = ex
+
+    def _handle_read_error(self, error):
+        """
+        _handle_read_error_
+
+        Record a stall if the connection timed out reading, then
+        reconnect
+
+        """
+        timed_out = isinstance(error, requests.exceptions.Timeout) or \
+            'timed out' in str(error)
+        if timed_out and self._last_read is not None:
+            self.metrics.stalls += 1
+            self.metrics.stall_seconds += time.time() - self._last_read
+        self._reconnect(error)
+
+    def _update_metrics(self):
+        """
+        _update_metrics_
+
+        Estimate the lag and report the metrics to the hook when
+        they are due
+
+        """
+        now = time.time()
+        if self._lag_source is not None and (
+                self._last_lag_check is None or
+                now - self._last_lag_check >= self._lag_interval):
+            self._last_lag_check = now
+            self.metrics.record_lag(self._last_seq, self._lag_source())
+        if self._metrics_hook is not None and \
+                now - self._last_metrics_report >= self._metrics_interval:
+            self._last_metrics_report = now
+            self._metrics_hook(self.metrics.snapshot())
 
     def __iter__(self):
         """
@@ -69,25 +608,247 @@ class Feed(object):
         Returns JSON data representing what was seen in the feed.
 
         """
+        data = self._next()
+        if data.get('id') is not None:
+            self.metrics.changes += 1
+        self._update_metrics()
+        return data
+
+    def _next(self):
+        """
+        _next_
+
+        Get the next entry from the feed, see next
+
+        """
+        self._ack()
         if self._end_of_iteration:
+            self.commit()
             raise StopIteration
+        if self._feed_mode != 'continuous':
+            return self._next_paged()
         if not self._resp:
-            self.start()
-        line = self._line_iter.next()
+            self._connect()
+        try:
+            line = self._line_iter.next()
+        except StopIteration:
+            if not self._continuous:
+                self.commit()
+                raise
+            # the stream ended without a last_seq, eg the connection was
+            # closed by a proxy, so resume from the last change seen
+            self._reconnect(requests.exceptions.ConnectionError(
+                "Changes feed ended unexpectedly"
+            ))
+            return {}
+        except NETWORK_ERRORS as ex:
+            self._handle_read_error(ex)
+            return {}
+        self._last_read = time.time()
+        self._retries = 0
+        # allow for the newline stripped by iter_lines
+        self.metrics.bytes += len(line) + 1
         if len(line.strip()) == 0:
             return {}
+        parse_start = time.time()
         try:
             data = json.loads(line)
         except ValueError:
+            self.metrics.bad_lines += 1
             data = {"error": "Bad JSON line", "line": line}
+        self.metrics.parse_seconds += time.time() - parse_start
 
         if data.get('last_seq'):
             if self._continuous:
                 # forever mode => restart
                 self._last_seq = data['last_seq']
-                self.start()
+                self._processed_seq = data['last_seq']
+                self._connect()
                 return {}
             else:
                 # not forever mode => break
+                self._pending_seq = data['last_seq']
                 return data
+        if data.get('seq') is not None:
+            self._pending_seq = data['seq']
+            self._last_seq = data['seq']
         return data
+
+
+class ChangesBatch(list):
+    """
+    _ChangesBatch_
+
+    List of changes from a feed, along with the seq of the
+    last change in the batch, which can be used as a checkpoint
+    once the whole batch has been processed.
+
+    """
+    def __init__(self, changes=None, last_seq=None):
+        super(ChangesBatch, self).__init__(changes or [])
+        self.last_seq = last_seq
+
+
+def batch_changes(changes, max_size=100, max_wait=1.0):
+    """
+    _batch_changes_
+
+    Group an iterable of changes, such as a Feed, into ChangesBatch
+    lists which are yielded when either max_size changes have been
+    collected or max_wait seconds have passed since the first change
+    in the batch arrived. The changes are read in a background thread,
+    so a partial batch is flushed on time even while the iterable is
+    waiting for more changes. Entries without a change id, such as
+    heartbeats and bad lines, are not included in the batches.
+
+    :param changes: iterable of change dicts
+    :param max_size: max number of changes per batch
+    :param max_wait: max number of seconds to hold a partial batch
+
+    """
+    received = Queue.Queue(max_size)
+    stop = threading.Event()
+
+    def put(message):
+        return put_unless_stopped(received, message, stop)
+
+    def read():
+        try:
+            for change in changes:
+                if change.get('id') is None and \
+                        change.get('last_seq') is None:
+                    continue
+                if not put(('change', change)):
+                    return
+        except Exception:
+            put(('error', sys.exc_info()))
+        finally:
+            put(('done', None))
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+
+    batch = ChangesBatch()
+    started = None
+    try:
+        while True:
+            timeout = None
+            if batch:
+                timeout = max(0, started + max_wait - time.time())
+            try:
+                kind, value = received.get(timeout=timeout)
+            except Queue.Empty:
+                yield batch
+                batch = ChangesBatch()
+                continue
+            if kind == 'done':
+                break
+            if kind == 'error':
+                raise value[0], value[1], value[2]
+            if value.get('id') is not None:
+                if not batch:
+                    started = time.time()
+                batch.append(value)
+                batch.last_seq = value.get('seq', batch.last_seq)
+            elif batch:
+                batch.last_seq = value['last_seq']
+            if batch and (len(batch) >= max_size or
+                          time.time() - started >= max_wait):
+                yield batch
+                batch = ChangesBatch()
+        if batch:
+            yield batch
+    finally:
+        stop.set()
+
+
+class Coalescer(object):
+    """
+    _Coalescer_
+
+    Wraps an iterable of changes, such as a Feed, and collapses
+    repeated changes to the same document. Changes are
+    gathered into windows of up to max_count changes or window seconds,
+    and within each window only the latest change for each document id
+    is emitted, in seq order.
+
+    The number of changes dropped is available as coalesced.
+    If a checkpoint store is provided, the last seq of a window is
+    committed to it once every change emitted from that window has been
+    processed, ie when the next change is requested, so none of the
+    coalesced changes can be lost. The wrapped feed should not be given
+    the checkpoint store itself. Use for_database to follow the changes
+    of a database with a feed that heartbeats while it is idle.
+
+    Example:
+
+    coalescer = Coalescer.for_database(db, window=5, checkpoint=store)
+    for change in coalescer:
+        refresh(change['id'])
+
+    :param changes: iterable of change dicts
+    :param window: max number of seconds to gather a window for
+    :param max_count: max number of changes per window
+    :param checkpoint: optional CheckpointStore to commit seqs to
+
+    """
+    def __init__(self, changes, window=1.0, max_count=1000, checkpoint=None):
+        self._changes = changes
+        self._window = window
+        self._max_count = max_count
+        self._checkpoint = checkpoint
+        self.received = 0
+        self.emitted = 0
+        self.coalesced = 0
+        self.last_seq = None
+
+    @classmethod
+    def for_database(cls, database, window=1.0, max_count=1000,
+                     checkpoint=None, since=None, include_docs=False,
+                     **kwargs):
+        """
+        _for_database_
+
+        Coalesce the continuous _changes feed of database, resuming
+        from the checkpoint if no since value is given. The feed sends
+        a heartbeat every window seconds, between one second and a
+        minute, unless heartbeat is passed. Additional keyword arguments
+        are passed to the Feed, eg selector to filter the changes on the
+        server.
+
+        :param database: CouchDatabase to follow the changes of
+        :param window: max number of seconds to gather a window for
+        :param max_count: max number of changes per window
+        :param checkpoint: optional CheckpointStore to commit seqs to
+        :param since: optional seq to start from
+        :param include_docs: include the documents in the changes
+
+        """
+        if checkpoint is not None and since is None:
+            since = checkpoint.load()
+        kwargs.setdefault('heartbeat', _heartbeat_ms(window))
+        changes = database._changes_feed(
+            since, True, include_docs, **kwargs
+        )
+        return cls(changes, window, max_count, checkpoint)
+
+    def __iter__(self):
+        """
+        yield the latest change per document for each window
+        """
+        windows = batch_changes(self._changes, self._max_count, self._window)
+        for batch in windows:
+            latest = collections.OrderedDict()
+            for change in batch:
+                self.received += 1
+                if change['id'] in latest:
+                    del latest[change['id']]
+                    self.coalesced += 1
+                latest[change['id']] = change
+            for change in latest.itervalues():
+                self.emitted += 1
+                yield change
+            self.last_seq = batch.last_seq
+            if self._checkpoint is not None and self.last_seq is not None:
+                self._checkpoint.save(self.last_seq)
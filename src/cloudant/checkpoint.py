@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+_checkpoint_
+
+Durable storage for changes feed sequence checkpoints, so that
+feed consumers can resume where they left off after a restart
+
+"""
+import json
+import os
+import posixpath
+import sqlite3
+import tempfile
+import threading
+import urllib
+
+
+class CheckpointStore(object):
+    """
+    _CheckpointStore_
+
+    Interface for objects that persist the last processed seq of
+    a changes feed. Subclasses implement load and save.
+
+    """
+    def load(self):
+        """
+        _load_
+
+        :returns: the last saved seq, or None if there isnt one
+
+        """
+        raise NotImplementedError("load not implemented")
+
+    def save(self, seq):
+        """
+        _save_
+
+        Persist seq as the latest checkpoint
+
+        """
+        raise NotImplementedError("save not implemented")
+
+
+class MemoryCheckpointStore(CheckpointStore):
+    """
+    _MemoryCheckpointStore_
+
+    Non durable checkpoint store that keeps the seq in memory,
+    useful for tests and short lived consumers
+
+    """
+    def __init__(self, seq=None):
+        self.seq = seq
+
+    def load(self):
+        return self.seq
+
+    def save(self, seq):
+        self.seq = seq
+
+
+class FileCheckpointStore(CheckpointStore):
+    """
+    _FileCheckpointStore_
+
+    Checkpoint store that keeps the seq as JSON in a local file.
+    Writes go to a temporary file which is then renamed over the
+    checkpoint file so that a crash never leaves a partial checkpoint.
+
+    :param path: path of the checkpoint file
+
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as handle:
+            return json.load(handle).get('seq')
+
+    def save(self, seq):
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.checkpoint')
+        with os.fdopen(fd, 'w') as handle:
+            json.dump({'seq': seq}, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(tmp_path, self.path)
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """
+    _SQLiteCheckpointStore_
+
+    Checkpoint store that keeps seqs in a SQLite database table,
+    one row per named checkpoint, so that several feeds can share
+    a single database file.
+
+    :param path: path to the SQLite database file
+    :param name: name of the checkpoint row for this feed
+    :param table: name of the table to use
+
+    """
+    def __init__(self, path, name='default', table='checkpoints'):
+        self.path = os.path.expanduser(path)
+        self.name = name
+        self.table = table
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                (
+                    "CREATE TABLE IF NOT EXISTS {0} "
+                    "(name TEXT PRIMARY KEY, seq TEXT)"
+                ).format(self.table)
+            )
+
+    def _connect(self):
+        """open a connection to the checkpoint database"""
+        return sqlite3.connect(self.path)
+
+    def load(self):
+        with self._lock:
+            conn = self._connect()
+            try:
+                row = conn.execute(
+                    "SELECT seq FROM {0} WHERE name = ?".format(self.table),
+                    (self.name,)
+                ).fetchone()
+            finally:
+                conn.close()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save(self, seq):
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        (
+                            "INSERT OR REPLACE INTO {0} (name, seq) "
+                            "VALUES (?, ?)"
+                        ).format(self.table),
+                        (self.name, json.dumps(seq))
+                    )
+            finally:
+                conn.close()
+
+
+class LocalDocumentCheckpointStore(CheckpointStore):
+    """
+    _LocalDocumentCheckpointStore_
+
+    Checkpoint store that keeps the seq in a _local document in a
+    database. _local documents are not replicated and dont appear in
+    the changes feed, so the checkpoint can live alongside the data
+    being followed.
+
+    :param database: CouchDatabase instance to store the checkpoint in
+    :param checkpoint_id: id of the _local document, without the
+      _local/ prefix
+
+    """
+    def __init__(self, database, checkpoint_id):
+        self._database = database
+        self._r_session = database._r_session
+        self.checkpoint_id = checkpoint_id
+        self._rev = None
+
+    @property
+    def url(self):
+        """URL of the _local checkpoint document"""
+        return posixpath.join(
+            self._database.database_url,
+            '_local',
+            urllib.quote(self.checkpoint_id, safe='')
+        )
+
+    def _fetch(self):
+        """fetch the checkpoint document, or None if it doesnt exist"""
+        resp = self._r_session.get(self.url)
+        if resp.status_code == 404:
+            self._rev = None
+            return None
+        resp.raise_for_status()
+        data = resp.json()
+        self._rev = data.get('_rev')
+        return data
+
+    def load(self):
+        data = self._fetch()
+        if data is None:
+            return None
+        return data.get('seq')
+
+    def save(self, seq):
+        if self._rev is None:
+            self._fetch()
+        data = {'seq': seq}
+        if self._rev is not None:
+            data['_rev'] = self._rev
+        resp = self._r_session.put(
+            self.url,
+            data=json.dumps(data),
+            headers={'Content-Type': 'application/json'}
+        )
+        if resp.status_code == 409:
+            # someone else wrote the checkpoint, pick up their rev and retry
+            self._fetch()
+            data['_rev'] = self._rev
+            resp = self._r_session.put(
+                self.url,
+                data=json.dumps(data),
+                headers={'Content-Type': 'application/json'}
+            )
+        resp.raise_for_status()
+        self._rev = resp.json().get('rev')
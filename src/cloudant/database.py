@@ -10,11 +10,13 @@ import contextlib
 import posixpath
 import urllib
 
+from .batch import chunked, parallel_map, parallel_stream, iter_json_array
+from .batch import size_bounded_chunks
 from .document import Document
 from .views import DesignDocument
 from .errors import CloudantException
 from .index import python_to_couch, Index
-from .changes import Feed
+from .changes import Feed, batch_changes, _heartbeat_ms
 
 
 class CouchDatabase(dict):
@@ -204,6 +206,8 @@ class CouchDatabase(dict):
             boolean
         :param key: string. Return only documents that match the
             specified key
+        :param keys: list. Return only documents that match the specified
+            keys, these are POSTed in the request body
         :param limit: int. Limit the number of the returned documents
             to the specified number
         :param skip: int. Skip this number of records before starting to
@@ -215,14 +219,19 @@ class CouchDatabase(dict):
           rows, counts etc.
 
         """
+        keys = kwargs.pop('keys', None)
         params = python_to_couch(kwargs)
-        resp = self._r_session.get(
-            posixpath.join(
-                self.database_url,
-                '_all_docs'
-            ),
-            params=params
-        )
+        url = posixpath.join(self.database_url, '_all_docs')
+        if keys is not None:
+            resp = self._r_session.post(
+                url,
+                params=params,
+                data=json.dumps({'keys': keys}),
+                headers={'Content-Type': 'application/json'}
+            )
+            resp.raise_for_status()
+        else:
+            resp = self._r_session.get(url, params=params)
         data = resp.json()
         return data
 
@@ -260,25 +269,107 @@ class CouchDatabase(dict):
         docs = self.all_docs()
         return [row['id'] for row in docs.get('rows', [])]
 
-    def changes(self, since=None, continuous=True, include_docs=False):
+    def _changes_feed(self, since, continuous, include_docs, **kwargs):
         """
-        Implement streaming from changes feed. Yields any changes that occur.
-
-        @param str since: Start from this sequence
-        @param boolean continuous: Stream results?
+        create a Feed for the _changes of this database, using the
+        database update_seq as the lag source if track_lag is set
         """
-        changes_feed = Feed(
+        if kwargs.pop('track_lag', False):
+            kwargs.setdefault(
+                'lag_source',
+                lambda: self.metadata().get('update_seq')
+            )
+        return Feed(
             self._r_session,
             posixpath.join(self.database_url, '_changes'),
             since=since,
             continuous=continuous,
-            include_docs=include_docs
+            include_docs=include_docs,
+            **kwargs
+        )
+
+    def changes(self, since=None, continuous=True, include_docs=False,
+                **kwargs):
+        """
+        Implement streaming from changes feed. Yields any changes that occur.
+
+        @param str since: Start from this sequence
+        @param boolean continuous: Stream results?
+        @param boolean include_docs: Include document bodies in the results
+
+        Additional keyword arguments are passed to the Feed, eg checkpoint
+        to commit processed seqs to a CheckpointStore and resume from it,
+        or selector, doc_ids, view or filter to filter the changes on the
+        server. Pass track_lag=True to estimate how far the feed is behind
+        the database update_seq, and metrics_hook to receive the feed
+        metrics.
+
+        Example:
+
+        for change in db.changes(selector={"type": "order"}):
+            print change["id"]
+        """
+        changes_feed = self._changes_feed(
+            since, continuous, include_docs, **kwargs
         )
 
         for change in changes_feed:
             if change:
                 yield change
 
+    def changes_batches(self, max_size=100, max_wait=1.0, since=None,
+                        continuous=True, include_docs=False, hydrate=False,
+                        checkpoint=None, **kwargs):
+        """
+        _changes_batches_
+
+        Stream the changes feed in ChangesBatch lists, each yielded once
+        it holds max_size changes or max_wait seconds after its first
+        change arrived. Each batch carries the seq of its last change
+        as batch.last_seq.
+
+        If a checkpoint store is provided the feed resumes from it, and
+        the last_seq of each batch is saved to it when the next batch is
+        requested, ie once the batch has been processed. Unless heartbeat
+        is passed, the feed heartbeats every max_wait seconds, between
+        one second and a minute, so that a dead connection is noticed
+        while a partial batch is waiting.
+
+        Example:
+
+        for batch in db.changes_batches(max_size=500, hydrate=True):
+            warehouse.write([change['doc'] for change in batch])
+
+        @param int max_size: max number of changes per batch
+        @param float max_wait: max seconds to wait to fill a batch
+        @param str since: Start from this sequence
+        @param boolean continuous: Stream results?
+        @param boolean include_docs: Include document bodies in the results
+        @param boolean hydrate: when include_docs is off, fetch the
+          documents for each batch with a single bulk request and add them
+          to the changes as 'doc'
+        @param CheckpointStore checkpoint: store to commit batch seqs to
+        """
+        if checkpoint is not None and since is None:
+            since = checkpoint.load()
+        kwargs.setdefault('heartbeat', _heartbeat_ms(max_wait))
+        changes_feed = self._changes_feed(
+            since, continuous, include_docs, **kwargs
+        )
+
+        for batch in batch_changes(changes_feed, max_size, max_wait):
+            if hydrate and not include_docs:
+                ids = set(c['id'] for c in batch if not c.get('deleted'))
+                docs = dict(
+                    (doc['_id'], doc) for doc in
+                    self.fetch_many(ids, chunk=max_size, workers=1)
+                )
+                for change in batch:
+                    change['doc'] = docs.get(change['id'])
+            yield batch
+            if checkpoint is not None and batch.last_seq is not None:
+                checkpoint.save(batch.last_seq)
+
     def __getitem__(self, key):
         """
         override [] operator access to return the
@@ -286,10 +377,7 @@ class CouchDatabase(dict):
         """
         if key in self.keys():
             return super(CouchDatabase, self).__getitem__(key)
-        if key.startswith('_design/'):
-            doc = DesignDocument(self, key)
-        else:
-            doc = Document(self, key)
+        doc = self._document_instance(key)
         if doc.exists():
             doc.fetch()
             super(CouchDatabase, self).__setitem__(key, doc)
@@ -362,7 +450,131 @@ class CouchDatabase(dict):
         resp.raise_for_status()
         return resp.json()
 
-    def bulk_insert(self, docs):
+    def _document_instance(self, doc_id, data=None):
+        """
+        _document_instance_
+
+        Build the appropriate Document or DesignDocument instance
+        for the doc_id, populated with data if provided
+
+        """
+        if doc_id.startswith('_design/'):
+            doc = DesignDocument(self, doc_id)
+        else:
+            doc = Document(self, doc_id)
+        if data:
+            doc.update(data)
+        return doc
+
+    def fetch_many(self, ids, include_docs=True, chunk=100, workers=4,
+                   cache=False):
+        """
+        _fetch_many_
+
+        Retrieve the documents for a (potentially very large) list of
+        ids. The ids are POSTed to _all_docs in chunks, which are fetched
+        concurrently, and Document instances are yielded as each chunk
+        arrives, so results are not in the same order as the ids.
+        The ids are read lazily and at most one chunk of rows is buffered
+        ahead of the consumer, so a slow consumer holds back the requests.
+        Missing and deleted documents are skipped.
+
+        :param ids: iterable of document _ids to retrieve
+        :param include_docs: if True the full documents are fetched,
+          otherwise the Documents only contain _id and _rev
+        :param chunk: max number of ids to send per request
+        :param workers: number of concurrent requests to make
+        :param cache: if True, add the Documents to this database's
+          local cache as they are retrieved
+
+        """
+        def fetch(keys):
+            data = self.all_docs(keys=keys, include_docs=include_docs)
+            return data.get('rows', [])
+
+        chunks = chunked(ids, chunk)
+        rows = parallel_stream(fetch, chunks, workers, max_pending=chunk)
+        for row in rows:
+            if 'error' in row or row['value'].get('deleted'):
+                continue
+            if include_docs:
+                data = row['doc']
+            else:
+                data = {'_id': row['id'], '_rev': row['value']['rev']}
+            doc = self._document_instance(row['id'], data)
+            if cache:
+                super(CouchDatabase, self).__setitem__(row['id'], doc)
+            yield doc
+
+    def bulk_get(self, id_revs, chunk=100, workers=4, revs=False,
+                 attachments=False, stream_chunk_size=65536):
+        """
+        _bulk_get_
+
+        Retrieve specific revisions of many documents using the
+        _bulk_get endpoint. The requests are split into chunks which
+        are fetched concurrently, and each response is decoded
+        incrementally as it streams in, so only a bounded number of
+        documents are held in memory at once.
+
+        POST    /db/_bulk_get   Returns the requested document revisions
+
+        Yields the entries for each requested revision as they are parsed,
+        either {"ok": <document>} or {"error": <error details>}
+
+        :param id_revs: iterable of (doc_id, rev) pairs, rev may be None
+          to fetch the current revision
+        :param chunk: max number of documents to request per POST
+        :param workers: number of concurrent requests to make
+        :param revs: if True include the revision history of each document
+        :param attachments: if True include attachment bodies, otherwise
+          only attachment stubs are returned
+        :param stream_chunk_size: number of bytes to read from the
+          response at a time
+
+        """
+        url = posixpath.join(self.database_url, '_bulk_get')
+        params = {}
+        if revs:
+            params['revs'] = 'true'
+        if attachments:
+            params['attachments'] = 'true'
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        }
+
+        def fetch(pairs):
+            docs = []
+            for doc_id, rev in pairs:
+                entry = {'id': doc_id}
+                if rev is not None:
+                    entry['rev'] = rev
+                docs.append(entry)
+            resp = self._r_session.post(
+                url,
+                params=params,
+                data=json.dumps({'docs': docs}),
+                headers=headers,
+                stream=True
+            )
+            resp.raise_for_status()
+            try:
+                results = iter_json_array(
+                    resp.iter_content(stream_chunk_size),
+                    'results'
+                )
+                for result in results:
+                    for entry in result.get('docs', []):
+                        yield entry
+            finally:
+                resp.close()
+
+        chunks = chunked(id_revs, chunk)
+        for entry in parallel_stream(fetch, chunks, workers=workers):
+            yield entry
+
+    def bulk_insert(self, docs, new_edits=True):
         """
         _bulk_insert_
 
@@ -373,10 +585,16 @@ class CouchDatabase(dict):
         a single request
 
         :param list docs: List of documents to be created/updated
+        :param bool new_edits: if False, store the documents with the
+          revisions they already have, as replication does, rather than
+          creating new revisions. The docs should include their
+          _revisions history.
 
         """
         url = posixpath.join(self.database_url, '_bulk_docs')
         data = {'docs': docs}
+        if not new_edits:
+            data['new_edits'] = False
         headers = {'Content-Type': 'application/json'}
         resp = self._r_session.post(
             url,
@@ -386,6 +604,130 @@ class CouchDatabase(dict):
         resp.raise_for_status()
         return resp.json()
 
+    def _bulk_write(self, docs, chunk, workers):
+        """
+        _bulk_write_
+
+        Write docs through _bulk_docs in chunks of at most chunk
+        documents, with up to workers requests in flight
+
+        :returns: list of the per document results of all the chunks
+
+        """
+        results = []
+        chunks = chunked(docs, chunk)
+        for result in parallel_map(self.bulk_insert, chunks, workers):
+            results.extend(result)
+        return results
+
+    def bulk_delete(self, ids_or_docs, chunk=100, workers=4):
+        """
+        _bulk_delete_
+
+        Delete many documents using _bulk_docs. Documents can be passed
+        as _id strings or as dicts containing _id and optionally _rev.
+        Any revisions that are not provided are looked up with chunked
+        _all_docs keys requests, documents that do not exist or are already
+        deleted are skipped, then tombstones are written in chunks.
+
+        :param ids_or_docs: iterable of document _ids and/or document dicts
+        :param chunk: max number of documents per request
+        :param workers: number of concurrent requests to make
+
+        :returns: list of _bulk_docs results, one per deleted document
+
+        """
+        revs = {}
+        unresolved = []
+        for item in ids_or_docs:
+            if isinstance(item, basestring):
+                doc_id, rev = item, None
+            else:
+                doc_id, rev = item['_id'], item.get('_rev')
+            revs[doc_id] = rev
+            if rev is None:
+                unresolved.append(doc_id)
+
+        for doc in self.fetch_many(unresolved, False, chunk, workers):
+            revs[doc['_id']] = doc['_rev']
+
+        tombstones = [
+            {'_id': doc_id, '_rev': rev, '_deleted': True}
+            for doc_id, rev in revs.iteritems() if rev is not None
+        ]
+        results = self._bulk_write(tombstones, chunk, workers)
+        for result in results:
+            if result.get('ok') and dict.__contains__(self, result['id']):
+                super(CouchDatabase, self).__delitem__(result['id'])
+        return results
+
+    def bulk_update(self, ids, func, chunk=100, workers=4, max_tries=10):
+        """
+        _bulk_update_
+
+        Apply func to many documents and write them back using
+        _bulk_docs. Documents that fail to save because of a conflict
+        are re-fetched and retried, up to max_tries times, without
+        rewriting the documents that succeeded.
+
+        Example:
+
+        def add_tag(doc):
+            doc.setdefault('tags', []).append('archived')
+
+        db.bulk_update(ids, add_tag)
+
+        :param ids: iterable of document _ids to update
+        :param func: callable taking a Document, it may either modify
+          the document in place or return the new document content
+        :param chunk: max number of documents per request
+        :param workers: number of concurrent requests to make
+        :param max_tries: give up on conflicting documents after this many
+          attempts
+
+        :returns: list of _bulk_docs results, one per updated document,
+          including the conflicts left over if max_tries was reached and
+          a not_found error for each id that is missing or deleted
+
+        """
+        results = []
+        remaining = list(ids)
+        tries = 0
+        while remaining:
+            tries += 1
+            docs = {}
+            for doc in self.fetch_many(remaining, True, chunk, workers):
+                doc_id, rev = doc['_id'], doc['_rev']
+                updated = func(doc)
+                if updated is not None and updated is not doc:
+                    doc.clear()
+                    doc.update(updated)
+                doc['_id'] = doc_id
+                doc['_rev'] = rev
+                docs[doc_id] = doc
+            for doc_id in remaining:
+                if doc_id not in docs:
+                    docs[doc_id] = None
+                    results.append({
+                        'id': doc_id,
+                        'error': 'not_found',
+                        'reason': 'missing'
+                    })
+
+            remaining = []
+            updated = [doc for doc in docs.itervalues() if doc is not None]
+            for result in self._bulk_write(updated, chunk, workers):
+                if result.get('error') == 'conflict' and tries < max_tries:
+                    remaining.append(result['id'])
+                    continue
+                if result.get('ok'):
+                    doc = docs[result['id']]
+                    doc['_rev'] = result['rev']
+                    if dict.__contains__(self, doc['_id']):
+                        super(CouchDatabase, self).__setitem__(doc['_id'], doc)
+                results.append(result)
+        return results
+
     def db_updates(self, since=None, continuous=True, include_docs=False):
         """
         _db_updates_
@@ -573,6 +915,90 @@ class CloudantDatabase(CouchDatabase):
 
         return resp.json()
 
+    def _post_revisions_map(self, endpoint, revisions_map, max_bytes,
+                            workers):
+        """
+        _post_revisions_map_
+
+        POST a {doc_id: [revs]} map to one of the revision comparison
+        endpoints, split into chunks of at most max_bytes of JSON
+        which are sent concurrently.
+
+        :returns: generator of the JSON responses for each chunk
+
+        """
+        url = posixpath.join(self.database_url, endpoint)
+
+        def post(items):
+            resp = self._r_session.post(
+                url,
+                headers={'Content-Type': 'application/json'},
+                data=json.dumps(dict(items))
+            )
+            resp.raise_for_status()
+            return resp.json()
+
+        chunks = size_bounded_chunks(
+            ((doc_id, list(revs)) for doc_id, revs in
+             revisions_map.iteritems()),
+            max_bytes=max_bytes,
+            sizer=lambda x: len(json.dumps({x[0]: x[1]}))
+        )
+        return parallel_map(post, chunks, workers, ordered=False)
+
+    def batch_missing_revisions(self, revisions_map, max_bytes=1048576,
+                                workers=4):
+        """
+        _batch_missing_revisions_
+
+        Given a map of document ids to lists of revisions, returns the
+          revisions that do not exist in the database, for any number of
+          documents. The map is sent in chunks bounded by max_bytes of JSON,
+          which are posted concurrently and the results merged.
+
+        :param revisions_map: dict of {doc_id: [revs]} to check
+        :param max_bytes: approx max size of each request body
+        :param workers: number of concurrent requests to make
+
+        :returns: dict of {doc_id: [missing revs]} for documents with
+          missing revisions
+
+        """
+        missed_revs = {}
+        responses = self._post_revisions_map(
+            '_missing_revs', revisions_map, max_bytes, workers
+        )
+        for resp_json in responses:
+            missed_revs.update(resp_json.get('missed_revs', {}))
+        return missed_revs
+
+    def batch_revisions_diff(self, revisions_map, max_bytes=1048576,
+                             workers=4):
+        """
+        _batch_revisions_diff_
+
+        Given a map of document ids to lists of revisions, returns the
+          differences between those revisions and the ones in the database,
+          for any number of documents. The map is sent in chunks bounded by
+          max_bytes of JSON, which are posted concurrently and the
+          results merged.
+
+        :param revisions_map: dict of {doc_id: [revs]} to check
+        :param max_bytes: approx max size of each request body
+        :param workers: number of concurrent requests to make
+
+        :returns: dict of {doc_id: {"missing": [...],
+          "possible_ancestors": [...]}} as returned by _revs_diff
+
+        """
+        diff = {}
+        responses = self._post_revisions_map(
+            '_revs_diff', revisions_map, max_bytes, workers
+        )
+        for resp_json in responses:
+            diff.update(resp_json)
+        return diff
+
     def get_revision_limit(self):
         """
         _get_revision_limit_
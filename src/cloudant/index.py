@@ -9,27 +9,33 @@ and views
 import json
 import types
 
-from collections import Sequence
+from collections import Sequence, OrderedDict
+from .batch import parallel_map, size_bounded_chunks
 from .errors import CloudantArgumentError
 
 
+# keys can be any JSON value
+JSON_TYPES = (int, long, float, basestring, Sequence, dict, types.NoneType)
+
 ARG_TYPES = {
     "descending": bool,
-    "endkey": (basestring, Sequence),
+    "endkey": JSON_TYPES,
     "endkey_docid": basestring,
     "group": bool,
-    "group_level": basestring,
+    "group_level": int,
     "include_docs": bool,
     "inclusive_end": bool,
-    "key": (int, basestring, Sequence),
+    "key": JSON_TYPES,
     "limit": (int, types.NoneType),
     "reduce": bool,
     "skip": (int, types.NoneType),
     "stale": basestring,
-    "startkey": (basestring, Sequence),
+    "startkey": JSON_TYPES,
     "startkey_docid": basestring,
 }
 
+KEY_ARGS = ("key", "startkey", "endkey")
+
 TYPE_CONVERTERS = {
     basestring: lambda x: json.dumps(x),
     str: lambda x: json.dumps(x),
@@ -70,8 +76,11 @@ def python_to_couch(options):
                 ).format(v)
                 raise CloudantArgumentError(msg)
         try:
-            if v is None:
-                result[k] = None
+            if k in KEY_ARGS:
+                result[k] = json_key(v)
+            elif v is None or k == 'stale':
+                # stale is a plain query parameter, not a JSON value
+                result[k] = v
             else:
                 result[k] = arg_converter(v)
         except Exception as ex:
@@ -81,11 +90,30 @@ def python_to_couch(options):
     return result
 
 
+def json_key(key):
+    """
+    helper to JSON encode a view key for use as a query parameter,
+    where null, numbers and objects are all valid keys
+    """
+    if isinstance(key, Sequence) and \
+            not isinstance(key, (basestring, list, tuple)):
+        key = list(key)
+    return json.dumps(key)
+
+
 def type_or_none(typerefs, value):
     """helper to check that value is of the types passed or None"""
     return isinstance(value, typerefs) or value is None
 
 
+def key_id(key):
+    """
+    helper to turn a (possibly compound) key into a hashable
+    value that compares equal for equal JSON keys
+    """
+    return json.dumps(key, sort_keys=True)
+
+
 class Index(object):
     """
     _Index_
@@ -139,6 +167,11 @@ class Index(object):
     for i in index:
         print i
 
+    Multiple keys:
+
+    # get the records for each key, in (key, rows) pairs
+    index.get_many(["2013", "2014", ["2015", "01"]])
+
     """
     def __init__(self, method_ref, **options):
         self.options = options
@@ -212,6 +245,44 @@ class Index(object):
         ).format(key)
         raise CloudantArgumentError(msg)
 
+    def get_many(self, keys, chunk_size=100, workers=4, max_bytes=65536):
+        """
+        _get_many_
+
+        Retrieve the records matching each of the keys provided.
+        The keys are POSTed to the index in chunks of at most chunk_size
+        keys and about max_bytes of JSON, with up to workers chunks in
+        flight at the same time. Duplicate keys are only queried once.
+
+        :param keys: list of keys (strings, numbers or lists)
+        :param chunk_size: max number of keys to send per request
+        :param workers: number of concurrent requests to make
+        :param max_bytes: approx max size of each request body
+
+        :returns: list of (key, rows) tuples in the same order as keys
+
+        """
+        keys = list(keys)
+        unique_keys = OrderedDict()
+        for key in keys:
+            unique_keys.setdefault(key_id(key), key)
+
+        def fetch(chunk):
+            data = self._ref(keys=chunk, **self.options)
+            return data.get('rows', [])
+
+        grouped = dict((k, []) for k in unique_keys)
+        chunks = size_bounded_chunks(
+            unique_keys.values(),
+            max_items=chunk_size,
+            max_bytes=max_bytes
+        )
+        for rows in parallel_map(fetch, chunks, workers=workers):
+            for row in rows:
+                grouped.setdefault(key_id(row.get('key')), []).append(row)
+
+        return [(key, grouped[key_id(key)]) for key in keys]
+
     def __iter__(self):
         """
         Iteration Support for large views
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+_multifeed_
+
+Follow the changes of many databases in an account without holding
+a continuous changes connection open for each of them
+
+"""
+import posixpath
+import Queue
+import sys
+import threading
+
+from .batch import put_unless_stopped
+from .changes import Feed
+from .checkpoint import MemoryCheckpointStore
+
+
+class MultiFeed(object):
+    """
+    _MultiFeed_
+
+    Iterator yielding (dbname, change) tuples for the changes of many
+    databases. A single continuous _db_updates feed is watched, and
+    when a database reports an update its new changes are fetched with
+    short normal _changes requests, by a bounded pool of worker threads.
+    Updates to a database that is already being fetched are coalesced
+    into a single follow up fetch.
+
+    Each database has its own checkpoint store, which is given the seq
+    of a page of changes once all the changes in that page have been
+    processed, ie when the next item is requested after the last change
+    of the page, so delivery is at-least-once.
+
+    Example:
+
+    stores = lambda dbname: SQLiteCheckpointStore(path, name=dbname)
+    for dbname, change in MultiFeed(account, checkpoint_factory=stores):
+        handle(dbname, change)
+
+    :param account: CouchDB or Cloudant account instance
+    :param dbnames: Optional list of the databases to follow, defaults to
+      every database reporting updates. Listed databases are also checked
+      for changes since their checkpoint when the feed starts
+    :param workers: number of concurrent _changes requests
+    :param limit: max number of changes to fetch per request
+    :param include_docs: Include document bodies in the changes
+    :param checkpoint_factory: callable returning the CheckpointStore for
+      a database name, defaults to in memory checkpoints
+    :param max_pending: max number of changes buffered for the consumer
+    :param heartbeat: ms between heartbeats on the _db_updates feed
+
+    """
+    def __init__(self, account, dbnames=None, workers=8, limit=1000,
+                 include_docs=False, checkpoint_factory=None,
+                 max_pending=1000, heartbeat=30000):
+        self._account = account
+        self._session = account._r_session
+        self._dbnames = set(dbnames) if dbnames is not None else None
+        self._workers = workers
+        self._limit = limit
+        self._include_docs = include_docs
+        self._checkpoint_factory = checkpoint_factory or \
+            (lambda dbname: MemoryCheckpointStore())
+        self._heartbeat = heartbeat
+        self._checkpoints = {}
+        self._seqs = {}
+        self._lock = threading.Lock()
+        self._scheduled = set()
+        self._dirty = set()
+        self._tasks = Queue.Queue()
+        self._output = Queue.Queue(max_pending)
+        self._stop = threading.Event()
+        self._started = False
+        self._worker_threads = []
+
+    def _checkpoint(self, dbname):
+        """get the checkpoint store for dbname"""
+        with self._lock:
+            if dbname not in self._checkpoints:
+                store = self._checkpoint_factory(dbname)
+                self._checkpoints[dbname] = store
+                self._seqs[dbname] = store.load()
+            return self._checkpoints[dbname]
+
+    def schedule(self, dbname):
+        """
+        _schedule_
+
+        Queue a fetch of the new changes for dbname, unless one is
+        already queued or running, in which case another fetch is done
+        as soon as it finishes
+
+        """
+        with self._lock:
+            if dbname in self._scheduled:
+                self._dirty.add(dbname)
+                return
+            self._scheduled.add(dbname)
+        self._tasks.put(dbname)
+
+    def _put(self, item):
+        """put item on the output queue, giving up if stopped"""
+        return put_unless_stopped(self._output, item, self._stop)
+
+    def _database_url(self, dbname):
+        """URL of the database named dbname"""
+        db = self._account._DATABASE_CLASS(self._account, dbname)
+        return db.database_url
+
+    def _fetch_changes(self, dbname):
+        """
+        fetch pages of changes for dbname since its last seq and pass
+        them to the consumer, until a short page shows we are caught up
+        """
+        self._checkpoint(dbname)
+        feed = Feed(
+            self._session,
+            posixpath.join(self._database_url(dbname), '_changes'),
+            include_docs=self._include_docs,
+            since=self._seqs[dbname],
+            feed='normal',
+            limit=self._limit
+        )
+        while not self._stop.is_set():
+            page = feed.next_page()
+            for change in page:
+                if not self._put(('change', dbname, change)):
+                    return
+            if page.last_seq is not None:
+                self._seqs[dbname] = page.last_seq
+                self._put(('checkpoint', dbname, page.last_seq))
+            if len(page) < self._limit:
+                return
+
+    def _worker(self):
+        """fetch changes for scheduled databases until stopped"""
+        while not self._stop.is_set():
+            try:
+                dbname = self._tasks.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            try:
+                self._fetch_changes(dbname)
+            except Exception:
+                self._put(('error', None, sys.exc_info()))
+            with self._lock:
+                if dbname in self._dirty:
+                    self._dirty.discard(dbname)
+                    requeue = True
+                else:
+                    self._scheduled.discard(dbname)
+                    requeue = False
+            if requeue:
+                self._tasks.put(dbname)
+
+    def _updates_feed(self):
+        """the _db_updates feed for the account"""
+        return Feed(
+            self._session,
+            posixpath.join(self._account._cloudant_url, '_db_updates'),
+            since='now',
+            continuous=True,
+            heartbeat=self._heartbeat
+        )
+
+    def _watch_updates(self):
+        """schedule fetches for the databases reported as updated"""
+        try:
+            for update in self._updates_feed():
+                if self._stop.is_set():
+                    break
+                dbname = update.get('db_name', update.get('dbname'))
+                if dbname is None:
+                    continue
+                if update.get('type') not in ('created', 'updated'):
+                    continue
+                if self._dbnames is not None and dbname not in self._dbnames:
+                    continue
+                self.schedule(dbname)
+        except Exception:
+            self._put(('error', None, sys.exc_info()))
+
+    def start(self):
+        """
+        _start_
+
+        Start the _db_updates watcher and the worker threads, and
+        schedule a catch up fetch for each of the listed databases
+
+        """
+        self._started = True
+        self._worker_threads = [
+            threading.Thread(target=self._worker)
+            for _ in range(self._workers)
+        ]
+        threads = [threading.Thread(target=self._watch_updates)]
+        threads.extend(self._worker_threads)
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for dbname in sorted(self._dbnames or []):
+            self.schedule(dbname)
+
+    def stop(self):
+        """
+        _stop_
+
+        Stop watching for updates and fetching changes
+
+        """
+        self._stop.set()
+
+    def __iter__(self):
+        """
+        yield (dbname, change) tuples until stopped
+        """
+        if not self._started:
+            self.start()
+        try:
+            while not self._stop.is_set():
+                try:
+                    kind, dbname, value = self._output.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                if kind == 'change':
+                    yield dbname, value
+                elif kind == 'checkpoint':
+                    self._checkpoint(dbname).save(value)
+                else:
+                    raise value[0], value[1], value[2]
+        finally:
+            self.stop()
+            for thread in self._worker_threads:
+                thread.join()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+_processor_
+
+Parallel processing of changes feeds, partitioned by document
+so that the changes to any one document are handled in order
+
+"""
+import collections
+import multiprocessing
+import Queue
+import sys
+import threading
+import zlib
+
+from .batch import put_unless_stopped
+from .errors import CloudantException
+
+
+def _worker_loop(handler, work_queue, ack_queue):
+    """
+    _worker_loop_
+
+    Pull (index, change) tuples from the work queue and pass the
+    change to the handler, reporting (index, error) on the ack queue,
+    until the None sentinel is seen. Once a change has failed, the
+    later changes in the queue are dropped without being handled, so
+    the changes to a document are never applied out of order.
+
+    """
+    failed = False
+    while True:
+        item = work_queue.get()
+        if item is None:
+            break
+        if failed:
+            continue
+        index, change = item
+        try:
+            handler(change)
+        except Exception as ex:
+            failed = True
+            ack_queue.put((index, "{0}: {1}".format(type(ex).__name__, ex)))
+        else:
+            ack_queue.put((index, None))
+
+
+class SeqTracker(object):
+    """
+    _SeqTracker_
+
+    Track the changes that have been dispatched to workers, in feed
+    order, and work out the highest seq that can safely be checkpointed,
+    ie the seq of the last change for which it and every earlier change
+    have been acknowledged.
+
+    """
+    def __init__(self):
+        self._in_flight = collections.deque()
+        self._acked = set()
+        self._lock = threading.Lock()
+        self.safe_seq = None
+
+    def dispatch(self, index, seq):
+        """record that change number index with seq was dispatched"""
+        with self._lock:
+            self._in_flight.append((index, seq))
+
+    def ack(self, index):
+        """
+        record that change number index was processed
+
+        :returns: True if safe_seq advanced
+
+        """
+        advanced = False
+        with self._lock:
+            self._acked.add(index)
+            while self._in_flight and self._in_flight[0][0] in self._acked:
+                done, seq = self._in_flight.popleft()
+                self._acked.discard(done)
+                if seq is not None:
+                    self.safe_seq = seq
+                    advanced = True
+        return advanced
+
+    def pending(self):
+        """number of dispatched changes not yet safe to checkpoint"""
+        with self._lock:
+            return len(self._in_flight)
+
+
+class ChangesProcessor(object):
+    """
+    _ChangesProcessor_
+
+    Consume a changes feed with a pool of workers. Each change is
+    routed to a worker by a hash of its document id, so different
+    documents are processed in parallel while the changes to a single
+    document are processed in feed order. Each worker has a bounded
+    queue, so a slow worker applies backpressure to the feed.
+
+    If a checkpoint store is provided, the processor commits the seq
+    of the latest change for which every earlier change has also been
+    processed, so restarting from the checkpoint never skips a change.
+    If the handler raises, dispatching stops, the changes queued behind
+    the failed one for the same worker are dropped, the checkpoint is not
+    advanced past the failed change and run raises a CloudantException.
+    The feed is read in a separate thread, so stop and handler errors
+    take effect even while the feed is waiting for changes.
+
+    Example:
+
+    store = FileCheckpointStore(path)
+    feed = db.changes(since=store.load())
+    processor = ChangesProcessor(feed, handle_change, workers=8,
+                                 checkpoint=store)
+    processor.run()
+
+    The feed itself should not be given the checkpoint store, since it
+    would commit changes as soon as they are dispatched.
+
+    :param feed: iterable of changes, eg a Feed or database.changes()
+    :param handler: callable invoked with each change, must be
+      picklable if use_processes is True
+    :param workers: number of workers/partitions
+    :param queue_size: max number of changes queued per worker
+    :param checkpoint: optional CheckpointStore to commit seqs to
+    :param checkpoint_every: commit after this many processed changes
+    :param use_processes: use worker processes instead of threads
+
+    """
+    def __init__(self, feed, handler, workers=4, queue_size=100,
+                 checkpoint=None, checkpoint_every=100, use_processes=False):
+        self._feed = feed
+        self._handler = handler
+        self._workers = workers
+        self._queue_size = queue_size
+        self._checkpoint = checkpoint
+        self._checkpoint_every = checkpoint_every
+        self._use_processes = use_processes
+        self._tracker = SeqTracker()
+        self._stop = threading.Event()
+        self._errors = []
+        self.dispatched = 0
+        self.processed = 0
+        self.committed_seq = None
+
+    def partition(self, change):
+        """
+        _partition_
+
+        :returns: the index of the worker that handles change
+
+        """
+        doc_id = change['id']
+        if isinstance(doc_id, unicode):
+            doc_id = doc_id.encode('utf-8')
+        return (zlib.crc32(doc_id) & 0xffffffff) % self._workers
+
+    def stop(self):
+        """
+        _stop_
+
+        Stop dispatching changes, run returns once the changes already
+        queued have been processed
+
+        """
+        self._stop.set()
+
+    def commit(self):
+        """
+        _commit_
+
+        Save the highest safely processed seq to the checkpoint store
+
+        """
+        seq = self._tracker.safe_seq
+        if self._checkpoint is not None and seq is not None and \
+                seq != self.committed_seq:
+            self._checkpoint.save(seq)
+        self.committed_seq = seq
+
+    def _start_workers(self):
+        """create the work queues, ack queue and workers"""
+        if self._use_processes:
+            queue_cls = multiprocessing.Queue
+            worker_cls = multiprocessing.Process
+        else:
+            queue_cls = Queue.Queue
+            worker_cls = threading.Thread
+        work_queues = [
+            queue_cls(self._queue_size) for _ in range(self._workers)
+        ]
+        ack_queue = queue_cls()
+        workers = []
+        for work_queue in work_queues:
+            worker = worker_cls(
+                target=_worker_loop,
+                args=(self._handler, work_queue, ack_queue)
+            )
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        return work_queues, ack_queue, workers
+
+    def _collect(self, ack_queue):
+        """
+        process acknowledgements from the workers until the None
+        sentinel is seen, committing checkpoints as we go
+        """
+        since_commit = 0
+        while True:
+            item = ack_queue.get()
+            if item is None:
+                break
+            index, error = item
+            if error is not None:
+                self._errors.append(error)
+                self._stop.set()
+                continue
+            self.processed += 1
+            since_commit += 1
+            self._tracker.ack(index)
+            if since_commit >= self._checkpoint_every:
+                self.commit()
+                since_commit = 0
+        self.commit()
+
+    def _put(self, queue, item):
+        """put item on queue, giving up if the processor has stopped"""
+        return put_unless_stopped(queue, item, self._stop)
+
+    def _read_feed(self, changes):
+        """
+        read the feed onto the changes queue, followed by a done
+        message, in a separate thread so that run never waits on a
+        quiet feed to notice that it has been stopped
+        """
+        try:
+            for change in self._feed:
+                if change.get('id') is None:
+                    continue
+                if not self._put(changes, ('change', change)):
+                    return
+            self._put(changes, ('done', None))
+        except Exception:
+            self._put(changes, ('error', sys.exc_info()))
+
+    def run(self):
+        """
+        _run_
+
+        Consume the feed until it ends or stop is called, dispatching
+        the changes to the workers, then wait for the workers to finish.
+
+        """
+        work_queues, ack_queue, workers = self._start_workers()
+        collector = threading.Thread(target=self._collect, args=(ack_queue,))
+        collector.daemon = True
+        collector.start()
+        changes = Queue.Queue(self._queue_size)
+        reader = threading.Thread(target=self._read_feed, args=(changes,))
+        reader.daemon = True
+        reader.start()
+        feed_error = None
+        try:
+            while not self._stop.is_set():
+                try:
+                    kind, change = changes.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                if kind == 'done':
+                    break
+                if kind == 'error':
+                    feed_error = change
+                    break
+                index = self.dispatched
+                self.dispatched += 1
+                self._tracker.dispatch(index, change.get('seq'))
+                work_queue = work_queues[self.partition(change)]
+                if not self._put(work_queue, (index, change)):
+                    break
+        finally:
+            self._stop.set()
+            for work_queue in work_queues:
+                work_queue.put(None)
+            for worker in workers:
+                worker.join()
+            ack_queue.put(None)
+            collector.join()
+
+        if feed_error is not None:
+            raise feed_error[0], feed_error[1], feed_error[2]
+        if self._errors:
+            raise CloudantException(
+                "Error processing changes, stopped at seq {0}: {1}".format(
+                    self.committed_seq, self._errors[0]
+                )
+            )
+        return self.committed_seq
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+"""
+_replication_
+
+Client side replication between databases, for when the server side
+_replicator can't be used, eg between accounts that can't reach
+each other
+
+"""
+import hashlib
+import Queue
+import sys
+import threading
+import time
+
+from .batch import put_unless_stopped
+from .checkpoint import LocalDocumentCheckpointStore
+from .errors import CloudantException
+from .processor import SeqTracker
+
+
+class ClientReplication(object):
+    """
+    _ClientReplication_
+
+    Replicate the documents of a source database into a target database
+    using the replication protocol from the client:
+
+    1. read batches of changes from the source _changes feed
+    2. ask the target which of the changed revisions it is missing
+       with _revs_diff
+    3. fetch the missing revisions, with their history, from the source
+       with _bulk_get
+    4. write them to the target with _bulk_docs and new_edits=false,
+       keeping the original revisions
+
+    The stages run concurrently, connected by bounded queues, with
+    workers threads for each of the diff and fetch/write stages. If any
+    stage fails, all of them give up straight away and run raises.
+    The seq of the latest batch for which every earlier batch has been
+    written is checkpointed, by default to a _local document in the
+    target, and the replication resumes from the checkpoint.
+
+    Example:
+
+    stats = ClientReplication(source_db, target_db, workers=8).run()
+    print stats['docs_per_sec']
+
+    :param source_db: database to replicate from
+    :param target_db: CloudantDatabase to replicate to
+    :param batch_size: max number of changes per batch
+    :param workers: number of threads per stage
+    :param queue_size: max number of batches queued between stages
+    :param continuous: if True keep replicating new changes until stop
+      is called, otherwise stop once the source has been caught up with
+    :param since: seq to start from, defaults to the checkpoint
+    :param checkpoint: CheckpointStore to use, defaults to a _local
+      document in the target database
+    :param checkpoint_id: id of the default _local checkpoint document,
+      derived from the source and target URLs if not given
+    :param attachments: if True replicate attachment bodies
+    :param progress: optional callable passed the stats dict after
+      each batch is written
+
+    """
+    def __init__(self, source_db, target_db, batch_size=500, workers=4,
+                 queue_size=4, continuous=False, since=None,
+                 checkpoint=None, checkpoint_id=None, attachments=True,
+                 progress=None):
+        self._source_db = source_db
+        self._target_db = target_db
+        self._batch_size = batch_size
+        self._workers = workers
+        self._queue_size = queue_size
+        self._continuous = continuous
+        self._since = since
+        if checkpoint is None:
+            if checkpoint_id is None:
+                checkpoint_id = self.default_checkpoint_id(
+                    source_db, target_db
+                )
+            checkpoint = LocalDocumentCheckpointStore(
+                target_db, checkpoint_id
+            )
+        self._checkpoint = checkpoint
+        self._attachments = attachments
+        self._progress = progress
+        self._tracker = SeqTracker()
+        self._stop = threading.Event()
+        self._abort = threading.Event()
+        self._started = None
+        self.changes = 0
+        self.missing_revs = 0
+        self.docs_written = 0
+        self.write_errors = 0
+        self.checkpoint_seq = None
+
+    @staticmethod
+    def default_checkpoint_id(source_db, target_db):
+        """
+        _default_checkpoint_id_
+
+        :returns: an id for the _local checkpoint document that is
+          unique to the source and target
+        """
+        key = u'{0} {1}'.format(
+            source_db.database_url,
+            target_db.database_url
+        ).encode('utf-8')
+        return 'cloudant-replication-{0}'.format(hashlib.md5(key).hexdigest())
+
+    def stop(self):
+        """
+        _stop_
+
+        Stop reading changes, run returns once the batches in flight
+        have been written
+
+        """
+        self._stop.set()
+
+    def stats(self):
+        """
+        _stats_
+
+        :returns: dict of the counts of changes read, revisions found
+          missing, documents written and write errors, the checkpointed
+          seq and the write throughput
+
+        """
+        elapsed = 0.0
+        if self._started is not None:
+            elapsed = time.time() - self._started
+        return {
+            'changes': self.changes,
+            'missing_revs': self.missing_revs,
+            'docs_written': self.docs_written,
+            'write_errors': self.write_errors,
+            'checkpoint_seq': self.checkpoint_seq,
+            'elapsed': elapsed,
+            'docs_per_sec': self.docs_written / elapsed if elapsed else 0.0,
+        }
+
+    def _get(self, queue):
+        """
+        get the next item from queue, or None if the replication has
+        been aborted
+        """
+        while not self._abort.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+        return None
+
+    def _fail(self, results):
+        """
+        report the current exception and abort the replication, so
+        that every stage gives up instead of waiting on the others
+        """
+        self._stop.set()
+        self._abort.set()
+        results.put(('error', sys.exc_info()))
+
+    def _read_changes(self, batches, results):
+        """
+        read pages of changes from the source onto the batches queue,
+        followed by a None sentinel per diff worker
+        """
+        try:
+            feed = self._source_db._changes_feed(
+                self._since,
+                self._continuous,
+                False,
+                feed='longpoll' if self._continuous else 'normal',
+                limit=self._batch_size,
+                style='all_docs'
+            )
+            index = 0
+            while not self._stop.is_set():
+                page = feed.next_page()
+                if page:
+                    self._tracker.dispatch(index, page.last_seq)
+                    if not put_unless_stopped(
+                            batches, (index, page), self._stop):
+                        break
+                    index += 1
+                if not self._continuous and len(page) < self._batch_size:
+                    break
+        except Exception:
+            self._fail(results)
+        finally:
+            for _ in range(self._workers):
+                put_unless_stopped(batches, None, self._abort)
+
+    def _diff(self, batches, missing, results):
+        """
+        find the revisions of each batch that the target is missing,
+        passing them on to the write stage
+        """
+        try:
+            while True:
+                item = self._get(batches)
+                if item is None:
+                    break
+                index, page = item
+                revisions_map = {}
+                for change in page:
+                    revs = revisions_map.setdefault(change['id'], [])
+                    revs.extend(c['rev'] for c in change.get('changes', []))
+                diff = self._target_db.batch_revisions_diff(
+                    revisions_map, workers=1
+                )
+                id_revs = [
+                    (doc_id, rev)
+                    for doc_id, info in diff.iteritems()
+                    for rev in info.get('missing', [])
+                ]
+                counts = {'changes': len(page), 'missing': len(id_revs)}
+                if not put_unless_stopped(
+                        missing, (index, id_revs, counts), self._abort):
+                    break
+        except Exception:
+            self._fail(results)
+        finally:
+            put_unless_stopped(missing, None, self._abort)
+
+    def _write(self, missing, results):
+        """
+        fetch the missing revisions from the source and write them to
+        the target, reporting each batch on the results queue
+        """
+        try:
+            while True:
+                item = self._get(missing)
+                if item is None:
+                    break
+                index, id_revs, counts = item
+                docs = []
+                errors = 0
+                if id_revs:
+                    entries = self._source_db.bulk_get(
+                        id_revs,
+                        chunk=len(id_revs),
+                        workers=1,
+                        revs=True,
+                        attachments=self._attachments
+                    )
+                    for entry in entries:
+                        if 'ok' in entry:
+                            docs.append(entry['ok'])
+                        else:
+                            errors += 1
+                failed = 0
+                if docs:
+                    written = self._target_db.bulk_insert(
+                        docs, new_edits=False
+                    )
+                    failed = len([r for r in written if 'error' in r])
+                counts['written'] = len(docs) - failed
+                counts['errors'] = errors + failed
+                results.put(('batch', (index, counts)))
+        except Exception:
+            self._fail(results)
+        finally:
+            results.put(('done', None))
+
+    def _record(self, index, counts):
+        """update the stats and checkpoint for a written batch"""
+        self.changes += counts['changes']
+        self.missing_revs += counts['missing']
+        self.docs_written += counts['written']
+        self.write_errors += counts['errors']
+        if self._tracker.ack(index):
+            seq = self._tracker.safe_seq
+            self._checkpoint.save(seq)
+            self.checkpoint_seq = seq
+        if self._progress is not None:
+            self._progress(self.stats())
+
+    def run(self):
+        """
+        _run_
+
+        Run the replication until the source has been caught up with,
+        or until stop is called for a continuous replication.
+
+        :returns: the stats dict
+
+        """
+        self._started = time.time()
+        if self._since is None:
+            self._since = self._checkpoint.load()
+        self.checkpoint_seq = self._since
+        batches = Queue.Queue(self._queue_size)
+        missing = Queue.Queue(self._queue_size)
+        results = Queue.Queue()
+        threads = [
+            threading.Thread(
+                target=self._read_changes, args=(batches, results)
+            )
+        ]
+        for _ in range(self._workers):
+            threads.append(threading.Thread(
+                target=self._diff, args=(batches, missing, results)
+            ))
+            threads.append(threading.Thread(
+                target=self._write, args=(missing, results)
+            ))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        error = None
+        running = self._workers
+        try:
+            while running:
+                kind, value = results.get()
+                if kind == 'batch':
+                    self._record(*value)
+                elif kind == 'error':
+                    if error is None:
+                        error = value
+                else:
+                    running -= 1
+        except Exception:
+            self._stop.set()
+            self._abort.set()
+            raise
+        for thread in threads:
+            thread.join()
+        if error is not None:
+            raise CloudantException(
+                "Replication failed after seq {0}: {1}: {2}".format(
+                    self.checkpoint_seq, error[0].__name__, error[1]
+                )
+            )
+        return self.stats()
+
+
+def replicate(source_db, target_db, **kwargs):
+    """
+    _replicate_
+
+    Replicate source_db into target_db from the client, without using
+    the _replicator database, see ClientReplication for the options.
+
+    Example:
+
+    with cloudant(user, passwd) as account:
+        stats = replicate(account['source'], other_account['target'])
+
+    :returns: dict of stats about the replication
+
+    """
+    return ClientReplication(source_db, target_db, **kwargs).run()
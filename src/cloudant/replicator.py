@@ -5,11 +5,47 @@ Implement a friendly wrapper around a Cloudant _replicator database.
 
 """
 
+import collections
+import heapq
+import time
+import urlparse
 import uuid
 
 from .database import CloudantDatabase
 from .errors import CloudantException
 
+
+def _endpoint_url(endpoint):
+    """
+    the URL of a replication source or target, which may be given as
+    a URL string or a dict containing a url, without any credentials
+    """
+    if isinstance(endpoint, dict):
+        endpoint = endpoint.get('url')
+    if not isinstance(endpoint, basestring):
+        return None
+    parts = urlparse.urlsplit(endpoint)
+    if not parts.netloc or '@' not in parts.netloc:
+        return endpoint
+    netloc = parts.netloc.rsplit('@', 1)[1]
+    return urlparse.urlunsplit(parts._replace(netloc=netloc))
+
+
+def _replication_summary(doc):
+    """
+    a summary of a replication document, without the credentials or
+    other bulky fields
+    """
+    return {
+        'id': doc.get('_id'),
+        'state': doc.get('_replication_state'),
+        'state_time': doc.get('_replication_state_time'),
+        'reason': doc.get('_replication_state_reason'),
+        'continuous': doc.get('continuous', False),
+        'source': _endpoint_url(doc.get('source')),
+        'target': _endpoint_url(doc.get('target')),
+    }
+
 class ReplicatorDatabase(CloudantDatabase):
     """
     CloudantDatabase object with a fixed name and some additional
@@ -52,6 +88,28 @@ class ReplicatorDatabase(CloudantDatabase):
 
         """
 
+        data = self._replication_doc(
+            lambda db: db.creds['basic_auth'],
+            lambda: self.creds['user_ctx'],
+            source_db,
+            target_db,
+            repl_id,
+            **kwargs
+        )
+        return self.create_document(data, throw_on_exists=True)
+
+    def _replication_doc(self, auth, user_ctx, source_db=None,
+                         target_db=None, repl_id=None, **kwargs):
+        """
+        _replication_doc_
+
+        Compose a replication document, see create_replication.
+
+        @param callable auth: returns the Authorization header value
+            for a Database object
+        @param callable user_ctx: returns the user_ctx to act as
+
+        """
         data = dict(
             _id=repl_id if repl_id else unicode(uuid.uuid4()),
             **kwargs
@@ -66,7 +124,7 @@ class ReplicatorDatabase(CloudantDatabase):
             data['source'] = {
                 "url": source_db.database_url,
                 "headers": {
-                    "Authorization": source_db.creds['basic_auth']
+                    "Authorization": auth(source_db)
                 }
             }
 
@@ -79,14 +137,57 @@ class ReplicatorDatabase(CloudantDatabase):
             data['target'] = {
                 "url": target_db.database_url,
                 "headers": {
-                    "Authorization": target_db.creds['basic_auth']
+                    "Authorization": auth(target_db)
                 }
             }
 
         if not data.get('user_ctx'):
-            data['user_ctx'] = self.creds['user_ctx']
+            data['user_ctx'] = user_ctx()
 
-        return self.create_document(data, throw_on_exists=True)
+        return data
+
+    def create_replications(self, specs, chunk=100, workers=4):
+        """
+        _create_replications_
+
+        Create many replications with chunked _bulk_docs requests.
+        The basic auth string is composed once per account, and the
+        user_ctx is looked up with a single _session request, rather
+        than once per database for every replication.
+
+        Example:
+
+        repl_db.create_replications([
+            {'source_db': src, 'target_db': tgt, 'repl_id': 'tenant1'},
+            {'source': 'https://...', 'target_db': tgt, 'continuous': True},
+        ])
+
+        @param list specs: dicts of the arguments to create_replication
+            for each replication
+        @param int chunk: max number of documents per request
+        @param int workers: number of concurrent requests to make
+
+        :returns: list of the _bulk_docs results, one per replication
+
+        """
+        auth_strs = {}
+        user_ctxs = []
+
+        def auth(db):
+            account = db._cloudant_account
+            if id(account) not in auth_strs:
+                auth_strs[id(account)] = account.basic_auth_str()
+            return auth_strs[id(account)]
+
+        def user_ctx():
+            if not user_ctxs:
+                user_ctxs.append(self._cloudant_account.session()['userCtx'])
+            return user_ctxs[0]
+
+        docs = [
+            self._replication_doc(auth, user_ctx, **spec) for spec in specs
+        ]
+        return self._bulk_write(docs, chunk, workers)
 
     def list_replications(self):
         """
@@ -95,8 +196,51 @@ class ReplicatorDatabase(CloudantDatabase):
         Returns a list of all replications.
 
         """
-        docs = self.all_docs(include_docs="true")['rows']
-        return [doc['doc'] for doc in docs]
+        return list(self.iter_replications(summary=False))
+
+    def iter_replications(self, state=None, page_size=100, summary=True):
+        """
+        _iter_replications_
+
+        Generator over the replications, reading the _replicator
+        database a page at a time using the last id of each page as
+        the start key of the next, so memory use is bounded by page_size
+        however many replications there are. Design documents are
+        skipped.
+
+        By default lightweight summaries are yielded rather than the
+        full documents, containing the id, state, state time and reason,
+        whether the replication is continuous and the source and target
+        URLs without any credentials.
+
+        Example:
+
+        for repl in repl_db.iter_replications(state='error'):
+            print repl['id'], repl['reason']
+
+        @param str state: only include replications in this
+            _replication_state, eg triggered, completed or error
+        @param int page_size: number of documents to read per request
+        @param boolean summary: if False yield the full documents
+
+        """
+        startkey = None
+        while True:
+            options = {'include_docs': True, 'limit': page_size + 1}
+            if startkey is not None:
+                options['startkey'] = startkey
+            rows = self.all_docs(**options).get('rows', [])
+            for row in rows[:page_size]:
+                doc = row.get('doc')
+                if doc is None or row['id'].startswith('_design/'):
+                    continue
+                if state is not None and \
+                        doc.get('_replication_state') != state:
+                    continue
+                yield _replication_summary(doc) if summary else doc
+            if len(rows) <= page_size:
+                break
+            startkey = rows[page_size]['id']
 
     def replication_state(self, repl_id):
         """
@@ -124,37 +268,154 @@ class ReplicatorDatabase(CloudantDatabase):
 
         Block and stream status of a given replication.
 
+        The current state is read first, then only the changes to the
+        replication document made since that read are followed, using a
+        server side doc_ids filter with the documents included, so
+        neither the rest of the _replicator history nor extra document
+        fetches are needed. Stops when the replication completes, errors
+        or its document is deleted.
+
         @param str repl_id: id of the replication to follow
 
         """
-        def update_state():
-            try:
-                repl_doc = self[repl_id]
-                repl_doc.fetch()
-                state = repl_doc.get('_replication_state')
-            except KeyError:
-                repl_doc = None
-                state = None
+        terminal_states = ['error', 'completed']
+        # Note where the changes feed is before reading the state, so
+        # that no update made after the read can be missed.
+        since = self.metadata().get('update_seq')
+        try:
+            repl_doc = self[repl_id]
+            repl_doc.fetch()
+        except KeyError:
+            repl_doc = None
 
-            return repl_doc, state
+        if repl_doc is not None:
+            yield repl_doc
+            if repl_doc.get('_replication_state') in terminal_states:
+                return
 
-        while True:
-            # Make sure we fetch the state up front, just in case it moves
-            # too fast and we miss it in the changes feed.
-            repl_doc, state = update_state()
-            if repl_doc:
-                yield repl_doc
-            if state is not None and state in ['error', 'completed']:
-                raise StopIteration
-
-            # Now listen on changes feed for the state
-            for change in self.changes():
-                if change.get('id') == repl_id:
-                    repl_doc, state = update_state()
-                    if repl_doc is not None:
-                        yield repl_doc
-                    if state is not None and state in ['error', 'completed']:
-                        raise StopIteration
+        changes = self.changes(
+            since=since,
+            doc_ids=[repl_id],
+            include_docs=True
+        )
+        for change in changes:
+            if change.get('id') != repl_id:
+                continue
+            if change.get('deleted'):
+                return
+            if change.get('doc') is None:
+                continue
+            if repl_doc is None:
+                repl_doc = self._document_instance(repl_id)
+                super(ReplicatorDatabase, self).__setitem__(repl_id, repl_doc)
+            repl_doc.update(change['doc'])
+            yield repl_doc
+            if repl_doc.get('_replication_state') in terminal_states:
+                return
+
+    def watch_replications(self, repl_ids, callbacks=None, chunk=100,
+                           workers=4):
+        """
+        _watch_replications_
+
+        Block and stream (repl_id, state) events for many replications
+        over a single changes connection. The current states are read
+        with bulk requests, then the changes to the replication documents
+        are followed with one doc_ids filtered feed, so the number of
+        connections stays constant however many replications are watched.
+
+        An event is produced whenever the state of a replication changes,
+        including its initial state if it has one. If the replication
+        document is deleted the state is None and it is no longer watched.
+        Watching ends once every replication has completed, errored or
+        been deleted, which never happens for continuous replications.
+
+        Example:
+
+        def on_error(repl_id, doc):
+            alert(repl_id, doc.get('_replication_state_reason'))
+
+        for repl_id, state in repl_db.watch_replications(
+                ids, callbacks={'error': on_error}):
+            print repl_id, state
+
+        @param list repl_ids: ids of the replications to watch
+        @param dict callbacks: optional mapping of state to a callable,
+            called with the replication id and document whenever a
+            replication enters that state
+        @param int chunk: max ids per request when reading the states
+        @param int workers: number of concurrent requests when reading
+            the states
+
+        """
+        terminal_states = ['error', 'completed']
+        callbacks = callbacks or {}
+        watching = set(repl_ids)
+        states = {}
+
+        def transition(repl_id, doc):
+            state = doc.get('_replication_state') if doc else None
+            if repl_id in states and states[repl_id] == state:
+                return None
+            states[repl_id] = state
+            if doc is None or state in terminal_states:
+                watching.discard(repl_id)
+            callback = callbacks.get(state)
+            if callback is not None:
+                callback(repl_id, doc)
+            return repl_id, state
+
+        # Note where the changes feed is before reading the states, so
+        # that no update made after the reads can be missed.
+        since = self.metadata().get('update_seq')
+        for doc in self.fetch_many(list(watching), chunk=chunk,
+                                   workers=workers):
+            if doc.get('_replication_state') is None:
+                states[doc['_id']] = None
+                continue
+            event = transition(doc['_id'], doc)
+            if event is not None:
+                yield event
+
+        if not watching:
+            return
+        changes = self.changes(
+            since=since,
+            doc_ids=sorted(watching),
+            include_docs=True
+        )
+        for change in changes:
+            repl_id = change.get('id')
+            if repl_id not in watching:
+                continue
+            if change.get('deleted'):
+                doc = None
+            elif change.get('doc') is None:
+                continue
+            else:
+                doc = change['doc']
+            event = transition(repl_id, doc)
+            if event is not None:
+                yield event
+            if not watching:
+                return
+
+    def stop_replications(self, repl_ids, chunk=100, workers=4):
+        """
+        _stop_replications_
+
+        Stop many replications by deleting their documents with chunked
+        _bulk_docs requests. Replications that dont exist are skipped.
+
+        @param list repl_ids: doc ids of the replications to stop
+        @param int chunk: max number of documents per request
+        @param int workers: number of concurrent requests to make
+
+        :returns: list of the _bulk_docs results, one per replication
+            stopped
+
+        """
+        return self.bulk_delete(repl_ids, chunk, workers)
 
     def stop_replication(self, repl_id):
         """ Stop a given replication.
@@ -171,3 +432,232 @@ class ReplicatorDatabase(CloudantDatabase):
 
         repl_doc.fetch()
         repl_doc.delete()
+
+
+class ReplicationScheduler(object):
+    """
+    _ReplicationScheduler_
+
+    Submit many replications to a _replicator database while keeping
+    at most max_active of them running at a time, so the cluster is not
+    overwhelmed. As replications complete or fail, queued ones are
+    submitted in their place. Failed replications are retried, after
+    waiting backoff seconds doubling with each attempt up to max_backoff,
+    by updating their document, which restarts them.
+
+    The active replications are followed with longpoll changes requests
+    filtered to their ids, so a single request is outstanding at a time.
+
+    Example:
+
+    scheduler = ReplicationScheduler(repl_db, max_active=20)
+    scheduler.add_all(specs)
+    for repl_id, state in scheduler.run():
+        print repl_id, state, scheduler.stats()
+
+    :param repl_db: ReplicatorDatabase instance
+    :param max_active: max number of replications running at once
+    :param max_retries: max number of times to retry a failed replication
+    :param backoff: initial seconds to wait before a retry
+    :param max_backoff: max seconds to wait before a retry
+    :param poll_timeout: max seconds to wait for changes per request
+    :param chunk: max number of documents per _bulk_docs request
+
+    """
+    FAILED_STATES = ('error', 'failed')
+
+    def __init__(self, repl_db, max_active=10, max_retries=3, backoff=1.0,
+                 max_backoff=300.0, poll_timeout=60.0, chunk=100):
+        self._repl_db = repl_db
+        self._max_active = max_active
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._poll_timeout = poll_timeout
+        self._chunk = chunk
+        self._queue = collections.deque()
+        self._retry_queue = []
+        self._active = {}
+        self._attempts = {}
+        self._since = None
+        self._started = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+
+    def add(self, spec):
+        """
+        _add_
+
+        Queue a replication, spec is a dict of the arguments to
+        create_replication. A repl_id is generated if it doesnt have one.
+
+        :returns: the repl_id of the replication
+
+        """
+        spec = dict(spec)
+        if not spec.get('repl_id'):
+            spec['repl_id'] = unicode(uuid.uuid4())
+        self._queue.append(spec)
+        return spec['repl_id']
+
+    def add_all(self, specs):
+        """
+        _add_all_
+
+        Queue many replications, see add
+
+        :returns: list of the repl_ids
+
+        """
+        return [self.add(spec) for spec in specs]
+
+    def stats(self):
+        """
+        _stats_
+
+        :returns: dict of the queue depth, number of active and waiting
+          replications, counts of outcomes and the completion throughput
+
+        """
+        elapsed = 0.0
+        if self._started is not None:
+            elapsed = time.time() - self._started
+        return {
+            'queued': len(self._queue),
+            'waiting_retry': len(self._retry_queue),
+            'active': len(self._active),
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'retries': self.retries,
+            'elapsed': elapsed,
+            'completed_per_sec': self.completed / elapsed if elapsed else 0.0,
+        }
+
+    def _promote_retries(self):
+        """move retries whose backoff has expired back onto the queue"""
+        now = time.time()
+        while self._retry_queue and self._retry_queue[0][0] <= now:
+            _, spec = heapq.heappop(self._retry_queue)
+            self._queue.appendleft(spec)
+
+    def _submit(self):
+        """
+        submit queued replications up to max_active
+
+        :returns: list of (repl_id, state) events for any replications
+          that could not be created
+
+        """
+        specs = []
+        while self._queue and \
+                len(self._active) + len(specs) < self._max_active:
+            specs.append(self._queue.popleft())
+        if not specs:
+            return []
+        events = []
+        by_id = dict((spec['repl_id'], spec) for spec in specs)
+        results = self._repl_db.create_replications(
+            specs, chunk=self._chunk, workers=1
+        )
+        for result in results:
+            spec = by_id[result['id']]
+            if result.get('error'):
+                self.failed += 1
+                events.append((result['id'], result['error']))
+            else:
+                self.submitted += 1
+                self._active[result['id']] = spec
+        return events
+
+    def _retry(self, repl_id, doc):
+        """
+        queue a failed replication to be resubmitted after a backoff
+
+        :returns: True if it will be retried
+
+        """
+        spec = self._active.pop(repl_id)
+        attempts = self._attempts.get(repl_id, 0)
+        if attempts >= self._max_retries:
+            return False
+        self._attempts[repl_id] = attempts + 1
+        self.retries += 1
+        spec = dict(spec, _rev=doc['_rev'])
+        delay = min(self._max_backoff, self._backoff * 2 ** attempts)
+        heapq.heappush(self._retry_queue, (time.time() + delay, spec))
+        return True
+
+    def _handle_change(self, change):
+        """
+        update the scheduler for a change to a replication document
+
+        :returns: (repl_id, state) event, or None if the state of an
+          active replication did not change
+
+        """
+        repl_id = change.get('id')
+        if repl_id not in self._active:
+            return None
+        if change.get('deleted'):
+            del self._active[repl_id]
+            return repl_id, None
+        doc = change.get('doc') or {}
+        state = doc.get('_replication_state')
+        if state == 'completed':
+            del self._active[repl_id]
+            self.completed += 1
+        elif state in self.FAILED_STATES:
+            if not self._retry(repl_id, doc):
+                self.failed += 1
+        elif state is None:
+            return None
+        return repl_id, state
+
+    def _wait_time(self):
+        """seconds to wait for changes before the next retry is due"""
+        if not self._retry_queue:
+            return self._poll_timeout
+        due = self._retry_queue[0][0] - time.time()
+        return max(0, min(self._poll_timeout, due))
+
+    def run(self):
+        """
+        _run_
+
+        Submit and follow the queued replications until they have all
+        completed or failed, yielding (repl_id, state) events as their
+        states change. The state is None if a replication document is
+        deleted, or the _bulk_docs error if it could not be created.
+
+        """
+        self._started = time.time()
+        # Note where the changes feed is before submitting anything, so
+        # that no state change can be missed.
+        self._since = self._repl_db.metadata().get('update_seq')
+        while self._queue or self._retry_queue or self._active:
+            self._promote_retries()
+            for event in self._submit():
+                yield event
+            if not self._active:
+                if self._retry_queue:
+                    time.sleep(self._wait_time())
+                continue
+            feed = self._repl_db._changes_feed(
+                self._since,
+                False,
+                True,
+                feed='longpoll',
+                limit=self._chunk,
+                doc_ids=sorted(self._active),
+                timeout=int(self._wait_time() * 1000)
+            )
+            page = feed.next_page()
+            for change in page:
+                event = self._handle_change(change)
+                if event is not None:
+                    yield event
+            if page.last_seq is not None:
+                self._since = page.last_seq
@@ -5,11 +5,18 @@ _views_
 Utilities for handling design docs and the resulting views they create
 
 """
+import collections
 import contextlib
+import json
 import posixpath
+import time
 
+from .batch import parallel_map
+from .cache import QueryCache, query_cache_key
+from .changes import _seq_number
 from .document import Document
-from .index import Index, python_to_couch
+from .errors import CloudantArgumentError, CloudantException
+from .index import Index, key_id, python_to_couch
 
 
 class Code(str):
@@ -91,6 +98,7 @@ class View(dict):
         self[self.view_name]['map'] = _codify(map_func)
         self[self.view_name]['reduce'] = _codify(reduce_func)
         self.index = Index(self)
+        self.cache = None
 
     @property
     def map(self):
@@ -129,26 +137,235 @@ class View(dict):
         as query parameters
 
         descending bool
-        endkey string or array
+        endkey any JSON value
         endkey_docid  string
         group bool
-        group_level ??
+        group_level int
         include_docs bool
         inclusive_end  bool
-        key string
+        key any JSON value
+        keys list, POSTed in the request body rather than as a param
         limit   int
         reduce  boolean
         skip    int
         stale   enum(ok, update_after)
-        startkey  string or array
+        startkey  any JSON value
         startkey_docid  string
 
         """
+        keys = kwargs.pop('keys', None)
         params = python_to_couch(kwargs)
-        resp = self._r_session.get(self.url, params=params)
+        if self.cache is None:
+            return self._query(params, keys)
+        return self.cache.get(
+            query_cache_key(params, keys),
+            lambda: self._query(params, keys),
+            self._update_seq,
+            allow_stale=kwargs.get('stale') is not None
+        )
+
+    def _query(self, params, keys=None):
+        """
+        _query_
+
+        Query the view with params already converted by python_to_couch,
+        POSTing the keys if there are any
+
+        """
+        if keys is not None:
+            resp = self._r_session.post(
+                self.url,
+                params=params,
+                data=json.dumps({'keys': keys}),
+                headers={'Content-Type': 'application/json'}
+            )
+        else:
+            resp = self._r_session.get(self.url, params=params)
         resp.raise_for_status()
         return resp.json()
 
+    def _update_seq(self):
+        """the update_seq of the database holding the view"""
+        return self.design_doc._cloudant_database.metadata().get(
+            'update_seq'
+        )
+
+    def enable_cache(self, max_entries=100, ttl=None,
+                     stale_while_revalidate=False, seq_check_interval=1.0):
+        """
+        _enable_cache_
+
+        Cache the results of queries on this view, keyed by their query
+        parameters. Results are dropped when the database update_seq
+        moves on or they are older than ttl, unless
+        stale_while_revalidate is set, in which case they are served
+        while being refreshed in the background. Queries passing stale
+        are always served this way. Cached results are shared, so
+        should not be modified.
+
+        :param max_entries: max number of results to keep
+        :param ttl: optional max age in seconds of a result
+        :param stale_while_revalidate: serve out of date results while
+          refreshing them in the background
+        :param seq_check_interval: min seconds between update_seq lookups
+
+        :returns: the QueryCache, also available as view.cache
+
+        """
+        self.cache = QueryCache(
+            max_entries=max_entries,
+            ttl=ttl,
+            stale_while_revalidate=stale_while_revalidate,
+            seq_check_interval=seq_check_interval
+        )
+        return self.cache
+
+    def disable_cache(self):
+        """
+        _disable_cache_
+
+        Stop caching query results
+
+        """
+        self.cache = None
+
+    def query_keys(self, keys, chunk_size=100, workers=4, max_bytes=65536,
+                   **kwargs):
+        """
+        _query_keys_
+
+        Retrieve the rows matching each of a list of keys, using
+        POST requests with the keys in the body. Large key lists are
+        split into chunks which are queried concurrently.
+
+        Example:
+
+        for key, rows in view.query_keys(["a", "b"], include_docs=True):
+            print key, len(rows)
+
+        :param keys: list of keys to look up
+        :param chunk_size: max number of keys to send per request
+        :param workers: number of concurrent requests to make
+        :param max_bytes: approx max size of each request body
+        :param kwargs: additional view query options
+
+        :returns: list of (key, rows) tuples in the same order as keys
+
+        """
+        return Index(self, **kwargs).get_many(
+            keys,
+            chunk_size=chunk_size,
+            workers=workers,
+            max_bytes=max_bytes
+        )
+
+    def _grouped_rows(self, options, page_size):
+        """
+        _grouped_rows_
+
+        Page through the grouped reduce output for the options, using
+        the key of the row after each page as the startkey of the next,
+        so no skip is needed.
+
+        """
+        options = dict(options)
+        while True:
+            rows = self(limit=page_size + 1, **options).get('rows', [])
+            for row in rows[:page_size]:
+                yield row
+            if len(rows) <= page_size:
+                break
+            options['startkey'] = rows[page_size]['key']
+
+    def grouped(self, group_level=None, page_size=1000, key_ranges=None,
+                merge=None, workers=4, **kwargs):
+        """
+        _grouped_
+
+        Iterate over the grouped reduce output of the view, in key
+        order, without using skip. With group_level None the rows are
+        grouped by their exact key, otherwise array keys are grouped by
+        their first group_level elements.
+
+        The output can be split into key_ranges, which are queried in
+        parallel. Each range is a (startkey, endkey) tuple, including
+        startkey but excluding endkey, and None leaves that end open.
+        The ranges should be contiguous and in key order. If a boundary
+        falls within a group, eg [2014, 6] at group_level 1, that group
+        is reported partly by each range, and merge is called with the
+        two values to combine them, eg lambda a, b: a + b for _sum or
+        _count. The rows of each range are held in memory until the
+        earlier ranges have been yielded.
+
+        Example:
+
+        for row in view.grouped(group_level=1):
+            print row['key'], row['value']
+
+        ranges = [(None, [2014]), ([2014], [2015]), ([2015], None)]
+        for row in view.grouped(group_level=2, key_ranges=ranges,
+                                merge=operator.add):
+            print row['key'], row['value']
+
+        :param group_level: int, number of key elements to group by
+        :param page_size: number of rows to request at a time
+        :param key_ranges: optional list of (startkey, endkey) tuples
+        :param merge: optional callable combining the values of rows
+          with the same key from adjacent ranges
+        :param workers: number of ranges to query concurrently
+        :param kwargs: additional view query options, eg stale
+
+        """
+        for option in ('skip', 'limit', 'reduce', 'group', 'group_level'):
+            if option in kwargs:
+                msg = "Cannot use {0} with grouped".format(option)
+                raise CloudantArgumentError(msg)
+        if page_size < 1:
+            msg = "page_size must be a positive integer, got {0}".format(
+                page_size
+            )
+            raise CloudantArgumentError(msg)
+        if group_level is None:
+            kwargs['group'] = True
+        else:
+            kwargs['group_level'] = group_level
+        if key_ranges is None:
+            for row in self._grouped_rows(kwargs, page_size):
+                yield row
+            return
+        if 'startkey' in kwargs or 'endkey' in kwargs:
+            msg = "Cannot use startkey or endkey with key_ranges"
+            raise CloudantArgumentError(msg)
+
+        def fetch(key_range):
+            options = dict(kwargs)
+            startkey, endkey = key_range
+            if startkey is not None:
+                options['startkey'] = startkey
+            if endkey is not None:
+                options['endkey'] = endkey
+                options['inclusive_end'] = False
+            return list(self._grouped_rows(options, page_size))
+
+        previous = None
+        for rows in parallel_map(fetch, key_ranges, workers):
+            if not rows:
+                continue
+            if previous is not None:
+                if merge is not None and \
+                        key_id(previous['key']) == key_id(rows[0]['key']):
+                    rows[0] = dict(
+                        rows[0],
+                        value=merge(previous['value'], rows[0]['value'])
+                    )
+                else:
+                    yield previous
+            for row in rows[:-1]:
+                yield row
+            previous = rows[-1]
+        if previous is not None:
+            yield previous
+
     @contextlib.contextmanager
     def custom_index(self, **options):
         """
@@ -243,24 +460,277 @@ class DesignDocument(Document):
         """
         return self.views.get(view_name)
 
+    def _fetch_info(self):
+        """
+        GET the _info of this design document
+        """
+        resp = self._r_session.get(posixpath.join(self._document_url, '_info'))
+        resp.raise_for_status()
+        return resp.json()
+
+    def _active_tasks(self, task_type):
+        """
+        the _active_tasks entries of type task_type, eg indexer or
+        view_compaction, for this design document. There may be one
+        per shard. None if the user is not allowed to see them.
+        """
+        resp = self._r_session.get(
+            posixpath.join(self._database_host, '_active_tasks')
+        )
+        if resp.status_code in (401, 403):
+            # only admins can see the active tasks
+            return None
+        resp.raise_for_status()
+        tasks = []
+        for task in resp.json():
+            if task.get('type') != task_type or \
+                    task.get('design_document') != self._document_id:
+                continue
+            # clustered databases report the shard,
+            # eg shards/00000000-1fffffff/dbname.1415960794
+            database = task.get('database', '')
+            if database.startswith('shards/'):
+                database = database.split('/', 2)[-1].rsplit('.', 1)[0]
+            if database == self._database_name:
+                tasks.append(task)
+        return tasks
+
+    def _build_progress(self, started, history, target_seq=None):
+        """
+        work out the progress of the index build from the _info and
+        _active_tasks, estimating the time left from the recent rate.
+        current is True once the index has caught up with target_seq,
+        or None if that cant be told from the seqs.
+        """
+        view_index = self._fetch_info().get('view_index', {})
+        tasks = self._active_tasks('indexer') or []
+        done = sum(t.get('changes_done', 0) for t in tasks)
+        total = sum(t.get('total_changes', 0) for t in tasks)
+        running = bool(tasks) or bool(view_index.get('updater_running'))
+        current = None
+        index_seq = _seq_number(view_index.get('update_seq'))
+        target = _seq_number(target_seq)
+        if index_seq is not None and target is not None:
+            current = index_seq >= target
+        now = time.time()
+        history.append((now, done))
+        eta = None
+        if running and total:
+            then, done_then = history[0]
+            rate = float(done - done_then) / (now - then) if now > then else 0
+            if rate > 0:
+                eta = (total - done) / rate
+        if not running and current is not False:
+            percent = 100.0
+        elif total:
+            percent = 100.0 * done / total
+        else:
+            percent = 0.0
+        return {
+            'running': running,
+            'current': current,
+            'percent': percent,
+            'changes_done': done,
+            'total_changes': total,
+            'eta': eta,
+            'elapsed': now - started,
+        }
+
+    def warm(self, views=None, wait=True, poll_interval=5.0, timeout=None,
+             progress=None):
+        """
+        _warm_
+
+        Start building the index for the views of this design document,
+        eg after deploying it, so that queries dont stall while it
+        builds. The build is triggered with a limit=0 query using
+        stale=update_after, which returns straight away. If wait is
+        True, the indexer progress is then polled from _info and
+        _active_tasks until the index has caught up with the database
+        update_seq from when warm was called, triggering the build again
+        if the index is behind but nothing is updating it. Where the seqs
+        can't be compared, the build is taken as finished once the
+        indexer has been seen running and then stopped, or has not been
+        seen running over two checks.
+
+        Example:
+
+        ddoc.save()
+        ddoc.warm(progress=lambda p: log.info(
+            "%.1f%% done, eta %s", p['percent'], p['eta']))
+
+        :param views: names of the views to warm, defaults to all of
+          them. The views of a design document share an index, so
+          warming any one builds them all.
+        :param wait: wait for the index build to finish
+        :param poll_interval: seconds between progress checks
+        :param timeout: optional max seconds to wait, after which a
+          CloudantException is raised
+        :param progress: optional callable passed a dict with the
+          percent done, changes done and total, ETA in seconds and
+          time elapsed at each check
+
+        :returns: the last progress dict
+
+        """
+        if views is None:
+            views = sorted(self.get('views', {}).keys())
+        if not views:
+            return None
+        started = time.time()
+        # recent (time, changes done) samples to estimate the rate from
+        history = collections.deque(maxlen=10)
+        target_seq = self._cloudant_database.metadata().get('update_seq')
+        view = self.get_view(views[0])
+        if not isinstance(view, View):
+            view = View(self, views[0])
+        # query the server directly, as a cached result would not
+        # start the build
+        trigger = python_to_couch({'limit': 0, 'stale': 'update_after'})
+        view._query(trigger)
+
+        status = self._build_progress(started, history, target_seq)
+        if progress is not None:
+            progress(status)
+        if not wait:
+            return status
+        seen_running = False
+        idle_checks = 0
+        while True:
+            if status['running']:
+                seen_running = True
+                idle_checks = 0
+            elif status['current']:
+                break
+            else:
+                # the indexer may not have registered yet
+                idle_checks += 1
+                if status['current'] is None and \
+                        (seen_running or idle_checks >= 2):
+                    break
+                if status['current'] is False and idle_checks >= 2:
+                    # nothing is updating the out of date index
+                    view._query(trigger)
+                    idle_checks = 0
+            if timeout is not None and time.time() - started >= timeout:
+                raise CloudantException(
+                    "Index for {0} not built after {1}s, {2:.1f}% done".format(
+                        self._document_id, timeout, status['percent']
+                    )
+                )
+            time.sleep(poll_interval)
+            status = self._build_progress(started, history, target_seq)
+            if progress is not None:
+                progress(status)
+        return status
+
     def info(self):
         """
         retrieve the view info data, returns dictionary
 
         GET databasename/_design/test/_info
+
+        As well as the raw view_index data, the result has a sizes
+        dict with the active (live data), external (uncompressed data)
+        and file (on disk) sizes of the index in bytes, and its
+        fragmentation, the fraction of the file that compaction would
+        reclaim.
+
         """
-        raise NotImplemented("info not yet implemented")
+        data = self._fetch_info()
+        view_index = data.get('view_index', {})
+        sizes = view_index.get('sizes', {})
+        # older servers report disk_size and data_size instead
+        active = sizes.get('active', view_index.get('data_size'))
+        external = sizes.get('external')
+        file_size = sizes.get('file', view_index.get('disk_size'))
+        fragmentation = None
+        if file_size and active is not None:
+            fragmentation = max(0.0, float(file_size - active) / file_size)
+        data['sizes'] = {
+            'active': active,
+            'external': external,
+            'file': file_size,
+            'fragmentation': fragmentation,
+        }
+        return data
 
     def cleanup(self):
         """
+        _cleanup_
+
+        Remove the index files that are no longer used by any of the
+        design documents in the database, eg after views have been
+        changed.
 
         POST /some_database/_view_cleanup
 
         """
-        raise NotImplemented("cleanup not yet implemented")
+        url = posixpath.join(
+            self._cloudant_database.database_url,
+            '_view_cleanup'
+        )
+        resp = self._r_session.post(
+            url,
+            headers={'Content-Type': 'application/json'}
+        )
+        resp.raise_for_status()
+        return resp.json()
 
-    def compact(self):
+    def compact(self, wait=False, poll_interval=5.0, timeout=None):
         """
+        _compact_
+
+        Compact the view index of this design document, reclaiming the
+        space taken up by old data. If wait is True, poll _info and
+        _active_tasks until the compaction has finished, ie it has been
+        seen running, or the index sizes have changed, and it is no
+        longer running. A compaction that is never seen and changes
+        nothing is taken as finished after two checks.
+
         POST /some_database/_compact/designname
+
+        :param wait: wait for the compaction to finish
+        :param poll_interval: seconds between checks
+        :param timeout: optional max seconds to wait, after which a
+          CloudantException is raised
+
+        :returns: the info for the design document if waiting,
+          otherwise the response to the compaction request
+
         """
-        raise NotImplemented("compact not yet implemented")
+        url = posixpath.join(
+            self._cloudant_database.database_url,
+            '_compact',
+            self._document_id.split('/', 1)[-1]
+        )
+        sizes = self.info()['sizes'] if wait else None
+        resp = self._r_session.post(
+            url,
+            headers={'Content-Type': 'application/json'}
+        )
+        resp.raise_for_status()
+        if not wait:
+            return resp.json()
+        started = time.time()
+        seen_running = False
+        idle_checks = 0
+        while True:
+            info = self.info()
+            running = info.get('view_index', {}).get('compact_running') or \
+                bool(self._active_tasks('view_compaction'))
+            if running:
+                seen_running = True
+            else:
+                # the compaction may not have started yet
+                idle_checks += 1
+                if seen_running or info['sizes'] != sizes or \
+                        idle_checks >= 2:
+                    return info
+            if timeout is not None and time.time() - started >= timeout:
+                raise CloudantException(
+                    "Compaction of {0} not finished after {1}s".format(
+                        self._document_id, timeout
+                    )
+                )
+            time.sleep(poll_interval)
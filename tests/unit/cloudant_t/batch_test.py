@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+_batch_test_
+
+"""
+import itertools
+import json
+import mock
+import Queue
+import threading
+import unittest
+
+from cloudant.batch import chunked, size_bounded_chunks, parallel_map
+from cloudant.batch import parallel_stream, iter_json_array
+from cloudant.batch import put_unless_stopped
+from cloudant.errors import CloudantArgumentError
+
+
+class BatchTests(unittest.TestCase):
+    """tests for the chunking and parallel helpers"""
+
+    def test_chunked(self):
+        self.assertEqual(
+            list(chunked(range(7), 3)),
+            [[0, 1, 2], [3, 4, 5], [6]]
+        )
+        self.assertEqual(list(chunked([], 3)), [])
+        self.assertRaises(CloudantArgumentError, list, chunked([1], 0))
+
+    def test_size_bounded_chunks(self):
+        items = ["aaaa", "bbbb", "cccc", "dddd"]
+        # each item encodes to 6 bytes, plus a separator
+        chunks = list(size_bounded_chunks(items, max_bytes=14))
+        self.assertEqual(chunks, [["aaaa", "bbbb"], ["cccc", "dddd"]])
+        chunks = list(size_bounded_chunks(items, max_items=3))
+        self.assertEqual(chunks, [["aaaa", "bbbb", "cccc"], ["dddd"]])
+        # oversized items are still emitted on their own
+        chunks = list(size_bounded_chunks(["x" * 100, "y"], max_bytes=10))
+        self.assertEqual(chunks, [["x" * 100], ["y"]])
+
+    def test_parallel_map(self):
+        result = list(parallel_map(lambda x: x * 2, range(20), workers=4))
+        self.assertEqual(result, [x * 2 for x in range(20)])
+        result = parallel_map(lambda x: x * 2, range(20), ordered=False)
+        self.assertEqual(sorted(result), [x * 2 for x in range(20)])
+        result = list(parallel_map(lambda x: x, [1, 2], workers=1))
+        self.assertEqual(result, [1, 2])
+
+    def test_parallel_map_lazy(self):
+        calls = []
+
+        def record(x):
+            calls.append(x)
+            return x
+        result = parallel_map(record, itertools.count(), workers=2,
+                              max_pending=3)
+        self.assertEqual([next(result) for _ in range(5)], range(5))
+        self.failUnless(len(calls) <= 8)
+        result.close()
+
+        def broken(x):
+            if x == 3:
+                raise ValueError("womp")
+            return x
+        for ordered in (True, False):
+            result = parallel_map(broken, range(6), ordered=ordered)
+            self.assertRaises(ValueError, list, result)
+
+    def test_parallel_stream(self):
+        func = lambda x: (x * 10 + i for i in range(3))
+        result = parallel_stream(func, range(5), workers=3, max_pending=2)
+        self.assertEqual(
+            sorted(result), sorted(x * 10 + i for x in range(5) for i in range(3))
+        )
+        result = list(parallel_stream(func, [1], workers=3))
+        self.assertEqual(result, [10, 11, 12])
+
+        def broken(x):
+            yield x
+            raise ValueError("womp")
+        result = parallel_stream(broken, range(3), workers=3)
+        self.assertRaises(ValueError, list, result)
+
+    def test_put_unless_stopped(self):
+        queue = Queue.Queue(1)
+        stop = threading.Event()
+        self.failUnless(put_unless_stopped(queue, 1, stop))
+        threading.Timer(0.1, stop.set).start()
+        # the queue stays full, so the put gives up once stopped
+        self.failIf(put_unless_stopped(queue, 2, stop))
+        self.assertEqual(queue.get_nowait(), 1)
+
+    def test_iter_json_array(self):
+        body = '{"results": [{"a": 1}, {"b": "x]"} ,\n{"c": [1, 2]}\n]}'
+        for size in (1, 3, 7, len(body)):
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            self.assertEqual(
+                list(iter_json_array(chunks, "results")),
+                [{"a": 1}, {"b": "x]"}, {"c": [1, 2]}]
+            )
+        self.assertEqual(list(iter_json_array(['{"results":[]}'], "results")), [])
+        self.assertEqual(list(iter_json_array(['{"error": "x"}'], "results")), [])
+        truncated = iter_json_array(['{"results": [{"a": 1}, {"b"'], "results")
+        self.assertRaises(ValueError, list, truncated)
+
+    def test_iter_json_array_split_values(self):
+        body = '{"rows": [{"s": "a\\"}{[", "n": [[1], {}]}, 12.5, "x,]", null]}'
+        expected = [{"s": 'a"}{[', "n": [[1], {}]}, 12.5, "x,]", None]
+        for size in (1, 2, 5):
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            self.assertEqual(list(iter_json_array(chunks, "rows")), expected)
+
+    def test_iter_json_array_decodes_once(self):
+        # a large element split over many chunks is decoded a single time
+        body = json.dumps({"rows": [{"k": "v" * 5000}, {"k": 1}]})
+        chunks = [body[i:i + 10] for i in range(0, len(body), 10)]
+        decoder = json.JSONDecoder()
+        with mock.patch.object(decoder, 'decode',
+                               wraps=decoder.decode) as mock_decode:
+            rows = list(iter_json_array(chunks, "rows", decoder))
+        self.assertEqual(rows, [{"k": "v" * 5000}, {"k": 1}])
+        self.assertEqual(mock_decode.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+_cache_test_
+
+Tests for the cloudant.cache module
+
+"""
+import threading
+import unittest
+import mock
+
+from cloudant.cache import QueryCache, query_cache_key
+
+
+class QueryCacheTests(unittest.TestCase):
+    """
+    tests for QueryCache class
+
+    """
+    def setUp(self):
+        self.seq = '1-a'
+        self.update_seq = lambda: self.seq
+        self.calls = 0
+
+    def query(self):
+        self.calls += 1
+        return {'rows': [self.calls]}
+
+    def test_key(self):
+        """keys are independent of param order"""
+        self.assertEqual(
+            query_cache_key({'a': '1', 'b': '2'}),
+            query_cache_key({'b': '2', 'a': '1'})
+        )
+        self.assertNotEqual(
+            query_cache_key({'a': '1'}),
+            query_cache_key({'a': '1'}, ['k'])
+        )
+
+    def test_lru(self):
+        """the least recently used result is evicted"""
+        cache = QueryCache(max_entries=2, seq_check_interval=0)
+        cache.get('a', self.query, self.update_seq)
+        cache.get('b', self.query, self.update_seq)
+        cache.get('a', self.query, self.update_seq)
+        cache.get('c', self.query, self.update_seq)
+        self.assertEqual(self.calls, 3)
+        cache.get('a', self.query, self.update_seq)
+        self.assertEqual(self.calls, 3)
+        cache.get('b', self.query, self.update_seq)
+        self.assertEqual(self.calls, 4)
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    def test_ttl(self):
+        """results expire after ttl seconds"""
+        cache = QueryCache(ttl=10, seq_check_interval=0)
+        with mock.patch('cloudant.cache.time.time') as mock_time:
+            mock_time.return_value = 100
+            cache.get('a', self.query, self.update_seq)
+            mock_time.return_value = 105
+            cache.get('a', self.query, self.update_seq)
+            self.assertEqual(self.calls, 1)
+            mock_time.return_value = 111
+            cache.get('a', self.query, self.update_seq)
+            self.assertEqual(self.calls, 2)
+
+    def test_seq_check_interval(self):
+        """the update_seq is only checked every seq_check_interval"""
+        update_seq = mock.Mock(return_value='1-a')
+        cache = QueryCache(seq_check_interval=60)
+        cache.get('a', self.query, update_seq)
+        cache.get('a', self.query, update_seq)
+        self.assertEqual(update_seq.call_count, 1)
+
+    def test_stale_while_revalidate(self):
+        """stale results are served while refreshed in the background"""
+        cache = QueryCache(stale_while_revalidate=True, seq_check_interval=0)
+        self.assertEqual(
+            cache.get('a', self.query, self.update_seq), {'rows': [1]}
+        )
+        self.seq = '2-b'
+        refreshed = threading.Event()
+
+        def slow_query():
+            result = self.query()
+            refreshed.set()
+            return result
+        self.assertEqual(
+            cache.get('a', slow_query, self.update_seq), {'rows': [1]}
+        )
+        self.failUnless(refreshed.wait(5))
+        for _ in range(100):
+            if not cache._refreshing:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(
+            cache.get('a', self.query, self.update_seq), {'rows': [2]}
+        )
+        stats = cache.stats()
+        self.assertEqual(stats['stale_hits'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertAlmostEqual(stats['hit_ratio'], 2 / 3.0)
+
+    def test_allow_stale(self):
+        """queries passing stale can be served while revalidating"""
+        cache = QueryCache(seq_check_interval=0)
+        cache.get('a', self.query, self.update_seq)
+        self.seq = '2-b'
+        with mock.patch.object(cache, '_refresh') as mock_refresh:
+            self.assertEqual(
+                cache.get('a', self.query, self.update_seq, allow_stale=True),
+                {'rows': [1]}
+            )
+            self.failUnless(mock_refresh.called)
+        self.assertEqual(
+            cache.get('a', self.query, self.update_seq), {'rows': [2]}
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,10 +5,15 @@ _changes tests_
 Tests for the changes module
 
 """
+import json
+import threading
+import time
 import requests
 import unittest
 import mock
-from cloudant.changes import Feed
+from cloudant.changes import Feed, ChangesBatch, batch_changes, Coalescer
+from cloudant.checkpoint import MemoryCheckpointStore
+from cloudant.errors import CloudantArgumentError
 
 
 FIXTURE_DATA = """
@@ -64,7 +69,8 @@ class FeedTests(unittest.TestCase):
             self.mock_instance,
             "http://bob.cloudant.com/bobsdb/_changes",
             include_docs=True,
-            since="SINCE"
+            since="SINCE",
+            feed='continuous'
         )
 
         result = [x for x in f]
@@ -79,5 +85,475 @@ class FeedTests(unittest.TestCase):
         errors = [x['error'] for x in result if x.get('error') is not None]
         self.assertEqual(len(errors), 1)
 
+    def test_feed_checkpoint(self):
+        """
+        test committing processed seqs to a checkpoint store
+        """
+        lines = [
+            '{"seq": "1-a", "id": "doc1", "changes": []}',
+            '{"seq": "2-b", "id": "doc2", "changes": []}',
+            '',
+            '{"seq": "3-c", "id": "doc3", "changes": []}',
+        ]
+        mock_resp = mock.Mock()
+        mock_resp.iter_lines.return_value = iter(lines)
+        self.mock_instance.get.return_value = mock_resp
+
+        store = MemoryCheckpointStore("0-start")
+        f = Feed(
+            self.mock_instance,
+            "http://bob.cloudant.com/bobsdb/_changes",
+            checkpoint=store,
+            checkpoint_every=2,
+            checkpoint_interval=3600,
+            feed='continuous'
+        )
+        self.assertEqual(f.next()['seq'], "1-a")
+        self.assertEqual(
+            self.mock_instance.get.call_args[1]['params']['since'], "0-start"
+        )
+        self.assertEqual(f.next()['seq'], "2-b")
+        # the change in hand is not committed until it is processed
+        self.assertEqual(store.load(), "0-start")
+        self.assertEqual(f.next(), {})
+        self.assertEqual(store.load(), "2-b")
+        self.assertEqual(f.next()['seq'], "3-c")
+        self.assertEqual(store.load(), "2-b")
+        self.assertRaises(StopIteration, f.next)
+        self.assertEqual(store.load(), "3-c")
+    def test_feed_checkpoint_idle(self):
+        """
+        test processed changes are committed on time while the feed
+        only sends heartbeats
+        """
+        lines = [
+            '{"seq": "1-a", "id": "doc1", "changes": []}',
+            '{"seq": "2-b", "id": "doc2", "changes": []}',
+            '', '', '',
+        ]
+        mock_resp = mock.Mock()
+        mock_resp.iter_lines.return_value = iter(lines)
+        self.mock_instance.get.return_value = mock_resp
+
+        store = MemoryCheckpointStore()
+        f = Feed(
+            self.mock_instance,
+            "http://bob.cloudant.com/bobsdb/_changes",
+            checkpoint=store,
+            checkpoint_every=100,
+            checkpoint_interval=0.05,
+            feed='continuous'
+        )
+        self.assertEqual(f.next()['seq'], "1-a")
+        self.assertEqual(f.next()['seq'], "2-b")
+        self.assertEqual(f.next(), {})
+        self.assertEqual(store.load(), None)
+        time.sleep(0.1)
+        self.assertEqual(f.next(), {})
+        self.assertEqual(store.load(), "2-b")
+
+    def test_feed_stall_reconnect(self):
+        """
+        test reconnecting from the last seq when the connection stalls
+        """
+        def stalled_lines():
+            yield '{"seq": "1-a", "id": "doc1", "changes": []}'
+            yield ''
+            raise requests.exceptions.ConnectionError("Read timed out.")
+
+        first = mock.Mock()
+        first.iter_lines.return_value = stalled_lines()
+        second = mock.Mock()
+        second.iter_lines.return_value = iter(
+            ['{"seq": "2-b", "id": "doc2", "changes": []}']
+        )
+        self.mock_instance.get.side_effect = [first, second]
+
+        f = Feed(
+            self.mock_instance,
+            "http://bob.cloudant.com/bobsdb/_changes",
+            heartbeat=1000,
+            timeout=60000,
+            feed='continuous'
+        )
+        result = [x for x in f]
+        self.assertEqual([x.get('seq') for x in result], ['1-a', None, None, '2-b'])
+        self.assertEqual(self.mock_instance.get.call_count, 2)
+        call = self.mock_instance.get.call_args
+        self.assertEqual(call[1]['timeout'], 3.0)
+        self.assertEqual(call[1]['params']['heartbeat'], 1000)
+        self.assertEqual(call[1]['params']['timeout'], 60000)
+        self.assertEqual(call[1]['params']['since'], '1-a')
+        self.assertTrue(first.close.called)
+        snapshot = f.metrics.snapshot()
+        self.assertEqual(snapshot['reconnects'], 1)
+        self.assertEqual(snapshot['stalls'], 1)
+        self.failUnless(snapshot['stall_seconds'] >= 0)
+
+    def test_feed_reconnect_backoff(self):
+        """
+        test reconnecting with backoff from the last yielded seq
+        """
+        def broken_lines():
+            yield '{"seq": "1-a", "id": "doc1", "changes": []}'
+            raise requests.exceptions.ChunkedEncodingError("reset")
+
+        first = mock.Mock()
+        first.iter_lines.return_value = broken_lines()
+        last = mock.Mock()
+        last.iter_lines.return_value = iter(
+            ['{"seq": "2-b", "id": "doc2", "changes": []}']
+        )
+        self.mock_instance.get.side_effect = [
+            first,
+            requests.exceptions.ConnectionError("refused"),
+            requests.exceptions.ConnectionError("refused"),
+            last
+        ]
+        f = Feed(
+            self.mock_instance,
+            "http://bob.cloudant.com/bobsdb/_changes",
+            since="0-x",
+            backoff=1,
+            feed='continuous'
+        )
+        with mock.patch('cloudant.changes.time.sleep') as mock_sleep:
+            result = [x for x in f]
+        self.assertEqual([x.get('seq') for x in result], ['1-a', None, '2-b'])
+        self.assertEqual([c[0][0] for c in mock_sleep.call_args_list], [1, 2])
+        params = [c[1]['params'] for c in self.mock_instance.get.call_args_list]
+        self.assertEqual(params[0]['since'], '0-x')
+        self.assertEqual(params[-1]['since'], '1-a')
+        self.assertEqual(f.last_seq, '2-b')
+        self.assertEqual(f.metrics.reconnects, 3)
+        self.assertEqual(f.metrics.stalls, 0)
+
+    def test_feed_unexpected_end(self):
+        """
+        test a feed followed forever reconnects when the stream ends
+        without a last_seq
+        """
+        responses = []
+        for lines in (['{"seq": "1-a", "id": "doc1", "changes": []}'], [],
+                      ['{"seq": "2-b", "id": "doc2", "changes": []}']):
+            resp = mock.Mock()
+            resp.iter_lines.return_value = iter(lines)
+            responses.append(resp)
+        self.mock_instance.get.side_effect = responses
+        f = Feed(
+            self.mock_instance,
+            "http://bob.cloudant.com/bobsdb/_changes",
+            continuous=True,
+            backoff=1
+        )
+        with mock.patch('cloudant.changes.time.sleep') as mock_sleep:
+            result = [f.next() for _ in range(4)]
+        self.assertEqual(
+            [x.get('seq') for x in result], ['1-a', None, None, '2-b']
+        )
+        # the second empty stream in a row backs off
+        self.assertEqual([c[0][0] for c in mock_sleep.call_args_list], [1])
+        params = [c[1]['params'] for c in self.mock_instance.get.call_args_list]
+        self.assertEqual([p.get('since') for p in params], [None, '1-a', '1-a'])
+        self.assertEqual(f.metrics.reconnects, 2)
+
+    def test_feed_max_retries(self):
+        """connection errors are raised once retries are exhausted"""
+        self.mock_instance.get.side_effect = requests.exceptions.ConnectionError("refused")
+        f = Feed(
+            self.mock_instance,
+            "http://bob.cloudant.com/bobsdb/_changes",
+            max_retries=2
+        )
+        with mock.patch('cloudant.changes.time.sleep'):
+            self.assertRaises(requests.exceptions.ConnectionError, f.next)
+        self.assertEqual(self.mock_instance.get.call_count, 3)
+
+    def test_feed_filters(self):
+        """test server side filter options"""
+        mock_resp = mock.Mock()
+        mock_resp.iter_lines.return_value = iter([])
+        self.mock_instance.get.return_value = mock_resp
+        self.mock_instance.post.return_value = mock_resp
+        url = "http://bob.cloudant.com/bobsdb/_changes"
+
+        list(Feed(
+            self.mock_instance, url, feed='continuous',
+            selector={'type': 'order'}
+        ))
+        call = self.mock_instance.post.call_args
+        self.assertEqual(call[0][0], url)
+        self.assertEqual(call[1]['params']['filter'], '_selector')
+        self.assertEqual(json.loads(call[1]['data']), {'selector': {'type': 'order'}})
+
+        list(Feed(
+            self.mock_instance, url, feed='continuous',
+            doc_ids=('a', 'b'), style='all_docs'
+        ))
+        call = self.mock_instance.post.call_args
+        self.assertEqual(call[1]['params']['filter'], '_doc_ids')
+        self.assertEqual(call[1]['params']['style'], 'all_docs')
+        self.assertEqual(json.loads(call[1]['data']), {'doc_ids': ['a', 'b']})
+        self.assertEqual(self.mock_instance.post.call_count, 2)
+
+        list(Feed(
+            self.mock_instance, url, feed='continuous', view='ddoc/view1'
+        ))
+        params = self.mock_instance.get.call_args[1]['params']
+        self.assertEqual(params['filter'], '_view')
+        self.assertEqual(params['view'], 'ddoc/view1')
+
+        list(Feed(
+            self.mock_instance, url, feed='continuous', filter='ddoc/new',
+            query_params={'status': 'new'}
+        ))
+        params = self.mock_instance.get.call_args[1]['params']
+        self.assertEqual(params['filter'], 'ddoc/new')
+        self.assertEqual(params['status'], 'new')
+        self.assertEqual(self.mock_instance.post.call_count, 2)
+
+        self.assertRaises(
+            CloudantArgumentError, Feed, self.mock_instance, url,
+            selector={}, doc_ids=['a']
+        )
+        self.assertRaises(
+            CloudantArgumentError, Feed, self.mock_instance, url,
+            filter='_selector'
+        )
+        self.assertRaises(
+            CloudantArgumentError, Feed, self.mock_instance, url,
+            style='womp'
+        )
+
+    def _page_resp(self, seqs, last_seq):
+        resp = mock.Mock()
+        resp.content = json.dumps({
+            'results': [{'seq': x, 'id': 'doc%s' % x} for x in seqs],
+            'last_seq': last_seq
+        })
+        return resp
+
+    def test_feed_longpoll(self):
+        """test following a longpoll feed with adaptive polling"""
+        self.mock_instance.get.side_effect = [
+            self._page_resp([1, 2], 2),
+            self._page_resp([3], 3),
+            self._page_resp([], 3),
+            self._page_resp([], 3),
+            self._page_resp([4], 4),
+        ]
+        f = Feed(
+            self.mock_instance,
+            "http://bob.cloudant.com/bobsdb/_changes",
+            continuous=True,
+            feed='longpoll',
+            limit=2,
+            poll_interval=1,
+            max_poll_interval=3
+        )
+        with mock.patch('cloudant.changes.time.sleep') as mock_sleep:
+            results = [f.next() for _ in range(9)]
+        self.assertEqual(
+            [r.get('seq') for r in results],
+            [1, 2, None, 3, None, None, None, 4, None]
+        )
+        # full page => no wait, partial => poll_interval, idle => backoff
+        self.assertEqual(
+            [c[0][0] for c in mock_sleep.call_args_list], [1, 2, 3]
+        )
+        call = self.mock_instance.get.call_args
+        self.assertEqual(call[1]['params']['feed'], 'longpoll')
+        self.assertEqual(call[1]['params']['limit'], 2)
+        self.assertEqual(call[1]['params']['since'], 3)
+        self.assertFalse(call[1]['stream'])
+
+    def test_feed_normal(self):
+        """test a normal feed returns a single page"""
+        self.mock_instance.get.return_value = self._page_resp([1, 2], 2)
+        f = Feed(
+            self.mock_instance,
+            "http://bob.cloudant.com/bobsdb/_changes",
+            feed='normal'
+        )
+        result = [x for x in f]
+        self.assertEqual(result[-1], {'last_seq': 2})
+        self.assertEqual(len(result), 3)
+        self.assertEqual(self.mock_instance.get.call_count, 1)
+
+    def test_feed_default_mode(self):
+        """a feed that is not followed forever defaults to normal"""
+        url = "http://bob.cloudant.com/bobsdb/_changes"
+        self.mock_instance.get.return_value = self._page_resp([1], 1)
+        result = list(Feed(self.mock_instance, url))
+        self.assertEqual(result, [{'seq': 1, 'id': 'doc1'}, {'last_seq': 1}])
+        call = self.mock_instance.get.call_args
+        self.assertEqual(call[1]['params']['feed'], 'normal')
+        self.assertEqual(call[1]['stream'], False)
+        f = Feed(self.mock_instance, url, continuous=True)
+        self.assertEqual(f._params['feed'], 'continuous')
+
+    def test_feed_next_page(self):
+        """test pulling bounded pages"""
+        self.mock_instance.get.side_effect = [
+            self._page_resp([1, 2], 2),
+            self._page_resp([], 2),
+        ]
+        f = Feed(
+            self.mock_instance,
+            "http://bob.cloudant.com/bobsdb/_changes",
+            feed='normal',
+            limit=2
+        )
+        page = f.next_page()
+        self.failUnless(isinstance(page, ChangesBatch))
+        self.assertEqual([c['seq'] for c in page], [1, 2])
+        self.assertEqual(page.last_seq, 2)
+        page = f.next_page()
+        self.assertEqual(list(page), [])
+        self.assertEqual(self.mock_instance.get.call_args[1]['params']['since'], 2)
+
+        self.assertRaises(
+            CloudantArgumentError,
+            Feed(
+                self.mock_instance, "http://bob.cloudant.com",
+                feed='continuous', limit=2
+            ).next_page
+        )
+        # without a limit a page would be the whole history
+        self.assertRaises(
+            CloudantArgumentError,
+            Feed(self.mock_instance, "http://bob.cloudant.com").next_page
+        )
+        self.assertRaises(
+            CloudantArgumentError, Feed, self.mock_instance,
+            "http://bob.cloudant.com", feed='womp'
+        )
+
+    def test_feed_metrics(self):
+        """test throughput, bad line and lag metrics"""
+        mock_resp = mock.Mock()
+        mock_resp.iter_lines.return_value = (
+            x for x in FIXTURE_DATA.split('\n')
+        )
+        self.mock_instance.get.return_value = mock_resp
+        snapshots = []
+        lag_source = mock.Mock(return_value="26990-xyz")
+        f = Feed(
+            self.mock_instance,
+            "http://bob.cloudant.com/bobsdb/_changes",
+            lag_source=lag_source,
+            lag_interval=0,
+            metrics_hook=snapshots.append,
+            metrics_interval=0,
+            feed='continuous'
+        )
+        result = [x for x in f]
+        metrics = f.metrics.snapshot()
+        self.assertEqual(metrics['changes'], 6)
+        self.assertEqual(metrics['bad_lines'], 1)
+        self.assertEqual(metrics['bytes'], len(FIXTURE_DATA) + 1)
+        self.failUnless(metrics['changes_per_sec'] > 0)
+        self.assertEqual(metrics['update_seq'], "26990-xyz")
+        # last change seen was 26987
+        self.assertEqual(metrics['lag'], 3)
+        self.assertEqual(len(snapshots), len(result))
+        self.assertEqual(snapshots[0]['changes'], 0)
+        self.assertEqual(lag_source.call_count, len(result))
+
+    def test_feed_page_metrics(self):
+        """test metrics for paged feeds"""
+        self.mock_instance.get.return_value = self._page_resp([1, 2], 2)
+        f = Feed(
+            self.mock_instance,
+            "http://bob.cloudant.com/bobsdb/_changes",
+            feed='normal',
+            limit=10,
+            lag_source=lambda: 5
+        )
+        f.next_page()
+        self.assertEqual(f.metrics.changes, 2)
+        self.assertEqual(
+            f.metrics.bytes,
+            len(self.mock_instance.get.return_value.content)
+        )
+        self.assertEqual(f.metrics.lag, 3)
+
+
+class BatchChangesTests(unittest.TestCase):
+    """tests for grouping changes into batches"""
+
+    def test_batch_by_size(self):
+        changes = [{'seq': str(i), 'id': 'doc%s' % i} for i in range(5)]
+        changes.insert(2, {})
+        changes.insert(3, {'error': 'Bad JSON line', 'line': 'x'})
+        batches = list(batch_changes(changes, max_size=2, max_wait=3600))
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+        self.failUnless(all(isinstance(b, ChangesBatch) for b in batches))
+        self.assertEqual([b.last_seq for b in batches], ['1', '3', '4'])
+
+    def test_batch_by_time(self):
+        release = threading.Event()
+
+        def changes():
+            yield {'seq': '1', 'id': 'a'}
+            # a quiet feed, the partial batch is flushed meanwhile
+            release.wait(5)
+            yield {'seq': '2', 'id': 'b'}
+
+        batches = batch_changes(changes(), max_size=10, max_wait=0.05)
+        start = time.time()
+        self.assertEqual(next(batches), [{'seq': '1', 'id': 'a'}])
+        self.failUnless(time.time() - start < 1)
+        release.set()
+        self.assertEqual(list(batches), [[{'seq': '2', 'id': 'b'}]])
+
+    def test_batch_errors(self):
+        def changes():
+            yield {'seq': '1', 'id': 'a'}
+            raise ValueError("womp")
+        batches = batch_changes(changes(), max_size=10, max_wait=3600)
+        self.assertRaises(ValueError, list, batches)
+
+
+class CoalescerTests(unittest.TestCase):
+    """tests for coalescing repeated changes"""
+
+    def test_coalesce(self):
+        ids = ['a', 'b', 'a', 'c', 'a', 'b', 'd', 'd']
+        changes = [{'seq': i, 'id': x} for i, x in enumerate(ids)]
+        store = MemoryCheckpointStore()
+        coalescer = Coalescer(changes, window=3600, max_count=6, checkpoint=store)
+
+        result = iter(coalescer)
+        first_window = [next(result) for _ in range(3)]
+        self.assertEqual(
+            first_window,
+            [{'seq': 3, 'id': 'c'}, {'seq': 4, 'id': 'a'}, {'seq': 5, 'id': 'b'}]
+        )
+        # the window is not checkpointed until all of it has been processed
+        self.assertEqual(store.load(), None)
+        self.assertEqual(next(result), {'seq': 7, 'id': 'd'})
+        self.assertEqual(store.load(), 5)
+        self.assertEqual(list(result), [])
+        self.assertEqual(store.load(), 7)
+        self.assertEqual(coalescer.last_seq, 7)
+        self.assertEqual(coalescer.received, 8)
+        self.assertEqual(coalescer.emitted, 4)
+        self.assertEqual(coalescer.coalesced, 4)
+
+    def test_for_database(self):
+        database = mock.Mock()
+        database._changes_feed.return_value = [{'seq': 1, 'id': 'a'}]
+        store = MemoryCheckpointStore()
+        store.save(5)
+        coalescer = Coalescer.for_database(
+            database, window=2, checkpoint=store, selector={'type': 'x'}
+        )
+        self.assertEqual(list(coalescer), [{'seq': 1, 'id': 'a'}])
+        database._changes_feed.assert_called_once_with(
+            5, True, False, heartbeat=2000, selector={'type': 'x'}
+        )
+
+
 if __name__ == '__main__':
     unittest.main()
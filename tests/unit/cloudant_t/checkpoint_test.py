@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+_checkpoint_test_
+
+"""
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from cloudant.checkpoint import CheckpointStore, MemoryCheckpointStore
+from cloudant.checkpoint import FileCheckpointStore, SQLiteCheckpointStore
+from cloudant.checkpoint import LocalDocumentCheckpointStore
+
+
+class CheckpointStoreTests(unittest.TestCase):
+    """tests for the checkpoint store implementations"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_interface(self):
+        store = CheckpointStore()
+        self.assertRaises(NotImplementedError, store.load)
+        self.assertRaises(NotImplementedError, store.save, "1-abc")
+
+    def test_memory_store(self):
+        store = MemoryCheckpointStore()
+        self.assertEqual(store.load(), None)
+        store.save("1-abc")
+        self.assertEqual(store.load(), "1-abc")
+
+    def test_file_store(self):
+        path = os.path.join(self.tempdir, 'feed.checkpoint')
+        store = FileCheckpointStore(path)
+        self.assertEqual(store.load(), None)
+        store.save("12-abc")
+        store.save("13-def")
+        self.assertEqual(FileCheckpointStore(path).load(), "13-def")
+        # no temp files left behind
+        self.assertEqual(os.listdir(self.tempdir), ['feed.checkpoint'])
+
+    def test_sqlite_store(self):
+        path = os.path.join(self.tempdir, 'checkpoints.db')
+        store1 = SQLiteCheckpointStore(path, name='feed1')
+        store2 = SQLiteCheckpointStore(path, name='feed2')
+        self.assertEqual(store1.load(), None)
+        store1.save("12-abc")
+        store2.save(42)
+        store1.save("13-def")
+        self.assertEqual(SQLiteCheckpointStore(path, 'feed1').load(), "13-def")
+        self.assertEqual(store2.load(), 42)
+
+    def test_local_document_store(self):
+        session = mock.Mock()
+        database = mock.Mock()
+        database._r_session = session
+        database.database_url = "https://bob.cloudant.com/unittest"
+        store = LocalDocumentCheckpointStore(database, 'my feed')
+        self.assertEqual(
+            store.url, "https://bob.cloudant.com/unittest/_local/my%20feed"
+        )
+
+        missing = mock.Mock(status_code=404)
+        session.get.return_value = missing
+        self.assertEqual(store.load(), None)
+
+        put_resp = mock.Mock(status_code=201)
+        put_resp.json.return_value = {'ok': True, 'rev': '0-1'}
+        session.put.return_value = put_resp
+        store.save("12-abc")
+        self.assertEqual(json.loads(session.put.call_args[1]['data']), {'seq': '12-abc'})
+
+        put_resp.json.return_value = {'ok': True, 'rev': '0-2'}
+        store.save("13-def")
+        self.assertEqual(
+            json.loads(session.put.call_args[1]['data']),
+            {'seq': '13-def', '_rev': '0-1'}
+        )
+
+        found = mock.Mock(status_code=200)
+        found.json.return_value = {'_id': '_local/my feed', '_rev': '0-2', 'seq': '13-def'}
+        session.get.return_value = found
+        self.assertEqual(store.load(), '13-def')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,13 +2,16 @@
 database unittests
 """
 
+import itertools
 import mock
 import unittest
 import posixpath
 import json
+import time
 
 from cloudant.database import CouchDatabase, CloudantDatabase
 from cloudant.errors import CloudantException
+from cloudant.views import DesignDocument
 
 
 class CouchDBTest(unittest.TestCase):
@@ -191,6 +194,241 @@ class CouchDBTest(unittest.TestCase):
             headers={'Content-Type': 'application/json'}
         )
 
+    def test_fetch_many(self):
+        def fake_post(url, params=None, data=None, headers=None):
+            rows = []
+            for key in json.loads(data)['keys']:
+                if key == 'missing':
+                    rows.append({'key': key, 'error': 'not_found'})
+                elif key == 'deleted':
+                    rows.append({
+                        'id': key, 'key': key, 'doc': None,
+                        'value': {'rev': '2-x', 'deleted': True}
+                    })
+                else:
+                    rows.append({
+                        'id': key, 'key': key, 'value': {'rev': '1-x'},
+                        'doc': {'_id': key, '_rev': '1-x', 'foo': 'bar'}
+                    })
+            resp = mock.Mock()
+            resp.json.return_value = {'rows': rows}
+            return resp
+        self.mock_session.post = mock.Mock(side_effect=fake_post)
+
+        ids = ['a', 'missing', 'b', 'deleted', '_design/c']
+        docs = list(self.c.fetch_many(ids, chunk=2, workers=2, cache=True))
+
+        self.assertEqual(self.mock_session.post.call_count, 3)
+        call = self.mock_session.post.call_args_list[0]
+        self.assertEqual(call[0][0], posixpath.join(self.db_url, '_all_docs'))
+        self.assertEqual(call[1]['params'], {'include_docs': 'true'})
+        self.assertEqual(
+            sorted(d['_id'] for d in docs), ['_design/c', 'a', 'b']
+        )
+        self.failUnless(all(d['foo'] == 'bar' for d in docs))
+        self.failUnless(isinstance(dict(self.c)['_design/c'], DesignDocument))
+        self.assertEqual(sorted(self.c.keys()), ['_design/c', 'a', 'b'])
+
+        docs = list(self.c.fetch_many(['a'], include_docs=False))
+        self.assertEqual(docs, [{'_id': 'a', '_rev': '1-x'}])
+        self.assertEqual(
+            self.mock_session.post.call_args[1]['params'],
+            {'include_docs': 'false'}
+        )
+
+    def test_fetch_many_backpressure(self):
+        def fake_post(url, params=None, data=None, headers=None):
+            rows = [
+                {
+                    'id': key, 'key': key, 'value': {'rev': '1-x'},
+                    'doc': {'_id': key, '_rev': '1-x'}
+                }
+                for key in json.loads(data)['keys']
+            ]
+            resp = mock.Mock()
+            resp.json.return_value = {'rows': rows}
+            return resp
+        self.mock_session.post = mock.Mock(side_effect=fake_post)
+
+        # an endless id generator is read lazily, and only a bounded
+        # number of chunks are fetched ahead of the consumer
+        ids = ('doc{0}'.format(i) for i in itertools.count())
+        docs = self.c.fetch_many(ids, chunk=2, workers=2)
+        self.assertEqual(next(docs)['_id'][:3], 'doc')
+        time.sleep(0.3)
+        self.failUnless(self.mock_session.post.call_count <= 6)
+        docs.close()
+        # give the workers time to notice and exit
+        time.sleep(0.3)
+
+    def test_bulk_get(self):
+        def fake_post(url, params=None, data=None, headers=None, stream=False):
+            results = []
+            for entry in json.loads(data)['docs']:
+                if entry['id'] == 'missing':
+                    results.append({'id': entry['id'], 'docs': [
+                        {'error': {'id': entry['id'], 'error': 'not_found'}}
+                    ]})
+                else:
+                    results.append({'id': entry['id'], 'docs': [
+                        {'ok': {'_id': entry['id'], '_rev': entry.get('rev')}}
+                    ]})
+            body = json.dumps({'results': results})
+            resp = mock.Mock()
+            resp.iter_content.return_value = (
+                body[i:i + 10] for i in range(0, len(body), 10)
+            )
+            return resp
+        self.mock_session.post = mock.Mock(side_effect=fake_post)
+
+        pairs = [('a', '1-x'), ('b', None), ('missing', '1-y')]
+        entries = list(self.c.bulk_get(pairs, chunk=2, workers=1, revs=True))
+
+        self.assertEqual(self.mock_session.post.call_count, 2)
+        call = self.mock_session.post.call_args_list[0]
+        self.assertEqual(call[0][0], posixpath.join(self.db_url, '_bulk_get'))
+        self.assertEqual(call[1]['params'], {'revs': 'true'})
+        self.assertEqual(
+            json.loads(call[1]['data']),
+            {'docs': [{'id': 'a', 'rev': '1-x'}, {'id': 'b'}]}
+        )
+        self.failUnless(call[1]['stream'])
+        self.assertEqual(entries, [
+            {'ok': {'_id': 'a', '_rev': '1-x'}},
+            {'ok': {'_id': 'b', '_rev': None}},
+            {'error': {'id': 'missing', 'error': 'not_found'}},
+        ])
+
+    def test_bulk_delete(self):
+        def fake_post(url, params=None, data=None, headers=None):
+            resp = mock.Mock()
+            body = json.loads(data)
+            if url.endswith('_all_docs'):
+                rows = []
+                for key in body['keys']:
+                    if key == 'missing':
+                        rows.append({'key': key, 'error': 'not_found'})
+                    else:
+                        rows.append({'id': key, 'key': key, 'value': {'rev': '1-' + key}})
+                resp.json.return_value = {'rows': rows}
+            else:
+                resp.json.return_value = [
+                    {'id': d['_id'], 'rev': '2-x', 'ok': True} for d in body['docs']
+                ]
+            return resp
+        self.mock_session.post = mock.Mock(side_effect=fake_post)
+        dict.__setitem__(self.c, 'a', {'_id': 'a'})
+
+        results = self.c.bulk_delete(
+            ['a', 'missing', {'_id': 'b', '_rev': '3-b'}, {'_id': 'c'}],
+            chunk=2
+        )
+
+        urls = [c[0][0] for c in self.mock_session.post.call_args_list]
+        self.assertEqual(urls.count(posixpath.join(self.db_url, '_all_docs')), 2)
+        self.assertEqual(urls.count(posixpath.join(self.db_url, '_bulk_docs')), 2)
+        tombstones = []
+        for call in self.mock_session.post.call_args_list:
+            if call[0][0].endswith('_bulk_docs'):
+                tombstones.extend(json.loads(call[1]['data'])['docs'])
+        self.assertEqual(
+            sorted(tombstones),
+            sorted([
+                {'_id': 'a', '_rev': '1-a', '_deleted': True},
+                {'_id': 'b', '_rev': '3-b', '_deleted': True},
+                {'_id': 'c', '_rev': '1-c', '_deleted': True},
+            ])
+        )
+        self.assertEqual(len(results), 3)
+        self.failIf('a' in self.c.keys())
+
+    def test_bulk_update(self):
+        revs = {'a': 1, 'b': 1}
+        conflicts = set(['b'])
+
+        def fake_post(url, params=None, data=None, headers=None):
+            resp = mock.Mock()
+            body = json.loads(data)
+            if url.endswith('_all_docs'):
+                resp.json.return_value = {'rows': [
+                    {
+                        'id': k, 'key': k, 'value': {'rev': '%s-x' % revs[k]},
+                        'doc': {'_id': k, '_rev': '%s-x' % revs[k], 'count': revs[k]}
+                    } if k in revs else {'key': k, 'error': 'not_found'}
+                    for k in body['keys']
+                ]}
+            else:
+                results = []
+                for doc in body['docs']:
+                    if doc['_id'] in conflicts:
+                        # someone else got there first, once
+                        conflicts.remove(doc['_id'])
+                        revs[doc['_id']] += 1
+                        results.append({'id': doc['_id'], 'error': 'conflict'})
+                    else:
+                        revs[doc['_id']] += 1
+                        results.append({'id': doc['_id'], 'ok': True, 'rev': '%s-x' % revs[doc['_id']]})
+                resp.json.return_value = results
+            return resp
+        self.mock_session.post = mock.Mock(side_effect=fake_post)
+
+        def bump(doc):
+            doc['count'] += 10
+
+        results = self.c.bulk_update(['a', 'b'], bump)
+        self.assertEqual(sorted(r['id'] for r in results), ['a', 'b'])
+        self.failUnless(all(r['ok'] for r in results))
+        writes = [
+            json.loads(c[1]['data'])['docs']
+            for c in self.mock_session.post.call_args_list
+            if c[0][0].endswith('_bulk_docs')
+        ]
+        self.assertEqual(len(writes), 2)
+        # only the conflicting doc is retried, from its new revision
+        self.assertEqual(writes[1], [{'_id': 'b', '_rev': '2-x', 'count': 12}])
+
+        conflicts.add('a')
+        results = self.c.bulk_update(['a'], lambda d: {'replaced': True}, max_tries=1)
+        self.assertEqual(results, [{'id': 'a', 'error': 'conflict'}])
+
+        results = self.c.bulk_update(['gone', 'a'], bump)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(
+            results[0], {'id': 'gone', 'error': 'not_found', 'reason': 'missing'}
+        )
+        self.assertEqual(results[1]['id'], 'a')
+        self.failUnless(results[1]['ok'])
+
+    def test_changes_batches(self):
+        feed = [
+            {'seq': '1-a', 'id': 'a', 'changes': []},
+            {},
+            {'seq': '2-b', 'id': 'b', 'changes': []},
+            {'seq': '3-c', 'id': 'c', 'changes': [], 'deleted': True},
+        ]
+        store = mock.Mock()
+        store.load.return_value = '0-x'
+        with mock.patch('cloudant.database.Feed') as mock_feed:
+            mock_feed.return_value = iter(feed)
+            with mock.patch.object(CouchDatabase, 'fetch_many') as mock_fetch:
+                mock_fetch.side_effect = lambda ids, **kw: [
+                    {'_id': i, 'body': i.upper()} for i in ids
+                ]
+                batches = self.c.changes_batches(
+                    max_size=2, max_wait=3600, hydrate=True, checkpoint=store
+                )
+                first = next(batches)
+                self.assertEqual(first.last_seq, '2-b')
+                self.assertEqual([c['doc']['body'] for c in first], ['A', 'B'])
+                self.failIf(store.save.called)
+                second = next(batches)
+                store.save.assert_called_once_with('2-b')
+                self.assertEqual(second[0]['doc'], None)
+                self.assertRaises(StopIteration, next, batches)
+                store.save.assert_called_with('3-c')
+        self.assertEqual(mock_feed.call_args[1]['since'], '0-x')
+        self.assertEqual(mock_feed.call_args[1]['heartbeat'], 60000)
+
     def test_db_updates(self):
         updates_feed = """
             {"dbname": "somedb3", "type": "created", "account": "bob", "seq": "3-g1AAAABteJzLYWBgYMxgTmFQSElKzi9KdUhJMtHLTc1NzTcwMNdLzskvTUnMK9HLSy3JAapkSmTIY2H4DwRZGcyJzLlAIfa0tKQUQ2NTIkzIAgD_wSJc"}
@@ -369,6 +607,44 @@ class CloudantDBTest(unittest.TestCase):
         )
         self.assertEqual(revs_diff, ret_val)
 
+    def test_batch_revisions(self):
+        def fake_post(url, headers=None, data=None):
+            body = json.loads(data)
+            resp = mock.Mock()
+            if url.endswith('_missing_revs'):
+                resp.json.return_value = {'missed_revs': dict(
+                    (k, v[:1]) for k, v in body.items() if k != 'complete'
+                )}
+            else:
+                resp.json.return_value = dict(
+                    (k, {'missing': v[:1]}) for k, v in body.items()
+                )
+            return resp
+        self.mock_session.post = mock.Mock(side_effect=fake_post)
+
+        revs = dict(
+            ('doc%03d' % i, ['1-aaaa', '2-bbbb']) for i in range(50)
+        )
+        revs['complete'] = ['1-cccc']
+
+        missed = self.cl.batch_missing_revisions(revs, max_bytes=200)
+        self.assertEqual(len(missed), 50)
+        self.assertEqual(missed['doc007'], ['1-aaaa'])
+        self.failIf('complete' in missed)
+        calls = self.mock_session.post.call_args_list
+        self.failUnless(len(calls) > 1)
+        for call in calls:
+            self.failUnless(call[0][0].endswith('_missing_revs'))
+            self.failUnless(len(call[1]['data']) <= 200)
+
+        self.mock_session.post.reset_mock()
+        diff = self.cl.batch_revisions_diff(revs, max_bytes=200, workers=1)
+        self.assertEqual(len(diff), 51)
+        self.assertEqual(diff['doc049'], {'missing': ['1-aaaa']})
+        self.assertEqual(
+            self.mock_session.post.call_count, len(calls)
+        )
+
     def test_revs_limit(self):
         limit = 500
         expected_url = posixpath.join(
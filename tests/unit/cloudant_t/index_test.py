@@ -24,7 +24,7 @@ class PythonToCouchTests(unittest.TestCase):
             "endkey": ['string'],
             "endkey_docid": 'string',
             "group": True,
-            "group_level": "string",
+            "group_level": 2,
             "include_docs": True,
             "inclusive_end": True,
             "key": 12,
@@ -40,16 +40,26 @@ class PythonToCouchTests(unittest.TestCase):
         self.assertEqual(result['endkey'], '["string"]')
         self.assertEqual(result['skip'], 12)
         self.assertEqual(result['endkey_docid'], '"string"')
-        self.assertEqual(result['stale'], '"ok"')
+        self.assertEqual(result['stale'], 'ok')
+        self.assertEqual(result['group_level'], 2)
 
     def test_other_valid_option_combos(self):
         result = python_to_couch({"skip": None})
         self.assertEqual(result['skip'], None)
 
+    def test_json_keys(self):
+        """keys can be any JSON value"""
+        for key, encoded in [
+                (1.5, '1.5'), (2 ** 40, '1099511627776'), (None, 'null'),
+                ({"a": 1}, '{"a": 1}'), (("a", 2), '["a", 2]'), (3, '3')]:
+            for arg in ("key", "startkey", "endkey"):
+                self.assertEqual(python_to_couch({arg: key})[arg], encoded)
+
     def test_invalid_option_raises(self):
         self.assertRaises(CloudantArgumentError, python_to_couch, {"womp": "womp"})
         self.assertRaises(CloudantArgumentError, python_to_couch, {"group": "womp"})
         self.assertRaises(CloudantArgumentError, python_to_couch, {"stale": "womp"})
+        self.assertRaises(CloudantArgumentError, python_to_couch, {"group_level": "2"})
 
         # this datetime triggers an argument conversion error
         self.assertRaises(CloudantArgumentError, python_to_couch, {'endkey': [1,2,3, datetime.datetime.utcnow()]})
@@ -123,5 +133,41 @@ class IndexTests(unittest.TestCase):
         results = [x for x in idx]
         self.assertEqual(len(results), 100)
 
+    def test_get_many(self):
+        """get rows for multiple keys, chunked and grouped by key"""
+        def fake_ref(keys=None, **options):
+            rows = []
+            for k in keys:
+                if k == "missing":
+                    continue
+                rows.append({'key': k, 'value': 1})
+                rows.append({'key': k, 'value': 2})
+            return {'rows': rows}
+        ref = mock.Mock(side_effect=fake_ref)
+        idx = Index(ref, include_docs=True)
+
+        keys = ["a", ["b", 1], "missing", "c", "a"]
+        result = idx.get_many(keys, chunk_size=2, workers=2)
+
+        self.assertEqual([k for k, _ in result], keys)
+        self.assertEqual(result[0][1], [{'key': 'a', 'value': 1}, {'key': 'a', 'value': 2}])
+        self.assertEqual(len(result[1][1]), 2)
+        self.assertEqual(result[2][1], [])
+        self.assertEqual(result[4][1], result[0][1])
+        # four unique keys in chunks of two
+        self.assertEqual(ref.call_count, 2)
+        for call in ref.call_args_list:
+            self.assertEqual(call[1]['include_docs'], True)
+
+    def test_get_many_max_bytes(self):
+        """long keys are split into size bounded chunks"""
+        ref = mock.Mock(return_value={'rows': []})
+        idx = Index(ref)
+        keys = [["x" * 40, i] for i in range(6)]
+        idx.get_many(keys, chunk_size=100, workers=1, max_bytes=100)
+        self.assertEqual(ref.call_count, 3)
+        for call in ref.call_args_list:
+            self.assertEqual(len(call[1]['keys']), 2)
+
 if __name__ == '__main__':
     unittest.main()
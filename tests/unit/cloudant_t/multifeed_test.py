@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+_multifeed_test_
+
+"""
+import json
+import mock
+import threading
+import unittest
+
+from cloudant.checkpoint import MemoryCheckpointStore
+from cloudant.database import CouchDatabase
+from cloudant.multifeed import MultiFeed
+
+
+class MultiFeedTests(unittest.TestCase):
+    """tests for MultiFeed"""
+
+    def setUp(self):
+        self.session = mock.Mock()
+        self.account = mock.Mock()
+        self.account._cloudant_url = "https://bob.cloudant.com"
+        self.account._r_session = self.session
+        self.account._DATABASE_CLASS = CouchDatabase
+        self.changes = {
+            'db1': [{'seq': i, 'id': 'doc%s' % i} for i in range(1, 6)],
+            'db2': [{'seq': 1, 'id': 'x'}],
+            'db3': [{'seq': 1, 'id': 'y'}],
+        }
+        self.requests = []
+        self.session.get.side_effect = self.fake_get
+
+    def fake_get(self, url, params=None, stream=False, timeout=None):
+        resp = mock.Mock()
+        if url.endswith('_db_updates'):
+            resp.iter_lines.return_value = iter([
+                json.dumps({'db_name': 'db2', 'type': 'updated'}),
+                json.dumps({'db_name': 'db3', 'type': 'updated'}),
+                json.dumps({'db_name': 'other', 'type': 'updated'}),
+                json.dumps({'db_name': 'db2', 'type': 'deleted'}),
+            ])
+            return resp
+        dbname = url.split('/')[-2]
+        self.requests.append((dbname, params.get('since')))
+        since = params.get('since') or 0
+        changes = [c for c in self.changes[dbname] if c['seq'] > since]
+        page = changes[:params['limit']]
+        resp.content = json.dumps({
+            'results': page,
+            'last_seq': page[-1]['seq'] if page else since
+        })
+        return resp
+
+    def test_multifeed(self):
+        stores = {}
+
+        def factory(dbname):
+            stores[dbname] = MemoryCheckpointStore(2 if dbname == 'db1' else None)
+            return stores[dbname]
+
+        mf = MultiFeed(
+            self.account, dbnames=['db1', 'db2', 'db3'], workers=2,
+            limit=2, checkpoint_factory=factory
+        )
+        results = []
+        items = iter(mf)
+        while len(results) < 5:
+            results.append(next(items))
+        threading.Timer(0.3, mf.stop).start()
+        self.assertEqual(list(items), [])
+
+        db1 = [c['seq'] for db, c in results if db == 'db1']
+        self.assertEqual(db1, [3, 4, 5])
+        self.assertEqual(
+            sorted(db for db, _ in results), ['db1', 'db1', 'db1', 'db2', 'db3']
+        )
+        # db1 resumed from its checkpoint and paged through its changes
+        db1_requests = [s for db, s in self.requests if db == 'db1']
+        self.assertEqual(db1_requests, [2, 4])
+        self.failIf('other' in [db for db, _ in self.requests])
+        self.assertEqual(stores['db1'].load(), 5)
+        self.assertEqual(stores['db2'].load(), 1)
+
+    def test_schedule_coalesces(self):
+        mf = MultiFeed(self.account)
+        mf.schedule('db1')
+        mf.schedule('db1')
+        mf.schedule('db1')
+        self.assertEqual(mf._tasks.qsize(), 1)
+        self.assertEqual(mf._dirty, set(['db1']))
+
+
+if __name__ == '__main__':
+    unittest.main()
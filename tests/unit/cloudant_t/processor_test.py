@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+_processor_test_
+
+"""
+import threading
+import time
+import unittest
+
+from cloudant.checkpoint import MemoryCheckpointStore
+from cloudant.errors import CloudantException
+from cloudant.processor import ChangesProcessor, SeqTracker
+
+
+def noop_handler(change):
+    """module level handler usable by worker processes"""
+    pass
+
+
+class SeqTrackerTests(unittest.TestCase):
+    """tests for SeqTracker"""
+
+    def test_safe_seq(self):
+        tracker = SeqTracker()
+        for i in range(4):
+            tracker.dispatch(i, 's%s' % i)
+        self.failIf(tracker.ack(1))
+        self.assertEqual(tracker.safe_seq, None)
+        self.failUnless(tracker.ack(0))
+        self.assertEqual(tracker.safe_seq, 's1')
+        tracker.ack(3)
+        self.assertEqual(tracker.safe_seq, 's1')
+        self.assertEqual(tracker.pending(), 2)
+        tracker.ack(2)
+        self.assertEqual(tracker.safe_seq, 's3')
+        self.assertEqual(tracker.pending(), 0)
+
+
+class ChangesProcessorTests(unittest.TestCase):
+    """tests for ChangesProcessor"""
+
+    def setUp(self):
+        self.feed = []
+        for i in range(200):
+            self.feed.append({'seq': i, 'id': 'doc%s' % (i % 7)})
+            if i % 50 == 0:
+                self.feed.append({})
+
+    def test_per_document_order(self):
+        seen = {}
+        lock = threading.Lock()
+
+        def handler(change):
+            time.sleep(0.0001)
+            with lock:
+                seen.setdefault(change['id'], []).append(change['seq'])
+
+        store = MemoryCheckpointStore()
+        processor = ChangesProcessor(
+            self.feed, handler, workers=3, queue_size=5,
+            checkpoint=store, checkpoint_every=10
+        )
+        result = processor.run()
+
+        self.assertEqual(result, 199)
+        self.assertEqual(store.load(), 199)
+        self.assertEqual(processor.dispatched, 200)
+        self.assertEqual(processor.processed, 200)
+        self.assertEqual(len(seen), 7)
+        for seqs in seen.values():
+            self.assertEqual(seqs, sorted(seqs))
+
+    def test_partition(self):
+        processor = ChangesProcessor([], noop_handler, workers=5)
+        self.assertEqual(
+            processor.partition({'id': 'abc'}),
+            processor.partition({'id': u'abc'})
+        )
+        parts = set(processor.partition({'id': 'doc%s' % i}) for i in range(100))
+        self.assertEqual(parts, set(range(5)))
+
+    def test_handler_error(self):
+        def handler(change):
+            if change['seq'] == 100:
+                raise ValueError("womp")
+
+        store = MemoryCheckpointStore()
+        processor = ChangesProcessor(
+            self.feed, handler, workers=2, checkpoint=store, checkpoint_every=1
+        )
+        self.assertRaises(CloudantException, processor.run)
+        self.failUnless(store.load() < 100)
+
+    def test_handler_error_quiet_feed(self):
+        release = threading.Event()
+        finished = threading.Event()
+
+        def feed():
+            for i in range(3):
+                yield {'seq': i, 'id': 'a'}
+            # nothing more arrives until the test is over
+            release.wait(10)
+            finished.set()
+
+        handled = []
+
+        def handler(change):
+            if change['seq'] == 0:
+                raise ValueError("womp")
+            handled.append(change['seq'])
+
+        processor = ChangesProcessor(feed(), handler, workers=2)
+        start = time.time()
+        self.assertRaises(CloudantException, processor.run)
+        release.set()
+        finished.wait(1)
+        self.failUnless(time.time() - start < 5)
+        # the later changes to the same document were dropped
+        self.assertEqual(handled, [])
+
+    def test_stop_quiet_feed(self):
+        release = threading.Event()
+        finished = threading.Event()
+
+        def feed():
+            yield {'seq': 0, 'id': 'a'}
+            release.wait(10)
+            finished.set()
+
+        processor = ChangesProcessor(feed(), noop_handler, workers=2)
+        timer = threading.Timer(0.2, processor.stop)
+        timer.start()
+        self.assertEqual(processor.run(), 0)
+        release.set()
+        finished.wait(1)
+
+    def test_processes(self):
+        processor = ChangesProcessor(
+            self.feed, noop_handler, workers=2, use_processes=True
+        )
+        self.assertEqual(processor.run(), 199)
+        self.assertEqual(processor.processed, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+_replication_test_
+
+Tests for the cloudant.replication module
+
+"""
+import threading
+import time
+import unittest
+import mock
+
+import cloudant
+from cloudant.changes import ChangesBatch
+from cloudant.checkpoint import MemoryCheckpointStore
+from cloudant.errors import CloudantException
+from cloudant.replication import ClientReplication
+
+
+class ClientReplicationTests(unittest.TestCase):
+    """
+    tests for ClientReplication class
+
+    """
+    def setUp(self):
+        self.pages = [
+            ChangesBatch([
+                {'id': 'a', 'seq': 1, 'changes': [{'rev': '1-a'}]},
+                {'id': 'b', 'seq': 2, 'changes': [{'rev': '2-b'}, {'rev': '2-c'}]},
+            ], 2),
+            ChangesBatch([
+                {'id': 'c', 'seq': 3, 'changes': [{'rev': '1-c'}]},
+                {'id': 'd', 'seq': 4, 'changes': [{'rev': '1-d'}]},
+            ], 4),
+            ChangesBatch([
+                {'id': 'e', 'seq': 5, 'changes': [{'rev': '1-e'}]},
+            ], 5),
+        ]
+        self.feed = mock.Mock()
+        self.feed.next_page.side_effect = self.pages
+        self.source = mock.Mock()
+        self.source.database_url = "http://bob.cloudant.com/source"
+        self.source._changes_feed.return_value = self.feed
+
+        def bulk_get(id_revs, **kwargs):
+            for doc_id, rev in id_revs:
+                if doc_id == 'd':
+                    yield {'error': {'id': doc_id, 'error': 'not_found'}}
+                else:
+                    yield {'ok': {'_id': doc_id, '_rev': rev}}
+        self.source.bulk_get.side_effect = bulk_get
+
+        self.target = mock.Mock()
+        self.target.database_url = "http://jim.cloudant.com/target"
+
+        def revs_diff(revisions_map, **kwargs):
+            # the target already has a
+            return dict(
+                (doc_id, {'missing': revs})
+                for doc_id, revs in revisions_map.iteritems()
+                if doc_id != 'a'
+            )
+        self.target.batch_revisions_diff.side_effect = revs_diff
+        self.target.bulk_insert.return_value = []
+
+    def test_replicate(self):
+        """test replicating the missing revisions in batches"""
+        store = MemoryCheckpointStore()
+        progress = mock.Mock()
+        stats = cloudant.replicate(
+            self.source, self.target, batch_size=2, workers=2,
+            checkpoint=store, progress=progress
+        )
+        self.assertEqual(stats['changes'], 5)
+        self.assertEqual(stats['missing_revs'], 5)
+        self.assertEqual(stats['docs_written'], 4)
+        self.assertEqual(stats['write_errors'], 1)
+        self.assertEqual(stats['checkpoint_seq'], 5)
+        self.assertEqual(store.load(), 5)
+        self.assertEqual(progress.call_count, 3)
+        self.failUnless('docs_per_sec' in stats)
+
+        self.source._changes_feed.assert_called_once_with(
+            None, False, False, feed='normal', limit=2, style='all_docs'
+        )
+        written = []
+        for call in self.target.bulk_insert.call_args_list:
+            self.assertEqual(call[1], {'new_edits': False})
+            written.extend(doc['_id'] for doc in call[0][0])
+        self.assertEqual(sorted(written), ['b', 'b', 'c', 'e'])
+        for call in self.source.bulk_get.call_args_list:
+            self.assertTrue(call[1]['revs'])
+
+    def test_replicate_resumes_from_checkpoint(self):
+        """test the replication starts from the stored checkpoint"""
+        self.feed.next_page.side_effect = [ChangesBatch([], 7)]
+        stats = ClientReplication(
+            self.source, self.target,
+            checkpoint=MemoryCheckpointStore(7)
+        ).run()
+        self.assertEqual(self.source._changes_feed.call_args[0][0], 7)
+        self.assertEqual(stats['changes'], 0)
+        self.assertEqual(stats['checkpoint_seq'], 7)
+
+    def test_replicate_error(self):
+        """test an error in a stage stops the replication"""
+        self.target.bulk_insert.side_effect = ValueError("womp")
+        store = MemoryCheckpointStore()
+        replication = ClientReplication(
+            self.source, self.target, batch_size=2, workers=1,
+            checkpoint=store
+        )
+        self.assertRaises(CloudantException, replication.run)
+        self.assertEqual(store.load(), None)
+
+    def test_replicate_error_full_queues(self):
+        """test a failing writer doesnt deadlock the other stages"""
+        self.feed.next_page.side_effect = [
+            ChangesBatch([
+                {'id': 'doc%s' % i, 'seq': i, 'changes': [{'rev': '1-x'}]}
+            ], i)
+            for i in range(50)
+        ]
+
+        def bulk_insert(docs, **kwargs):
+            # let the queues between the stages fill up first
+            time.sleep(0.2)
+            raise ValueError("womp")
+        self.target.bulk_insert.side_effect = bulk_insert
+        replication = ClientReplication(
+            self.source, self.target, batch_size=1, workers=2,
+            queue_size=1, checkpoint=MemoryCheckpointStore()
+        )
+        errors = []
+
+        def run():
+            try:
+                replication.run()
+            except CloudantException as ex:
+                errors.append(ex)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.failIf(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+        self.failUnless('womp' in str(errors[0]))
+
+    def test_default_checkpoint_id(self):
+        """test the default checkpoint id is stable per source/target"""
+        first = ClientReplication.default_checkpoint_id(
+            self.source, self.target
+        )
+        self.assertEqual(
+            first,
+            ClientReplication.default_checkpoint_id(self.source, self.target)
+        )
+        self.assertNotEqual(
+            first,
+            ClientReplication.default_checkpoint_id(self.target, self.source)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,10 +3,12 @@
 _views_test_
 
 """
+import json
 import mock
 import unittest
 
 from cloudant.views import Code, View, DesignDocument
+from cloudant.errors import CloudantArgumentError, CloudantException
 from cloudant.index import Index
 from cloudant.document import Document
 
@@ -77,6 +79,196 @@ class ViewTests(unittest.TestCase):
         with view1.custom_index() as v:
             self.failUnless(isinstance(v, Index))
 
+    def test_view_query_keys(self):
+        """keys are POSTed in the body, in chunks"""
+        db = mock.Mock()
+        db._database_name = 'unittest'
+        ddoc = DesignDocument(db, "_design/tests")
+        ddoc._database_host = "https://bob.cloudant.com"
+        view1 = View(ddoc, "view1", map_func=self.map_func)
+
+        def fake_post(url, params=None, data=None, headers=None):
+            keys = json.loads(data)['keys']
+            resp = mock.Mock()
+            resp.json.return_value = {
+                'rows': [{'key': k, 'id': k, 'value': 1} for k in keys]
+            }
+            return resp
+        ddoc._r_session.post = mock.Mock(side_effect=fake_post)
+
+        result = view1.query_keys(
+            ["a", "b", "c"], chunk_size=2, workers=1, include_docs=True
+        )
+        self.assertEqual([k for k, _ in result], ["a", "b", "c"])
+        self.assertEqual(result[2][1], [{'key': 'c', 'id': 'c', 'value': 1}])
+        self.assertEqual(ddoc._r_session.post.call_count, 2)
+        first = ddoc._r_session.post.call_args_list[0]
+        self.assertEqual(
+            first[0][0],
+            "https://bob.cloudant.com/unittest/_design/tests/_view/view1"
+        )
+        self.assertEqual(first[1]['params'], {'include_docs': 'true'})
+        self.assertEqual(json.loads(first[1]['data']), {'keys': ['a', 'b']})
+
+    def test_view_cache(self):
+        """query results are cached until the update_seq changes"""
+        db = mock.Mock()
+        db._database_name = 'unittest'
+        db.metadata.return_value = {'update_seq': '1-a'}
+        ddoc = DesignDocument(db, "_design/tests")
+        ddoc._database_host = "https://bob.cloudant.com"
+        view1 = View(ddoc, "view1", map_func=self.map_func)
+        ddoc._r_session.get.return_value.json.return_value = {'rows': []}
+
+        view1.enable_cache(seq_check_interval=0)
+        self.assertEqual(view1(key="a", reduce=False), {'rows': []})
+        self.assertEqual(view1(reduce=False, key="a"), {'rows': []})
+        with view1.custom_index(reduce=False) as idx:
+            idx["a"]
+        self.assertEqual(ddoc._r_session.get.call_count, 1)
+        view1(key="b")
+        self.assertEqual(ddoc._r_session.get.call_count, 2)
+
+        db.metadata.return_value = {'update_seq': '2-b'}
+        view1(key="a", reduce=False)
+        self.assertEqual(ddoc._r_session.get.call_count, 3)
+
+        stats = view1.cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['invalidations'], 1)
+
+        view1.disable_cache()
+        view1(key="a", reduce=False)
+        self.assertEqual(ddoc._r_session.get.call_count, 4)
+
+    def test_view_cache_stale(self):
+        """stale is sent as is, and stale results may be served"""
+        db = mock.Mock()
+        db._database_name = 'unittest'
+        db.metadata.return_value = {'update_seq': '1-a'}
+        ddoc = DesignDocument(db, "_design/tests")
+        ddoc._database_host = "https://bob.cloudant.com"
+        view1 = View(ddoc, "view1", map_func=self.map_func)
+        ddoc._r_session.get.return_value.json.return_value = {'rows': []}
+
+        view1.enable_cache(seq_check_interval=0)
+        view1(stale='update_after', limit=5)
+        ddoc._r_session.get.assert_called_once_with(
+            "https://bob.cloudant.com/unittest/_design/tests/_view/view1",
+            params={'stale': 'update_after', 'limit': 5}
+        )
+        self.assertEqual(view1.cache.stats()['misses'], 1)
+
+    def _grouped_view(self, rows):
+        """a View whose queries return the grouped rows in range"""
+        ddoc = DesignDocument(mock.Mock(), "_design/tests")
+        view1 = View(ddoc, "view1", map_func=self.map_func)
+        calls = []
+
+        def query(**kwargs):
+            calls.append(kwargs)
+            result = []
+            for key, value in rows:
+                if 'startkey' in kwargs and key < kwargs['startkey']:
+                    continue
+                if 'endkey' in kwargs:
+                    if key > kwargs['endkey']:
+                        continue
+                    if key == kwargs['endkey'] and \
+                            not kwargs.get('inclusive_end', True):
+                        continue
+                result.append({'key': key, 'value': value})
+            return {'rows': result[:kwargs['limit']]}
+        return view1, calls, query
+
+    def test_view_grouped(self):
+        """grouped output is paged by key without skip"""
+        rows = [([2013, m], m) for m in range(1, 6)]
+        view1, calls, query = self._grouped_view(rows)
+        with mock.patch.object(View, '__call__', side_effect=query):
+            result = list(view1.grouped(group_level=2, page_size=2))
+        self.assertEqual(result, [{'key': k, 'value': v} for k, v in rows])
+        self.assertEqual(
+            [c.get('startkey') for c in calls],
+            [None, [2013, 3], [2013, 5]]
+        )
+        for call in calls:
+            self.assertEqual(call['group_level'], 2)
+            self.assertEqual(call['limit'], 3)
+            self.failIf('skip' in call)
+
+        self.assertRaises(
+            CloudantArgumentError, list, view1.grouped(skip=10)
+        )
+
+    def test_view_grouped_json_keys(self):
+        """pages can start at number, null or object keys"""
+        db = mock.Mock()
+        db._database_name = 'unittest'
+        ddoc = DesignDocument(db, "_design/tests")
+        ddoc._database_host = "https://bob.cloudant.com"
+        view1 = View(ddoc, "view1", map_func=self.map_func)
+        keys = [None, 0.5, 1.5, 2 ** 40, {'a': 1}]
+        startkeys = []
+
+        def fake_get(url, params=None):
+            start = 0
+            if 'startkey' in params:
+                startkeys.append(params['startkey'])
+                start = keys.index(json.loads(params['startkey']))
+            resp = mock.Mock()
+            resp.json.return_value = {'rows': [
+                {'key': k, 'value': 1}
+                for k in keys[start:start + params['limit']]
+            ]}
+            return resp
+        ddoc._r_session.get = mock.Mock(side_effect=fake_get)
+
+        result = list(view1.grouped(page_size=1))
+        self.assertEqual([r['key'] for r in result], keys)
+        self.assertEqual(
+            startkeys, ['0.5', '1.5', '1099511627776', '{"a": 1}']
+        )
+
+    def test_view_grouped_key_ranges(self):
+        """ranges are queried in parallel and split groups merged"""
+        rows = [
+            (['a'], 1), (['b'], 2), (['b'], 3), (['c'], 4), (['d'], 5)
+        ]
+        view1, calls, query = self._grouped_view(rows)
+        ranges = [(None, ['b']), (['b'], ['c']), (['c'], None)]
+        with mock.patch.object(View, '__call__', side_effect=query):
+            result = list(view1.grouped(key_ranges=ranges, workers=2))
+        self.assertEqual(
+            [(r['key'], r['value']) for r in result],
+            [(['a'], 1), (['b'], 2), (['b'], 3), (['c'], 4), (['d'], 5)]
+        )
+        self.assertEqual(len(calls), 3)
+        for call in calls:
+            self.assertTrue(call['group'])
+            if 'endkey' in call:
+                self.assertFalse(call['inclusive_end'])
+
+        # a group split across the ranges is merged
+        rows = [(['a'], 1), (['b'], 2), (['c'], 4)]
+        view1, calls, query = self._grouped_view(rows)
+        split = [(None, ['b']), (['b'], None)]
+
+        def split_query(**kwargs):
+            result = query(**kwargs)
+            if 'endkey' in kwargs:
+                result['rows'].append({'key': ['b'], 'value': 10})
+            return result
+        with mock.patch.object(View, '__call__', side_effect=split_query):
+            result = list(view1.grouped(
+                key_ranges=split, merge=lambda x, y: x + y
+            ))
+        self.assertEqual(
+            [(r['key'], r['value']) for r in result],
+            [(['a'], 1), (['b'], 12), (['c'], 4)]
+        )
+
 
 class DesignDocTests(unittest.TestCase):
     """
@@ -115,6 +307,245 @@ class DesignDocTests(unittest.TestCase):
             self.assertEqual(ddoc['views']['view2'].reduce, None)
             self.failUnless(mock_save.called)
 
+    def _warm_ddoc(self, tasks, infos):
+        """a DesignDocument whose _active_tasks and _info are faked"""
+        mock_database = mock.Mock()
+        mock_database._database_name = 'unittest'
+        mock_database.metadata.return_value = {'update_seq': '100-abc'}
+        ddoc = DesignDocument(mock_database, '_design/unittest')
+        ddoc._database_host = "https://bob.cloudant.com"
+        ddoc['views'] = {'view1': {'map': "MAP"}, 'view2': {'map': "MAP"}}
+        requests = []
+
+        def fake_get(url, params=None):
+            requests.append((url, params))
+            resp = mock.Mock()
+            resp.status_code = 200
+            if url.endswith('_active_tasks'):
+                result = tasks.pop(0) if len(tasks) > 1 else tasks[0]
+                if result is None:
+                    resp.status_code = 403
+                resp.json.return_value = result
+            elif url.endswith('_info'):
+                result = infos.pop(0) if len(infos) > 1 else infos[0]
+                resp.json.return_value = {'view_index': result}
+            return resp
+        ddoc._r_session.get = mock.Mock(side_effect=fake_get)
+        return ddoc, requests
+
+    def test_ddoc_warm(self):
+        """test triggering and waiting for an index build"""
+        def task(done, shard):
+            return {
+                'type': 'indexer',
+                'database': 'shards/{0}/unittest.1415960794'.format(shard),
+                'design_document': '_design/unittest',
+                'changes_done': done,
+                'total_changes': 100,
+            }
+        tasks = [
+            # the indexer hasnt registered yet
+            [],
+            [task(10, '00-7f'), task(10, '80-ff'),
+             {'type': 'indexer', 'database': 'other',
+              'design_document': '_design/unittest'}],
+            [task(50, '00-7f'), task(50, '80-ff')],
+            [],
+        ]
+        infos = [
+            {'updater_running': False, 'update_seq': 0},
+            {'updater_running': True, 'update_seq': 20},
+            {'updater_running': True, 'update_seq': 50},
+            {'updater_running': False, 'update_seq': 100},
+        ]
+        ddoc, requests = self._warm_ddoc(tasks, infos)
+
+        reports = []
+        with mock.patch('cloudant.views.time') as mock_time:
+            mock_time.time.side_effect = [0, 0, 10, 20, 30]
+            status = ddoc.warm(poll_interval=1, progress=reports.append)
+
+        view_url = "https://bob.cloudant.com/unittest/_design/unittest/_view/view1"
+        self.assertEqual(
+            requests[0], (view_url, {'limit': 0, 'stale': 'update_after'})
+        )
+        self.assertEqual(
+            len([r for r in requests if '_view' in r[0]]), 1
+        )
+        self.assertEqual(
+            [r['percent'] for r in reports], [0.0, 10.0, 50.0, 100.0]
+        )
+        self.assertEqual(reports[0]['current'], False)
+        self.assertEqual(reports[0]['eta'], None)
+        # 100 changes done in 20s, 100 to go
+        self.assertEqual(reports[2]['eta'], 20.0)
+        self.assertFalse(status['running'])
+        self.assertTrue(status['current'])
+        self.assertEqual(mock_time.sleep.call_count, 3)
+
+    def test_ddoc_warm_without_seqs(self):
+        """
+        test waiting for a build when the seqs cant be compared and the
+        active tasks cant be seen
+        """
+        infos = [
+            {'updater_running': False},
+            {'updater_running': True},
+            {'updater_running': False},
+        ]
+        ddoc, requests = self._warm_ddoc([None], infos)
+        with mock.patch('cloudant.views.time') as mock_time:
+            mock_time.time.return_value = 0
+            status = ddoc.warm(poll_interval=1)
+        # not finished on the first check, before the build was seen
+        self.assertEqual(mock_time.sleep.call_count, 2)
+        self.assertEqual(status['current'], None)
+        self.assertEqual(status['percent'], 100.0)
+
+        # never seen running, finished after a second check
+        ddoc, requests = self._warm_ddoc([None], [{'updater_running': False}])
+        with mock.patch('cloudant.views.time') as mock_time:
+            mock_time.time.return_value = 0
+            ddoc.warm(poll_interval=1)
+        self.assertEqual(mock_time.sleep.call_count, 1)
+
+    def test_ddoc_warm_retrigger(self):
+        """test an out of date index that nothing is building"""
+        infos = [
+            {'updater_running': False, 'update_seq': 0},
+            {'updater_running': False, 'update_seq': 0},
+            {'updater_running': False, 'update_seq': 100},
+        ]
+        ddoc, requests = self._warm_ddoc([[]], infos)
+        # a cached view still sends every trigger to the server
+        view1 = View(ddoc, 'view1')
+        view1.enable_cache(seq_check_interval=0)
+        ddoc['views']['view1'] = view1
+        with mock.patch('cloudant.views.time') as mock_time:
+            mock_time.time.return_value = 0
+            status = ddoc.warm(poll_interval=1)
+        self.assertTrue(status['current'])
+        self.assertEqual(len([r for r in requests if '_view' in r[0]]), 2)
+        self.assertEqual(view1.cache.stats()['misses'], 0)
+
+    def test_ddoc_warm_timeout(self):
+        """test giving up waiting for an index build"""
+        ddoc, requests = self._warm_ddoc(
+            [[]], [{'updater_running': True, 'update_seq': 5}]
+        )
+        with mock.patch('cloudant.views.time') as mock_time:
+            mock_time.time.side_effect = [0, 0, 60]
+            self.assertRaises(CloudantException, ddoc.warm, timeout=30)
+
+        self.assertEqual(DesignDocument(ddoc._cloudant_database, '_design/x').warm(), None)
+
+    def _ops_ddoc(self):
+        mock_database = mock.Mock()
+        mock_database._database_name = 'unittest'
+        mock_database.database_url = "https://bob.cloudant.com/unittest"
+        ddoc = DesignDocument(mock_database, '_design/unittest')
+        ddoc._database_host = "https://bob.cloudant.com"
+        return ddoc
+
+    def test_ddoc_info(self):
+        """test size and fragmentation reporting"""
+        ddoc = self._ops_ddoc()
+        ddoc._r_session.get.return_value.json.return_value = {
+            'name': 'unittest',
+            'view_index': {
+                'sizes': {'active': 250, 'external': 400, 'file': 1000},
+                'compact_running': False,
+            }
+        }
+        info = ddoc.info()
+        ddoc._r_session.get.assert_called_once_with(
+            "https://bob.cloudant.com/unittest/_design/unittest/_info"
+        )
+        self.assertEqual(info['sizes'], {
+            'active': 250, 'external': 400, 'file': 1000,
+            'fragmentation': 0.75
+        })
+        self.assertEqual(info['name'], 'unittest')
+
+        # older servers
+        ddoc._r_session.get.return_value.json.return_value = {
+            'view_index': {'disk_size': 200, 'data_size': 150}
+        }
+        self.assertEqual(ddoc.info()['sizes'], {
+            'active': 150, 'external': None, 'file': 200,
+            'fragmentation': 0.25
+        })
+
+    def test_ddoc_cleanup(self):
+        ddoc = self._ops_ddoc()
+        ddoc._r_session.post.return_value.json.return_value = {'ok': True}
+        self.assertEqual(ddoc.cleanup(), {'ok': True})
+        self.assertEqual(
+            ddoc._r_session.post.call_args[0][0],
+            "https://bob.cloudant.com/unittest/_view_cleanup"
+        )
+
+    def test_ddoc_compact(self):
+        """test compacting and waiting for the compaction"""
+        ddoc = self._ops_ddoc()
+        ddoc._r_session.post.return_value.json.return_value = {'ok': True}
+        idle = {'compact_running': False, 'sizes': {'file': 1000}}
+        infos = [
+            # before the request, then before the compaction has started
+            idle,
+            idle,
+            {'compact_running': True, 'sizes': {'file': 1000}},
+            {'compact_running': False, 'sizes': {'file': 1000}},
+            {'compact_running': False, 'sizes': {'file': 400}},
+        ]
+        tasks = [
+            [],
+            [{'type': 'view_compaction', 'design_document': '_design/unittest',
+              'database': 'shards/00-ff/unittest.123'}],
+            [],
+        ]
+
+        def fake_get(url, params=None):
+            resp = mock.Mock()
+            resp.status_code = 200
+            if url.endswith('_active_tasks'):
+                resp.json.return_value = tasks.pop(0)
+            else:
+                resp.json.return_value = {'view_index': infos.pop(0)}
+            return resp
+        ddoc._r_session.get = mock.Mock(side_effect=fake_get)
+
+        self.assertEqual(ddoc.compact(), {'ok': True})
+        self.assertEqual(
+            ddoc._r_session.post.call_args[0][0],
+            "https://bob.cloudant.com/unittest/_compact/unittest"
+        )
+        with mock.patch('cloudant.views.time') as mock_time:
+            mock_time.time.return_value = 0
+            info = ddoc.compact(wait=True, poll_interval=1)
+        self.assertEqual(mock_time.sleep.call_count, 3)
+        self.assertFalse(info['view_index']['compact_running'])
+        self.assertEqual(info['sizes']['file'], 400)
+        self.assertEqual(infos, [])
+
+        # a compaction that is over before the first check, but has
+        # changed the index sizes
+        infos[:] = [idle, {'compact_running': False, 'sizes': {'file': 400}}]
+        tasks[:] = [[]]
+        with mock.patch('cloudant.views.time') as mock_time:
+            mock_time.time.return_value = 0
+            info = ddoc.compact(wait=True, poll_interval=1)
+        self.assertEqual(mock_time.sleep.call_count, 0)
+        self.assertEqual(info['sizes']['file'], 400)
+
+        # nothing seen and nothing changed, finished after two checks
+        infos[:] = [idle, idle, idle]
+        tasks[:] = [[], []]
+        with mock.patch('cloudant.views.time') as mock_time:
+            mock_time.time.return_value = 0
+            ddoc.compact(wait=True, poll_interval=1)
+        self.assertEqual(mock_time.sleep.call_count, 1)
+
     def test_list_views(self):
         mock_database = mock.Mock()
         ddoc = DesignDocument(mock_database, '_design/unittest')